@@ -7,8 +7,16 @@
 # Purpose: Provide a whole range of PMAC monitoring services, backups, compares, etc.
 # ------------------------------------------------------------------------------
 
-import getopt, sys, re, os, datetime, os.path
+import getopt, sys, re, os, datetime, os.path, socket, struct, select, time, errno, types, gzip, json, multiprocessing, hashlib, StringIO, sqlite3
 from xml.dom.minidom import *
+try:
+    import lzma
+except ImportError:
+    lzma = None
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 if __name__ == '__main__':
 #    from pkg_resources import require
@@ -30,6 +38,11 @@ helpText = '''
         -h, --help                Print the help text and exit
         --backup=<dir>            As config file 'backup' statement (see below)
         --comments                As config file 'comments' statement (see below)
+        --compress=<format>       As config file 'compress' statement (see below)
+        --backupstore=<dir>       As config file 'backupstore' statement (see below)
+        --deltabackup=<runs>      As config file 'deltabackup' statement (see below)
+        --restore=<manifest>      Write the backup described by a backup store manifest
+                                  to stdout and exit
         --resultsdir=<dir>        As config file 'resultsdir' statement (see below)
         --pmac=<name>             As config file 'pmac' statement (see below)
         --ts=<ip>:<port>          As config file 'ts' statement (see below)
@@ -46,10 +59,48 @@ helpText = '''
         --debug                   Turns on extra debug output
         --fixfile=<file>          Generate a fix file that can be loaded to the PMAC
         --unfixfile=<file>        Generate a file that can be used to correct the reference
+        --pipeline=<depth>        As config file 'pipeline' statement (see below)
+        --concurrent=<num>        As config file 'concurrent' statement (see below)
+        --record=<dir>            As config file 'record' statement (see below)
+        --replay=<dir>            As config file 'replay' statement (see below)
+        --replayrealtime          As config file 'replayrealtime' statement (see below)
+        --renderprocesses=<num>   As config file 'renderprocesses' statement (see below)
+        --bundle=<format>         As config file 'bundle' statement (see below)
+        --diffonly                As config file 'diffonly' statement (see below)
+        --quick-check             As config file 'quickcheck' statement (see below)
+        --apply-fix               As config file 'applyfix' statement (see below)
+        --read=<spec>             As config file 'read' statement (see below)
+        --sections=<names>        As config file 'sections' statement (see below)
+        --watch=<seconds>         As config file 'watch' statement (see below)
+        --poll=<spec>             As config file 'poll' statement (see below)
+        --pollrate=<hz>           As config file 'pollrate' statement (see below)
+        --pollbuffer=<samples>    As config file 'pollbuffer' statement (see below)
+        --pollflush=<seconds>     As config file 'pollflush' statement (see below)
+        --topologycache=<file>    As config file 'topologycache' statement (see below)
+        --programcache=<file>     As config file 'programcache' statement (see below)
+        --history=<file>          As config file 'history' statement (see below)
+        --changes=<varSpec>       Print when the variables changed on each PMAC in the
+                                  history database and exit
+        --query=<query>           Query the latest state of each PMAC in the history
+                                  database and of each query path snapshot file, and
+                                  exit.  <query> is <varSpec>, <varSpec><op><value>,
+                                  where <op> is one of = != < > <= >=, or
+                                  refs:<word> for the programs that use the word
+        --queryformat=<format>    Print the query results as a table (the default)
+                                  or json
+        --querypath=<path>        As config file 'querypath' statement (see below)
+        --queryindex=<file>       As config file 'queryindex' statement (see below)
 
   Config file syntax:
     resultsdir <dir>
-      Directory into which to place the results HTML files.  Defaults to pmacAnalysis.
+      Directory into which to place the results HTML files, the JUnit report
+      report.xml with the time taken by each phase of the analysis of each
+      PMAC, the same timings as report_timings.json, the differences
+      found for each PMAC, <pmacName>_compare.json, and the readout
+      statistics, readout_stats.json.  Defaults to pmacAnalysis.  The file
+      page_manifest.json records a hash of the contents of each group of
+      pages; pages whose contents have not changed since the previous run
+      are not rewritten.
     pmac <name>
       Define a PMAC.
         name = Name of the PMAC
@@ -63,8 +114,140 @@ helpText = '''
         port = Host port number
     backup <dir>
       Write backup files in the specified directory.  Defaults to no backup written.
+      A backup replaces the previous one only when the readout has completed.
+    compress <format>
+      Compress the backup files, format is gzip (<pmacName>.pmc.gz) or xz
+      (<pmacName>.pmc.xz, requires the lzma module).  Defaults to uncompressed.
+    deltabackup <runs>
+      Write differential backups.  A full backup, <pmacName>.pmc, is written
+      every <runs> runs and is the base of the runs in between, which write
+      only the lines that have changed since the base to <pmacName>.delta.pmc.
+      Loading the base followed by the delta restores the PMAC.  Defaults to
+      0, every backup is full.
+    backupstore <dir>
+      Also store backups in a content-addressed store in the specified
+      directory.  Each section of a backup is stored once in <dir>/objects
+      under the SHA-1 of its text and each completed readout writes a
+      manifest, <dir>/manifests/<pmacName>/<yyyymmdd-hhmmss>.json, listing
+      its sections.  Unchanged sections cost no further space.  The .pmc
+      text is recreated with --restore=<manifest>.
     comments
       Write comments into backup files.
+    concurrent <num>
+      Read the hardware of up to <num> PMACs at once from a single thread
+      using non-blocking connections.  Each PMAC keeps up to its pipeline
+      depth of commands in flight.  Defaults to 0, PMACs are read one at a
+      time using the dls_pmaclib interfaces.
+    record <dir>
+      Record every command sent to each PMAC during the hardware readout, with
+      its reply and timing, into the trace file <dir>/<pmacName>.trace.gz.
+    replay <dir>
+      Rather than connecting to each PMAC, replay the hardware readout from the
+      trace file <dir>/<pmacName>.trace.gz written by a 'record' statement.
+      The readout fails if it sends commands other than those recorded.
+    replayrealtime
+      Replay traces at the recorded speed.  Defaults to replaying as fast as
+      possible.
+    renderprocesses <num>
+      Render the HTML pages of the PMACs on a pool of <num> processes once all
+      the PMACs have been analysed.  Defaults to 0, the pages are rendered by
+      this process.
+    bundle <format>
+      Rather than an HTML page for each part of each PMAC's state, write a
+      single <pmacName>_bundle.json (format json) or <pmacName>_bundle.json.gz
+      (format gzip) per PMAC and the page viewer.htm, which displays the
+      bundles in the browser.  The viewer fetches the bundles so the results
+      directory must be served over HTTP.
+    diffonly
+      Only compare the PMACs.  The differences are written to
+      <pmacName>_compare.json in the results directory, along with report.xml
+      and any fix files, but no HTML pages are written.
+    quickcheck
+      Only determine whether each PMAC matches its reference.  Each section of
+      the hardware is compared as soon as it has been read and the readout
+      stops at the first mismatch.  Variables used by inline expressions in the
+      reference are read directly from the PMAC.  Only a summary index page and
+      report.xml are written.  PMACs are read one at a time.
+    read <spec>
+      Only read and compare part of each PMAC, there can be more than one of
+      these.  The spec is either a variable specification, as for nocompare,
+      or the name of a section, see the sections statement.  No backup, index
+      page or section pages are written, only the comparison results and
+      report.xml.
+    sections <names>
+      Only read, compare and render the comma separated sections: ivars,
+      pvars, qvars, mdefs (M-variable definitions), mvals (M-variable values),
+      plcs, progs (motion programs), kinematics, cs (coordinate system
+      definitions), msivars (macro station I-variables) and feedrate.  No
+      backup is written and the index page only links to the pages rendered.
+    watch <seconds>
+      Monitor the PMACs until interrupted rather than analysing them once.
+      The connection to each PMAC is kept open and its reference is only
+      parsed once, after the first readout.  The hardware is read again every
+      <seconds> and compared with the reference.  The comparison results and
+      report.xml are only written when the differences of a PMAC change.  A
+      PMAC that fails to read is reconnected at the next readout.  No
+      backups, section pages or index page are written.
+    poll <spec>
+      Sample variables of each PMAC at a fixed rate until interrupted rather
+      than analysing them, there can be more than one of these.  The spec is
+      a variable specification, as for nocompare, of P, M (values), Q or I
+      variables, or #<motor> or #<first>..<last> for motor positions.  The
+      samples are kept in a ring buffer per PMAC, which is regularly appended
+      to <pmacName>_poll.dat in the results directory as rows of 8 byte
+      little endian floats, the time followed by the values.  The columns
+      and the minimum, maximum, mean and standard deviation of each over the
+      samples in the buffer are written to <pmacName>_poll.json.  A sample
+      that cannot be read is stored as a row of NaN values, counted as failed
+      in <pmacName>_poll.json, and the PMAC is reconnected at the next
+      sample.  Requires numpy.
+    pollrate <hz>
+      The number of samples per second taken by poll, default 10.
+    pollbuffer <samples>
+      The size of the ring buffer of poll samples of each PMAC, default 10000.
+    pollflush <seconds>
+      The interval between writes of the poll files, default 10.
+    topologycache <file>
+      Keep the type, number of axes, number of coordinate systems and macro
+      stations of each PMAC, by host and port, in this JSON file.  When a
+      PMAC is in the cache, the discovery commands are sent as a single
+      command line and the cached topology is used if the reply is the one
+      cached, otherwise the PMAC is discovered again and the cache updated.
+      The cache is not used while recording or replaying.
+    programcache <file>
+      Keep the listing of each PLC and motion program of each PMAC, by host
+      and port, in this JSON file.  Every block of a cached listing, and the
+      end of the listing, is read again as its fingerprint in a single batch
+      of commands, pipelined if the pipeline statement allows, rather than
+      one block after another.  The cached listing is used if they are all
+      unchanged, otherwise the buffer is listed again, so any edit is
+      noticed.  The cache is not used while recording or replaying.
+    history <file>
+      Store the hardware state of each complete readout in this SQLite
+      database.  Each readout is a row of the runs table (run, pmac, started)
+      and the vars table (run, pmac, family, node, number, value) holds the
+      value of every variable read by the run.  The vars table is indexed
+      by run and by (pmac, family, node, number, run), so the state of a PMAC
+      as of any run, and the values of a variable over the runs, see
+      --changes, are both single indexed queries.
+    querypath <path>
+      A PMC snapshot file, such as a backup, or a directory of them to be
+      searched by --query, there can be more than one of these.  Backups in
+      the backup directory are searched if there are none.  Files ending
+      .pmc, .pmc.gz and .pmc.xz are searched, differential backups are not.
+    queryindex <file>
+      The SQLite database, in the format of the history statement, that
+      indexes the snapshot files searched by --query.  Only new or changed
+      files are parsed, on a pool of processes.  Defaults to query_index.db
+      in the results directory.
+    applyfix
+      Download the fix for each PMAC that does not match its reference, the
+      commands of the --fixfile file, over a new connection.  Commands are
+      batched into multi-command lines, program buffers are sent line by
+      line.  Only the variables, axis definitions, programs and PLC states
+      the fix touched are then read back.  Those that still differ, or that
+      could not be read back, are written to <pmacName>_applyfix.json in the
+      results directory.
     comparewith <pmcfile>
       Rather than reading the hardware, use this PMC file as
       the current PMAC state.
@@ -120,6 +303,10 @@ helpText = '''
     macroics <num>
       The number of macro ICs the PMAC has.  If not specified, the number
       is automatically determined.
+    pipeline <depth>
+      The number of commands that may be in flight to the PMAC at once while
+      reading ranges of variables.  Only used by the tcpip and ts connections.
+      Defaults to 1, every command waits for its reply before the next is sent.
   '''
 
 def tokenIsInt(token):
@@ -229,11 +416,14 @@ class LexerError(Exception):
         return '[%s:%s] Unknown token: %s' % (self.fileName, self.line, self.token)
 
 class ParserError(Exception):
-    '''Parser error exception.'''
+    '''Parser error exception.  The token is None at the end of the input.'''
     def __init__(self, message, token):
         self.message = message
-        self.line = token.line
-        self.fileName = token.fileName
+        self.line = '?'
+        self.fileName = '?'
+        if token is not None:
+            self.line = token.line
+            self.fileName = token.fileName
     def __str__(self):
         return '[%s:%s] %s' % (self.fileName, self.line, self.message)
 
@@ -274,6 +464,9 @@ class GlobalConfig(object):
         '''Constructor.'''
         self.verbose = False
         self.backupDir = None
+        self.backupStoreDir = None
+        self.deltaBackupEvery = 0
+        self.restoreManifest = None
         self.writeAnalysis = True
         self.comments = False
         self.configFile = None
@@ -287,6 +480,33 @@ class GlobalConfig(object):
         self.debug = False
         self.fixfile = None
         self.unfixfile = None
+        self.concurrent = 0
+        self.recordDir = None
+        self.replayDir = None
+        self.replayRealTime = False
+        self.renderProcesses = 0
+        self.bundleFormat = None
+        self.diffOnly = False
+        self.quickCheck = False
+        self.applyFix = False
+        self.readSpecs = None
+        self.sections = None
+        self.watchInterval = None
+        self.pollSpecs = None
+        self.pollRate = 10.0
+        self.pollBufferSize = 10000
+        self.pollFlushInterval = 10.0
+        self.topologyCacheFile = None
+        self.programCacheFile = None
+        self.historyFile = None
+        self.changesSpec = None
+        self.queryText = None
+        self.queryFormat = 'table'
+        self.queryPaths = []
+        self.queryIndexFile = None
+        self.startTime = time.time()
+        self.factorySettingsTime = 0.0
+        self.backupCompression = None
     def createOrGetPmac(self, name):
         if name not in self.pmacs:
             self.pmacs[name] = Pmac(name)
@@ -300,7 +520,15 @@ class GlobalConfig(object):
                 'geobrick', 'vmepmac', 'reference=', 'comparewith=',
                 'resultsdir=', 'nocompare=', 'only=', 'include=',
                 'nofactorydefs', 'macroics=', 'checkpositions', 'debug', 'comments',
-                'fixfile=', 'unfixfile='])
+                'fixfile=', 'unfixfile=', 'pipeline=', 'concurrent=',
+                'record=', 'replay=', 'replayrealtime', 'renderprocesses=',
+                'bundle=', 'diffonly', 'quick-check', 'compress=', 'backupstore=',
+                'restore=', 'deltabackup=',
+                'apply-fix', 'read=', 'sections=', 'watch=',
+                'poll=', 'pollrate=', 'pollbuffer=', 'pollflush=',
+                'topologycache=', 'programcache=',
+                'history=', 'changes=', 'query=', 'queryformat=', 'querypath=',
+                'queryindex='])
         except getopt.GetoptError, err:
             raise ArgumentError(str(err))
         globalPmac = Pmac('global')
@@ -314,6 +542,14 @@ class GlobalConfig(object):
                 self.backupDir = a
             elif o == '--comments':
                 self.comments = True
+            elif o == '--compress':
+                self.setBackupCompression(a)
+            elif o == '--deltabackup':
+                self.deltaBackupEvery = int(a)
+            elif o == '--backupstore':
+                self.backupStoreDir = a
+            elif o == '--restore':
+                self.restoreManifest = a
             elif o == '--pmac':
                 curPmac = self.createOrGetPmac(a)
                 curPmac.copyNoComparesFrom(globalPmac)
@@ -399,13 +635,90 @@ class GlobalConfig(object):
                     raise ArgumentError('No PMAC yet defined')
                 else:
                     curPmac.setNumMacroStationIcs(int(a))
+            elif o == '--pipeline':
+                if curPmac is None:
+                    raise ArgumentError('No PMAC yet defined')
+                else:
+                    curPmac.setPipelineDepth(int(a))
             elif o == '--checkpositions':
                 self.checkPositions = True
+            elif o == '--concurrent':
+                self.concurrent = int(a)
+            elif o == '--record':
+                self.recordDir = a
+            elif o == '--replay':
+                self.replayDir = a
+            elif o == '--replayrealtime':
+                self.replayRealTime = True
+            elif o == '--renderprocesses':
+                self.renderProcesses = int(a)
+            elif o == '--diffonly':
+                self.diffOnly = True
+            elif o == '--quick-check':
+                self.quickCheck = True
+            elif o == '--apply-fix':
+                self.applyFix = True
+            elif o == '--read':
+                self.addReadSpec(a)
+            elif o == '--sections':
+                self.setSections(a)
+            elif o == '--watch':
+                self.watchInterval = float(a)
+            elif o == '--poll':
+                self.addPollSpec(a)
+            elif o == '--pollrate':
+                self.pollRate = float(a)
+            elif o == '--pollbuffer':
+                self.pollBufferSize = int(a)
+            elif o == '--pollflush':
+                self.pollFlushInterval = float(a)
+            elif o == '--topologycache':
+                self.topologyCacheFile = a
+            elif o == '--programcache':
+                self.programCacheFile = a
+            elif o == '--history':
+                self.historyFile = a
+            elif o == '--changes':
+                self.changesSpec = a
+            elif o == '--query':
+                self.queryText = a
+            elif o == '--queryformat':
+                if a not in ['table', 'json']:
+                    raise ArgumentError('Unknown query format: %s' % a)
+                self.queryFormat = a
+            elif o == '--querypath':
+                self.queryPaths.append(a)
+            elif o == '--queryindex':
+                self.queryIndexFile = a
+            elif o == '--bundle':
+                if a not in ['json', 'gzip']:
+                    raise ArgumentError('Bad bundle format: %s' % a)
+                self.bundleFormat = a
         if len(args) > 1:
             raise ArgumentError('Too many arguments.')
         if len(args) == 1:
             self.configFile = args[0]
         return True
+    def addReadSpec(self, spec):
+        if self.readSpecs is None:
+            self.readSpecs = []
+        self.readSpecs.append(spec)
+    def addPollSpec(self, spec):
+        if self.pollSpecs is None:
+            self.pollSpecs = []
+        self.pollSpecs.append(spec)
+    def setSections(self, text):
+        self.sections = []
+        for name in text.lower().split(','):
+            if name not in Pmac.readSections:
+                raise ArgumentError('Unknown section: %s' % name)
+            self.sections.append(name)
+    def setBackupCompression(self, compression):
+        if compression not in ['gzip', 'xz']:
+            raise ArgumentError('Bad backup compression: %s' % compression)
+        elif compression == 'xz' and lzma is None:
+            raise ArgumentError('xz compression requires the lzma module')
+        self.backupCompression = compression
     def processConfigFile(self):
         '''Process the configuration file.'''
         if self.configFile is None:
@@ -441,6 +754,55 @@ class GlobalConfig(object):
                     self.backupDir = words[1]
                 elif words[0].lower() == 'comments' and len(words) == 1:
                     self.comments = True
+                elif words[0].lower() == 'deltabackup' and len(words) == 2:
+                    self.deltaBackupEvery = int(words[1])
+                elif words[0].lower() == 'backupstore' and len(words) == 2:
+                    self.backupStoreDir = words[1]
+                elif words[0].lower() == 'compress' and len(words) == 2:
+                    self.setBackupCompression(words[1].lower())
+                elif words[0].lower() == 'concurrent' and len(words) == 2:
+                    self.concurrent = int(words[1])
+                elif words[0].lower() == 'record' and len(words) == 2:
+                    self.recordDir = words[1]
+                elif words[0].lower() == 'replay' and len(words) == 2:
+                    self.replayDir = words[1]
+                elif words[0].lower() == 'replayrealtime' and len(words) == 1:
+                    self.replayRealTime = True
+                elif words[0].lower() == 'renderprocesses' and len(words) == 2:
+                    self.renderProcesses = int(words[1])
+                elif words[0].lower() == 'diffonly' and len(words) == 1:
+                    self.diffOnly = True
+                elif words[0].lower() == 'sections' and len(words) == 2:
+                    self.setSections(words[1])
+                elif words[0].lower() == 'watch' and len(words) == 2:
+                    self.watchInterval = float(words[1])
+                elif words[0].lower() == 'poll' and len(words) == 2:
+                    self.addPollSpec(words[1])
+                elif words[0].lower() == 'pollrate' and len(words) == 2:
+                    self.pollRate = float(words[1])
+                elif words[0].lower() == 'pollbuffer' and len(words) == 2:
+                    self.pollBufferSize = int(words[1])
+                elif words[0].lower() == 'pollflush' and len(words) == 2:
+                    self.pollFlushInterval = float(words[1])
+                elif words[0].lower() == 'topologycache' and len(words) == 2:
+                    self.topologyCacheFile = words[1]
+                elif words[0].lower() == 'programcache' and len(words) == 2:
+                    self.programCacheFile = words[1]
+                elif words[0].lower() == 'history' and len(words) == 2:
+                    self.historyFile = words[1]
+                elif words[0].lower() == 'querypath' and len(words) == 2:
+                    self.queryPaths.append(words[1])
+                elif words[0].lower() == 'queryindex' and len(words) == 2:
+                    self.queryIndexFile = words[1]
+                elif words[0].lower() == 'read' and len(words) == 2:
+                    self.addReadSpec(words[1])
+                elif words[0].lower() == 'applyfix' and len(words) == 1:
+                    self.applyFix = True
+                elif words[0].lower() == 'quickcheck' and len(words) == 1:
+                    self.quickCheck = True
+                elif words[0].lower() == 'bundle' and len(words) == 2 and \
+                        words[1].lower() in ['json', 'gzip']:
+                    self.bundleFormat = words[1].lower()
                 elif words[0].lower() == 'nocompare' and len(words) == 2:
                     parser = PmacParser([words[1]], None)
                     (type, nodeList, start, count, increment) = parser.parseVarSpec()
@@ -462,6 +824,8 @@ class GlobalConfig(object):
                         count -= 1
                 elif words[0].lower() == 'macroics' and len(words) == 2 and curPmac is not None:
                     curPmac.setNumMacroStationIcs(int(words[1]))
+                elif words[0].lower() == 'pipeline' and len(words) == 2 and curPmac is not None:
+                    curPmac.setPipelineDepth(int(words[1]))
                 else:
                     raise ConfigError("Unknown configuration: %s" % repr(line))
     def makeVars(self, varType, nodeList, n):
@@ -482,8 +846,117 @@ class GlobalConfig(object):
         else:
             raise ConfigError('Cannot decode variable type %s' % repr(varType))
         return result
+    def restoreBackup(self):
+        '''Writes the backup described by a backup store manifest to stdout.'''
+        manifestFileName = os.path.abspath(self.restoreManifest)
+        storeDir = os.path.dirname(os.path.dirname(os.path.dirname(manifestFileName)))
+        sys.stdout.write(PmacBackupStore(storeDir).restore(manifestFileName))
+    def printChanges(self):
+        '''Prints when the variables of the changes specification changed on
+           each PMAC in the history database.'''
+        if self.historyFile is None:
+            raise ConfigError('No history database given')
+        history = PmacHistory(self.historyFile)
+        parser = PmacParser([self.changesSpec], None)
+        (type, nodeList, start, count, increment) = parser.parseVarSpec()
+        addrs = []
+        while count > 0:
+            addrs += [var.addr() for var in self.makeVars(type, nodeList, start)]
+            start += increment
+            count -= 1
+        for pmacName in history.pmacNames():
+            if self.onlyPmacs is None or pmacName in self.onlyPmacs:
+                for addr in addrs:
+                    for (started, value) in history.changes(pmacName, addr):
+                        if value is None:
+                            value = '-'
+                        print '%-24s %-12s %s %s' % (pmacName, addr,
+                            datetime.datetime.fromtimestamp(started).strftime('%Y-%m-%d %H:%M:%S'),
+                            value)
+        history.close()
+    def queryFiles(self):
+        '''Returns the snapshot files to be searched by a query.'''
+        paths = self.queryPaths
+        if len(paths) == 0 and self.backupDir is not None:
+            paths = [self.backupDir]
+        result = []
+        for path in paths:
+            if os.path.isdir(path):
+                for fileName in sorted(os.listdir(path)):
+                    if re.search(r'\.pmc(\.gz|\.xz)?$', fileName) and \
+                            not re.search(r'\.delta\.pmc', fileName):
+                        result.append(os.path.abspath(os.path.join(path, fileName)))
+            else:
+                result.append(os.path.abspath(path))
+        return result
+    def query(self):
+        '''Runs the query against the latest state of each pmac in the history
+           database and each snapshot file, indexing new or changed files first.'''
+        query = PmacQuery(self.queryText)
+        sources = []
+        if self.historyFile is not None:
+            history = PmacHistory(self.historyFile)
+            for pmacName in history.pmacNames():
+                if self.onlyPmacs is None or pmacName in self.onlyPmacs:
+                    sources.append((pmacName, history.state(pmacName)))
+            history.close()
+        fileNames = self.queryFiles()
+        if len(fileNames) > 0:
+            indexFile = self.queryIndexFile
+            if indexFile is None:
+                if not os.path.isdir(self.resultsDir):
+                    os.makedirs(self.resultsDir)
+                indexFile = os.path.join(self.resultsDir, 'query_index.db')
+            index = PmacHistory(indexFile)
+            todo = []
+            for fileName in fileNames:
+                info = os.stat(fileName)
+                if index.fileRun(fileName, info.st_mtime, info.st_size) is None:
+                    todo.append((fileName, info.st_mtime, info.st_size))
+            if len(todo) > 0:
+                print >> sys.stderr, 'Indexing %s of %s snapshot files' % (len(todo), len(fileNames))
+            if len(todo) > 1:
+                pool = multiprocessing.Pool(min(len(todo), multiprocessing.cpu_count()))
+                try:
+                    results = pool.map(historyFileValues, [f for (f, mtime, size) in todo], 1)
+                    pool.close()
+                except:
+                    pool.terminate()
+                    raise
+                finally:
+                    pool.join()
+            else:
+                results = [historyFileValues(f) for (f, mtime, size) in todo]
+            for (fileName, mtime, size), values in zip(todo, results):
+                if values is not None:
+                    index.storeFile(fileName, mtime, size, values)
+            for fileName in fileNames:
+                if index.fileRun(fileName, os.stat(fileName).st_mtime,
+                        os.stat(fileName).st_size) is not None:
+                    sources.append((fileName, index.state(fileName)))
+            index.close()
+        rows = []
+        for (source, values) in sources:
+            for (addr, value) in query.run(values):
+                rows.append((source, addr, value))
+        if self.queryFormat == 'json':
+            print json.dumps([{'source': source, 'addr': addr, 'value': value}
+                for (source, addr, value) in rows], indent=1, sort_keys=True)
+        else:
+            for (source, addr, value) in rows:
+                print '%-24s %-12s %s' % (source, addr, value)
     def analyse(self):
         '''Performs the analysis of the PMACs.'''
+        if self.quickCheck and self.readSpecs is not None:
+            raise ConfigError('A quick check cannot be limited by read specifications')
+        if self.watchInterval is not None and (self.quickCheck or self.replayDir is not None):
+            raise ConfigError('A quick check or replay cannot be watched')
+        if self.pollSpecs is not None and numpy is None:
+            raise ConfigError('Polling requires numpy')
+        if self.pollSpecs is not None and (self.quickCheck or self.replayDir is not None or
+                self.watchInterval is not None):
+            raise ConfigError('A quick check, replay or watch cannot be polled')
+        self.startTime = time.time()
         # Load the factory settings
         factorySettingsFilename = os.path.join(os.path.dirname(__file__),
             'factorySettings_pmac.pmc')
@@ -493,6 +966,7 @@ class GlobalConfig(object):
             'factorySettings_geobrick.pmc')
         self.loadFactorySettings(self.geobrickFactorySettings,
             factorySettingsFilename, self.includePaths)
+        self.factorySettingsTime = time.time() - self.startTime
         # Make sure the results directory exists
         if self.writeAnalysis == True:
             if not os.path.exists(self.resultsDir):
@@ -507,6 +981,51 @@ class GlobalConfig(object):
             elif not os.path.isdir(self.backupDir):
                 raise ConfigError('Backup path exists but is not a directory: %s' %\
                     self.backupDir)
+        # Make sure the trace directory exists if it is required
+        if self.recordDir is not None:
+            if not os.path.exists(self.recordDir):
+                os.makedirs(self.recordDir)
+            elif not os.path.isdir(self.recordDir):
+                raise ConfigError('Record path exists but is not a directory: %s' %\
+                    self.recordDir)
+        # Make sure the backup store exists if it is required
+        backupStore = None
+        if self.backupStoreDir is not None:
+            if not os.path.exists(self.backupStoreDir):
+                os.makedirs(self.backupStoreDir)
+            elif not os.path.isdir(self.backupStoreDir):
+                raise ConfigError('Backup store path exists but is not a directory: %s' %\
+                    self.backupStoreDir)
+            backupStore = PmacBackupStore(self.backupStoreDir)
+        # A readout limited to some variables or sections is not a backup
+        backupDir = self.backupDir
+        if self.readSpecs is not None or self.sections is not None:
+            backupDir = None
+            backupStore = None
+        # Recorded traces must hold, and replayed traces see, the full readout
+        useCaches = self.recordDir is None and self.replayDir is None
+        topologyCache = None
+        if self.topologyCacheFile is not None and useCaches:
+            topologyCache = PmacTopologyCache(self.topologyCacheFile)
+        programCache = None
+        if self.programCacheFile is not None and useCaches:
+            programCache = PmacProgramCache(self.programCacheFile)
+        # Replayed readouts are not history
+        self.history = None
+        if self.historyFile is not None and self.replayDir is None:
+            self.history = PmacHistory(self.historyFile)
+        for name,pmac in self.pmacs.iteritems():
+            pmac.setBackupStore(backupStore)
+            pmac.setTopologyCache(topologyCache)
+            pmac.setProgramCache(programCache)
+            pmac.setDeltaBackupEvery(self.deltaBackupEvery)
+            pmac.setReadSpecs(self.readSpecs)
+            pmac.setSections(self.sections)
+            if self.recordDir is not None:
+                pmac.setRecordFile('%s/%s.trace.gz' % (self.recordDir, name))
+            if self.replayDir is not None:
+                pmac.setReplayFile('%s/%s.trace.gz' % (self.replayDir, name),
+                    self.replayRealTime)
         if self.writeAnalysis is True:
             # Drop a style sheet
             wFile = open('%s/analysis.css' % self.resultsDir, 'w+')
@@ -521,310 +1040,355 @@ class GlobalConfig(object):
 				#code{white-space:pre}
 				#code{font-family:courier}
 				''')
+        if self.pollSpecs is not None:
+            self.poll()
+            return
+        if self.watchInterval is not None:
+            self.watch()
+            return
+        # Read the hardware of all the pmacs at once if required.  Traces are
+        # always replayed one PMAC at a time.
+        readConcurrently = self.concurrent > 0 and self.replayDir is None and \
+            not self.quickCheck
+        if readConcurrently:
+            loop = PmacReadoutLoop(self.concurrent, backupDir, self.checkPositions,
+                self.debug, self.comments, compression=self.backupCompression)
+            failures = loop.run([pmac for name,pmac in self.pmacs.iteritems()
+                if (self.onlyPmacs is None or name in self.onlyPmacs) and pmac.compareWith is None])
+            # Pmacs that failed are not analysed, only reported
+            for name, message in failures.iteritems():
+                self.pmacs[name].readFailure = message
+                self.pmacs[name].compareResult = False
         # Analyse each pmac
         for name,pmac in self.pmacs.iteritems():
-            if self.onlyPmacs is None or name in self.onlyPmacs:
-                # Create the comparison web page
-                page = WebPage('Comparison results for %s (%s)' % (pmac.name, datetime.datetime.today().strftime('%x %X')),
-                    '%s/%s_compare.htm' % (self.resultsDir, pmac.name),
-                    styleSheet='analysis.css')
+            if (self.onlyPmacs is None or name in self.onlyPmacs) and pmac.readFailure is None:
+                # Compare each section as it is read if required
+                quickCheck = None
+                if self.quickCheck and pmac.compareWith is None:
+                    quickCheck = PmacQuickCheck(pmac, self.pmacFactorySettings,
+                        self.geobrickFactorySettings, self.includePaths)
+                    pmac.setQuickCheck(quickCheck)
                 # Read the hardware (or compare with file)
-                if pmac.compareWith is None:
+                if pmac.compareWith is None and readConcurrently:
+                    pass   # Already read
+                elif pmac.compareWith is None:
                     try:
-                        pmac.readHardware(self.backupDir, self.checkPositions, self.debug, self.comments, self.verbose)
+                        pmac.readHardware(backupDir, self.checkPositions, self.debug, self.comments, self.verbose,
+                            self.backupCompression)
                     except PmacReadError as pErr:
-                    	import traceback
-                    	traceback.print_exc()
-                        print "FAILED TO CONNECT TO " + pmac.name
+                        # Reported like a failed concurrent readout
+                        print "FAILED TO READ %s: %s" % (pmac.name, pErr)
+                        pmac.readFailure = str(pErr)
+                        pmac.compareResult = False
+                        continue
                 else:
                     pmac.loadCompareWith()
                 # Load the reference
-                factoryDefs = None
-                if pmac.useFactoryDefs:
-                    if pmac.geobrick:
-                        factoryDefs = self.geobrickFactorySettings
-                    else:
-                        factoryDefs = self.pmacFactorySettings
-                pmac.loadReference(factoryDefs, self.includePaths)
+                if quickCheck is None or not quickCheck.referenceLoaded:
+                    self.loadPmacReference(pmac)
                 # Make the comparison
-                theFixFile = None
+                diff = pmac.compare()
+                self.storeHistory(pmac)
+                if self.quickCheck:
+                    continue   # Only the summary is written
                 if self.fixfile is not None:
                     theFixFile = open(self.fixfile, "w")
-                theUnfixFile = None
+                    diff.writeFixFile(theFixFile)
+                    theFixFile.close()
                 if self.unfixfile is not None:
                     theUnfixFile = open(self.unfixfile, "w")
-                matches = pmac.compare(page, theFixFile, theUnfixFile)
-                if theFixFile is not None:
-                    theFixFile.close()
-                if theUnfixFile is not None:
+                    diff.writeUnfixFile(theUnfixFile)
                     theUnfixFile.close()
-                # Write out the HTML
-                if matches:
-                    # delete any existing comparison file
-                    if os.path.exists('%s/%s_compare.htm' % (self.resultsDir, pmac.name)):
-                        os.remove('%s/%s_compare.htm' % (self.resultsDir, pmac.name))
-                else:
-                    if self.writeAnalysis is True:       
-					    page.write()
+                if self.applyFix and pmac.compareWith is None and not diff.matches():
+                    if self.replayDir is not None:
+                        print 'Fix not applied to %s, it is being replayed' % pmac.name
+                    else:
+                        try:
+                            remaining = pmac.applyFix(diff, self.verbose)
+                            if self.writeAnalysis is True:
+                                remaining.writeJson('%s/%s_applyfix.json' %
+                                    (self.resultsDir, pmac.name))
+                        except PmacReadError, pErr:
+                            print 'FAILED TO APPLY FIX TO %s: %s' % (pmac.name, pErr)
+                # Write out the differences
+                self.writeCompareResults(pmac, diff)
+        if self.quickCheck:
+            if self.writeAnalysis is True:
+                self.htmlQuickCheckPage()
+        elif self.diffOnly or self.readSpecs is not None:
+            pass    # No HTML pages
+        elif self.writeAnalysis is True and self.bundleFormat is not None:
+            # Write the JSON bundle of each pmac and the page that views them
+            for name,pmac in self.pmacs.iteritems():
+                if (self.onlyPmacs is None or name in self.onlyPmacs) and pmac.readFailure is None:
+                    started = time.time()
+                    pmac.writeBundle(self.resultsDir, self.bundleFormat)
+                    pmac.addPhaseTime('render', time.time() - started)
+            wFile = open('%s/viewer.htm' % self.resultsDir, 'w')
+            wFile.write(bundleViewerHtml)
+            wFile.close()
+        elif self.writeAnalysis is True:
+            # Render the pages of each pmac
+            jobs = []
+            for name,pmac in self.pmacs.iteritems():
+                if (self.onlyPmacs is None or name in self.onlyPmacs) and pmac.readFailure is None:
+                    jobs += pmac.htmlPageJobs(self.resultsDir)
+            self.runPageJobs(jobs)
         if self.writeAnalysis is True:
-			# Create the top level page
-			indexPage = WebPage('PMAC analysis (%s)' % datetime.datetime.today().strftime('%x %X'),
-				'%s/index.htm' % self.resultsDir,
-				styleSheet='analysis.css')
-			table = indexPage.table(indexPage.body())
-			for name,pmac in self.pmacs.iteritems():
-				row = indexPage.tableRow(table)
-				indexPage.tableColumn(row, '%s' % pmac.name)
-				if os.path.exists('%s/%s_compare.htm' % (self.resultsDir, pmac.name)):
-					indexPage.href(indexPage.tableColumn(row),
-						'%s_compare.htm' % pmac.name, 'Comparison results')
-				elif os.path.exists('%s/%s_plcs.htm' % (self.resultsDir, pmac.name)):
-					indexPage.tableColumn(row, 'Matches')
-				else:
-					indexPage.tableColumn(row, 'No results')
-				indexPage.href(indexPage.tableColumn(row),
-					'%s_ivariables.htm' % pmac.name, 'I variables')
-				indexPage.href(indexPage.tableColumn(row),
-					'%s_pvariables.htm' % pmac.name, 'P variables')
-				indexPage.href(indexPage.tableColumn(row),
-					'%s_mvariables.htm' % pmac.name, 'M variables')
-				indexPage.href(indexPage.tableColumn(row),
-					'%s_mvariablevalues.htm' % pmac.name, 'M variable values')
-				if pmac.numMacroStationIcs == 0:
-					indexPage.tableColumn(row, '-')
-				elif pmac.numMacroStationIcs is None and \
-						not os.path.exists('%s/%s_msivariables.htm' % (self.resultsDir, pmac.name)):
-					indexPage.tableColumn(row, '-')
-				else:
-					indexPage.href(indexPage.tableColumn(row),
-						'%s_msivariables.htm' % pmac.name, 'MS variables')
-				indexPage.href(indexPage.tableColumn(row),
-					'%s_coordsystems.htm' % pmac.name, 'Coordinate systems')
-				indexPage.href(indexPage.tableColumn(row),
-					'%s_plcs.htm' % pmac.name, 'PLCs')
-				indexPage.href(indexPage.tableColumn(row),
-					'%s_motionprogs.htm' % pmac.name, 'Motion programs')
-			indexPage.write()
-			# Dump the I variables for each pmac
-			for name,pmac in self.pmacs.iteritems():
-				if self.onlyPmacs is None or name in self.onlyPmacs:
-					# Create the I variables top level web page
-					page = WebPage('I Variables for %s (%s)' % (pmac.name, datetime.datetime.today().strftime('%x %X')),
-						'%s/%s_ivariables.htm' % (self.resultsDir, pmac.name),
-						styleSheet='analysis.css')
-					page.href(page.body(), '%s_ivars_glob.htm' % pmac.name, 'Global I variables')
-					page.lineBreak(page.body())
-					for motor in range(1, pmac.numAxes+1):
-						page.href(page.body(), '%s_ivars_motor%s.htm' % (pmac.name, motor),
-							'Motor %s I variables' % motor)
-						page.lineBreak(page.body())
-					page.write()
-					# Create the global I variables page
-					page = WebPage('Global I Variables for %s' % pmac.name,
-						'%s/%s_ivars_glob.htm' % (self.resultsDir, pmac.name),
-						styleSheet='analysis.css')
-					pmac.htmlGlobalIVariables(page)
-					page.write()
-					# Create each I variables page
-					for motor in range(1, pmac.numAxes+1):
-						page = WebPage('Motor %s I Variables for %s' % (motor, pmac.name),
-							'%s/%s_ivars_motor%s.htm' % (self.resultsDir, pmac.name, motor),
-							styleSheet='analysis.css')
-						pmac.htmlMotorIVariables(motor, page)
-						page.write()
-			# Dump the macrostation I variables for each pmac
-			for name,pmac in self.pmacs.iteritems():
-				if self.onlyPmacs is None or name in self.onlyPmacs:
-					if pmac.numMacroStationIcs > 0:
-						# Create the MS,I variables top level web page
-						page = WebPage('Macrostation I Variables for %s (%s)' % (pmac.name, datetime.datetime.today().strftime('%x %X')),
-							'%s/%s_msivariables.htm' % (self.resultsDir, pmac.name),
-							styleSheet='analysis.css')
-						page.href(page.body(), '%s_msivars_glob.htm' % pmac.name, 'Global macrostation I variables')
-						page.lineBreak(page.body())
-						for motor in range(1, pmac.numAxes+1):
-							page.href(page.body(), '%s_msivars_motor%s.htm' % (pmac.name, motor),
-								'Motor %s macrostation I variables' % motor)
-							page.lineBreak(page.body())
-						page.write()
-						# Create the global macrostation I variables page
-						page = WebPage('Global Macrostation I Variables for %s' % pmac.name,
-							'%s/%s_msivars_glob.htm' % (self.resultsDir, pmac.name),
-							styleSheet='analysis.css')
-						pmac.htmlGlobalMsIVariables(page)
-						page.write()
-						# Create each motor macrostation I variables page
-						for motor in range(1, pmac.numAxes+1):
-							page = WebPage('Motor %s Macrostation I Variables for %s' % (motor, pmac.name),
-								'%s/%s_msivars_motor%s.htm' % (self.resultsDir, pmac.name, motor),
-								styleSheet='analysis.css')
-							pmac.htmlMotorMsIVariables(motor, page)
-							page.write()
-			# Dump the M variables for each pmac
-			for name,pmac in self.pmacs.iteritems():
-				if self.onlyPmacs is None or name in self.onlyPmacs:
-					page = WebPage('M Variables for %s (%s)' % (pmac.name, datetime.datetime.today().strftime('%x %X')),
-						'%s/%s_mvariables.htm' % (self.resultsDir, pmac.name),
-						styleSheet='analysis.css')
-					table = page.table(page.body(), ['','0','1','2','3','4','5','6','7','8','9'])
-					row = None
-					for m in range(8192):
-						if m % 10 == 0:
-							row = page.tableRow(table)
-							page.tableColumn(row, 'm%s->' % m)
-						var = pmac.hardwareState.getMVariable(m)
-						page.tableColumn(row, var.valStr())
-					for i in range(8):
-						page.tableColumn(row, '')
-					page.write()
-			# Dump the M variable values for each pmac
-			for name,pmac in self.pmacs.iteritems():
-				if self.onlyPmacs is None or name in self.onlyPmacs:
-					page = WebPage('M Variable values for %s (%s)' % (pmac.name, datetime.datetime.today().strftime('%x %X')),
-						'%s/%s_mvariablevalues.htm' % (self.resultsDir, pmac.name),
-						styleSheet='analysis.css')
-					table = page.table(page.body(), ['','0','1','2','3','4','5','6','7','8','9'])
-					row = None
-					for m in range(8192):
-						if m % 10 == 0:
-							row = page.tableRow(table)
-							page.tableColumn(row, 'm%s' % m)
-						var = pmac.hardwareState.getMVariable(m)
-						page.tableColumn(row, var.contentsStr())
-					for i in range(8):
-						page.tableColumn(row, '')
-					page.write()
-			# Dump the P variables for each pmac
-			for name,pmac in self.pmacs.iteritems():
-				if self.onlyPmacs is None or name in self.onlyPmacs:
-					page = WebPage('P Variables for %s (%s)' % (pmac.name, datetime.datetime.today().strftime('%x %X')),
-						'%s/%s_pvariables.htm' % (self.resultsDir, pmac.name),
-						styleSheet='analysis.css')
-					table = page.table(page.body(), ['','0','1','2','3','4','5','6','7','8','9'])
-					row = None
-					for m in range(8192):
-						if m % 10 == 0:
-							row = page.tableRow(table)
-							page.tableColumn(row, 'p%s' % m)
-						var = pmac.hardwareState.getPVariable(m)
-						page.tableColumn(row, var.valStr())
-					for i in range(8):
-						page.tableColumn(row, '')
-					page.write()
-			# Dump the PLCs for each pmac
-			for name,pmac in self.pmacs.iteritems():
-				if self.onlyPmacs is None or name in self.onlyPmacs:
-					# Create the PLC top level web page
-					page = WebPage('PLCs for %s (%s)' % (pmac.name, datetime.datetime.today().strftime('%x %X')),
-						'%s/%s_plcs.htm' % (self.resultsDir, pmac.name),
-						styleSheet='analysis.css')
-					table = page.table(page.body(),
-						['PLC', 'Code', 'P Variables'])
-					for id in range(32):
-						plc = pmac.hardwareState.getPlcProgramNoCreate(id)
-						row = page.tableRow(table)
-						page.tableColumn(row, '%s' % id)
-						if plc is not None:
-							page.href(page.tableColumn(row), '%s_plc_%s.htm' % (pmac.name, id), 'Code')
-						else:
-							page.tableColumn(row, '-')
-						page.href(page.tableColumn(row), '%s_plc%s_p.htm' % (pmac.name, id),
-							'P%d..%d' % (id*100, id*100+99))
-					page.write()
-					# Create the listing pages
-					for id in range(32):
-						plc = pmac.hardwareState.getPlcProgramNoCreate(id)
-						if plc is not None:
-							page = WebPage('%s PLC%s' % (pmac.name, id),
-								'%s/%s_plc_%s.htm' % (self.resultsDir, pmac.name, id),
-								styleSheet='analysis.css')
-							plc.html2(page, page.body())
-							page.write()
-					# Create the P variable pages
-					for id in range(32):
-						page = WebPage('P Variables for %s PLC %s' % (pmac.name, id),
-							'%s/%s_plc%s_p.htm' % (self.resultsDir, pmac.name, id),
-							styleSheet='analysis.css')
-						table = page.table(page.body(), ['','0','1','2','3','4','5','6','7','8','9'])
-						row = None
-						for m in range(100):
-							if m % 10 == 0:
-								row = page.tableRow(table)
-								page.tableColumn(row, 'p%s' % (m+id*100))
-							var = pmac.hardwareState.getPVariable(m+id*100)
-							page.tableColumn(row, var.valStr())
-						page.write()
-			# Dump the motion programs for each pmac
-			for name,pmac in self.pmacs.iteritems():
-				if self.onlyPmacs is None or name in self.onlyPmacs:
-					# Create the motion program top level web page
-					page = WebPage('Motion Programs for %s (%s)' % (pmac.name, datetime.datetime.today().strftime('%x %X')),
-						'%s/%s_motionprogs.htm' % (self.resultsDir, pmac.name),
-						styleSheet='analysis.css')
-					table = page.table(page.body())
-					for id in range(256):
-						prog = pmac.hardwareState.getMotionProgramNoCreate(id)
-						if prog is not None:
-							row = page.tableRow(table)
-							page.tableColumn(row, 'prog%s' % id)
-							page.href(page.tableColumn(row), '%s_prog_%s.htm' % (pmac.name, id), 'Code')
-					page.write()
-					# Create the listing pages
-					for id in range(256):
-						prog = pmac.hardwareState.getMotionProgramNoCreate(id)
-						if prog is not None:
-							page = WebPage('Motion Program %s for %s' % (id, pmac.name),
-								'%s/%s_prog_%s.htm' % (self.resultsDir, pmac.name, id),
-								styleSheet='analysis.css')
-							prog.html2(page, page.body())
-							page.write()
-			# Dump the coordinate systems for each pmac
-			for name,pmac in self.pmacs.iteritems():
-				if self.onlyPmacs is None or name in self.onlyPmacs:
-					# Create the coordinate systems top level web page
-					page = WebPage('Coordinate Systems for %s (%s)' % (pmac.name, datetime.datetime.today().strftime('%x %X')),
-						'%s/%s_coordsystems.htm' % (self.resultsDir, pmac.name),
-						styleSheet='analysis.css')
-					table = page.table(page.body(),
-						['CS', 'Axis def', 'Forward Kinematic', 'Inverse Kinematic', 'Q Variables', '%'])
-					for id in range(1, 17):
-						row = page.tableRow(table)
-						page.tableColumn(row, '%s' % id)
-						col = page.tableColumn(row)
-						for m in range(1,33):
-							var = pmac.hardwareState.getCsAxisDefNoCreate(id, m)
-							if var is not None and not var.isZero():
-								page.text(col, '#%s->' % m)
-								var.html(page, col)
-						col = page.tableColumn(row)
-						var = pmac.hardwareState.getForwardKinematicProgramNoCreate(id)
-						if var is not None:
-							var.html(page, col)
-						col = page.tableColumn(row)
-						var = pmac.hardwareState.getInverseKinematicProgramNoCreate(id)
-						if var is not None:
-							var.html(page, col)
-						page.href(page.tableColumn(row), '%s_cs%s_q.htm' % (pmac.name, id),
-							'Q Variables')
-						col = page.tableColumn(row)
-						var = pmac.hardwareState.getFeedrateOverrideNoCreate(id)
-						if var is not None:
-							var.html(page, col)
-					page.write()
-					for id in range(1,17):
-						page = WebPage('Q Variables for %s CS %s' % (pmac.name, id),
-							'%s/%s_cs%s_q.htm' % (self.resultsDir, pmac.name, id),
-							styleSheet='analysis.css')
-						table = page.table(page.body(), ['','0','1','2','3','4','5','6','7','8','9'])
-						row = None
-						for m in range(100):
-							if m % 10 == 0:
-								row = page.tableRow(table)
-								page.tableColumn(row, 'q%s' % m)
-							var = pmac.hardwareState.getQVariable(id, m)
-							page.tableColumn(row, var.valStr())
-						page.write()
-			self.hudsonXmlReport()
+            # Create the top level page
+            if not self.diffOnly and not self.quickCheck and self.readSpecs is None:
+                self.htmlIndexPage()
+            self.hudsonXmlReport()
+            self.timingReport()
+        self.readoutStatsReport()
+    def loadPmacReference(self, pmac):
+        '''Loads the reference of the pmac on top of the factory settings of
+           its type, if they are used.'''
+        factoryDefs = None
+        if pmac.useFactoryDefs:
+            if pmac.geobrick:
+                factoryDefs = self.geobrickFactorySettings
+            else:
+                factoryDefs = self.pmacFactorySettings
+        pmac.loadReference(factoryDefs, self.includePaths)
+    def storeHistory(self, pmac):
+        '''Stores the hardware state of the pmac in the history database if it
+           has been completely read.'''
+        if self.history is not None and pmac.compareWith is None and pmac.readoutComplete:
+            started = time.time()
+            run = self.history.store(pmac.name, pmac.stats.started, pmac.hardwareState)
+            print 'Stored %s as run %s of %s in %.2fs' % (pmac.name, run, self.historyFile,
+                time.time() - started)
+    def writeCompareResults(self, pmac, diff):
+        '''Writes the differences of the pmac to the results directory.'''
+        compareFileName = '%s/%s_compare.htm' % (self.resultsDir, pmac.name)
+        if self.writeAnalysis is True:
+            diff.writeJson('%s/%s_compare.json' % (self.resultsDir, pmac.name))
+        if diff.matches() or self.diffOnly:
+            # delete any existing comparison file
+            if os.path.exists(compareFileName):
+                os.remove(compareFileName)
+        elif self.writeAnalysis is True:
+            started = time.time()
+            page = WebPage('Comparison results for %s (%s)' % (pmac.name, datetime.datetime.today().strftime('%x %X')),
+                compareFileName, styleSheet='analysis.css')
+            diff.html(page)
+            page.write()
+            pmac.addPhaseTime('render', time.time() - started)
+    def watch(self):
+        '''Monitors the pmacs until interrupted, reading each one again every
+           watch interval over a connection that is kept open.  The results
+           are only written when the differences of a pmac change.'''
+        pmacs = [pmac for name,pmac in self.pmacs.iteritems()
+            if (self.onlyPmacs is None or name in self.onlyPmacs) and pmac.compareWith is None]
+        lastResults = {}
+        try:
+            while True:
+                # The report covers the current cycle
+                self.startTime = time.time()
+                changed = False
+                for pmac in pmacs:
+                    try:
+                        pmac.watchReadout(self.checkPositions, self.debug, self.comments,
+                            self.verbose)
+                    except PmacReadError, pErr:
+                        print 'FAILED TO READ %s: %s' % (pmac.name, pErr)
+                        continue
+                    if not pmac.referenceLoaded:
+                        self.loadPmacReference(pmac)
+                        pmac.referenceLoaded = True
+                    diff = pmac.compare()
+                    self.storeHistory(pmac)
+                    result = json.dumps(diff.toDict(), sort_keys=True)
+                    if result != lastResults.get(pmac.name):
+                        print '%s: %s differences (%s)' % (pmac.name,
+                            len(diff.differences), datetime.datetime.today().strftime('%x %X'))
+                        lastResults[pmac.name] = result
+                        self.writeCompareResults(pmac, diff)
+                        changed = True
+                if changed and self.writeAnalysis is True:
+                    self.hudsonXmlReport()
+                time.sleep(max(0.0, self.watchInterval - (time.time() - self.startTime)))
+        except KeyboardInterrupt:
+            print 'Watch stopped'
+        finally:
+            for pmac in pmacs:
+                pmac.disconnect()
+    def poll(self):
+        '''Samples the poll variables of the pmacs at the poll rate until
+           interrupted, writing the poll files every flush interval.'''
+        pmacs = [pmac for name,pmac in self.pmacs.iteritems()
+            if (self.onlyPmacs is None or name in self.onlyPmacs) and pmac.compareWith is None]
+        buffers = {}
+        try:
+            for pmac in pmacs:
+                buffers[pmac.name] = pmac.beginPolling(self.pollSpecs, self.pollBufferSize,
+                    self.debug, self.verbose)
+            period = 1.0 / self.pollRate
+            nextSample = time.time()
+            nextFlush = nextSample + self.pollFlushInterval
+            failing = set()
+            while True:
+                for pmac in pmacs:
+                    try:
+                        values = pmac.pollSample(self.verbose)
+                        failing.discard(pmac.name)
+                    except PmacReadError, pErr:
+                        # Only the first of a run of failures is reported
+                        if pmac.name not in failing:
+                            print 'FAILED TO POLL %s: %s' % (pmac.name, pErr)
+                            failing.add(pmac.name)
+                        values = None
+                    buffers[pmac.name].add(time.time(), values)
+                now = time.time()
+                if now >= nextFlush:
+                    self.flushPollBuffers(buffers)
+                    nextFlush = now + self.pollFlushInterval
+                nextSample += period
+                if nextSample < now:
+                    # Overrun, carry on from now rather than catching up
+                    nextSample = now
+                else:
+                    time.sleep(nextSample - now)
+        except KeyboardInterrupt:
+            print 'Polling stopped'
+        finally:
+            self.flushPollBuffers(buffers)
+            for pmac in pmacs:
+                pmac.disconnect()
+                if pmac.stats is not None:
+                    pmac.endReadout()
+    def flushPollBuffers(self, buffers):
+        '''Appends the new samples of each poll buffer to its data file and
+           writes its statistics file.'''
+        for name, buffer in buffers.iteritems():
+            wFile = open('%s/%s_poll.dat' % (self.resultsDir, name), 'ab')
+            buffer.flush(wFile)
+            wFile.close()
+            tempFileName = '%s/%s_poll.json.tmp%s' % (self.resultsDir, name, os.getpid())
+            wFile = open(tempFileName, 'w')
+            json.dump(dict(buffer.toDict(), pmac=name, rate=self.pollRate), wFile,
+                indent=1, sort_keys=True)
+            wFile.close()
+            os.rename(tempFileName, '%s/%s_poll.json' % (self.resultsDir, name))
+    def runPageJobs(self, jobs):
+        '''Renders the web pages of the jobs, on a pool of processes if required.
+           Jobs whose inputs have the same hash as recorded in the page manifest
+           by the previous run, and whose pages still exist, are skipped.'''
+        manifestFileName = '%s/page_manifest.json' % self.resultsDir
+        manifest = {}
+        if os.path.exists(manifestFileName):
+            try:
+                manifest = json.load(open(manifestFileName, 'r'))
+            except ValueError:
+                print 'Ignoring unreadable page manifest %s' % manifestFileName
+        todo = []
+        for job in jobs:
+            key = pageJobKey(job)
+            digest = pageJobHash(job)
+            entry = manifest.get(key)
+            if entry is None or entry['hash'] != digest or \
+                    not all([os.path.exists(f) for f in entry['pages']]):
+                todo.append((key, digest, job))
+        print 'Rendering %s of %s page groups, the rest are unchanged' % (len(todo), len(jobs))
+        if self.renderProcesses > 0 and len(todo) > 1:
+            pool = multiprocessing.Pool(self.renderProcesses)
+            try:
+                results = pool.map(runPageJob, [job for key, digest, job in todo], 1)
+                pool.close()
+            except:
+                pool.terminate()
+                raise
+            finally:
+                pool.join()
+        else:
+            results = [runPageJob(job) for key, digest, job in todo]
+        for (key, digest, job), (pages, elapsed) in zip(todo, results):
+            manifest[key] = {'hash': digest, 'pages': pages}
+            self.pmacs[job[1][1]].addPhaseTime('render', elapsed)
+        tempFileName = '%s.tmp%s' % (manifestFileName, os.getpid())
+        wFile = open(tempFileName, 'w')
+        json.dump(manifest, wFile, indent=1, sort_keys=True)
+        wFile.close()
+        os.rename(tempFileName, manifestFileName)
+    def htmlQuickCheckPage(self):
+        '''Creates the top level page summarising the results of a quick check.'''
+        indexPage = WebPage('PMAC quick check (%s)' % datetime.datetime.today().strftime('%x %X'),
+            '%s/index.htm' % self.resultsDir,
+            styleSheet='analysis.css')
+        table = indexPage.table(indexPage.body(), ['PMAC', 'Result', 'First difference',
+            'Readout stopped after'])
+        for name,pmac in sorted(self.pmacs.iteritems()):
+            if self.onlyPmacs is None or name in self.onlyPmacs:
+                row = indexPage.tableRow(table)
+                indexPage.tableColumn(row, name)
+                if pmac.readFailure is not None:
+                    indexPage.emphasize(indexPage.tableColumn(row), 'Read failed')
+                    indexPage.tableColumn(row, pmac.readFailure)
+                elif pmac.compareResult:
+                    indexPage.tableColumn(row, 'Matches')
+                    indexPage.tableColumn(row, '-')
+                else:
+                    indexPage.emphasize(indexPage.tableColumn(row), 'Mismatch')
+                    d = pmac.compareDiff.differences[0]
+                    indexPage.tableColumn(row, '%s %s' % (d.label(), d.kind))
+                if pmac.quickCheck is None or pmac.quickCheck.failedSection is None:
+                    indexPage.tableColumn(row, '-')
+                else:
+                    indexPage.tableColumn(row, pmac.quickCheck.failedSection)
+        indexPage.write()
+    def htmlIndexPage(self):
+        '''Creates the top level page linking to the pages of each pmac.'''
+        indexPage = WebPage('PMAC analysis (%s)' % datetime.datetime.today().strftime('%x %X'),
+            '%s/index.htm' % self.resultsDir,
+            styleSheet='analysis.css')
+        table = indexPage.table(indexPage.body())
+        for name,pmac in self.pmacs.iteritems():
+            row = indexPage.tableRow(table)
+            indexPage.tableColumn(row, '%s' % pmac.name)
+            if self.bundleFormat is None:
+                resultsFile = '%s_plcs.htm' % pmac.name
+            else:
+                resultsFile = pmac.bundleFileName(self.bundleFormat)
+            if pmac.readFailure is not None:
+                indexPage.emphasize(indexPage.tableColumn(row), 'Read failed')
+                continue
+            elif os.path.exists('%s/%s_compare.htm' % (self.resultsDir, pmac.name)):
+                indexPage.href(indexPage.tableColumn(row),
+                    '%s_compare.htm' % pmac.name, 'Comparison results')
+            elif os.path.exists('%s/%s' % (self.resultsDir, resultsFile)) or \
+                    os.path.exists('%s/%s_compare.json' % (self.resultsDir, pmac.name)):
+                indexPage.tableColumn(row, 'Matches')
+            else:
+                indexPage.tableColumn(row, 'No results')
+            if self.bundleFormat is not None:
+                indexPage.href(indexPage.tableColumn(row),
+                    'viewer.htm?bundle=%s' % resultsFile, 'State')
+                continue
+            pages = pmac.selectedSectionParts(2)
+            def link(job, fileName, text):
+                if pages is None or job in pages:
+                    indexPage.href(indexPage.tableColumn(row), fileName, text)
+                else:
+                    indexPage.tableColumn(row, '-')
+            link('htmlIVariablePages', '%s_ivariables.htm' % pmac.name, 'I variables')
+            link('htmlPVariablePage', '%s_pvariables.htm' % pmac.name, 'P variables')
+            link('htmlMVariablePages', '%s_mvariables.htm' % pmac.name, 'M variables')
+            link('htmlMVariablePages', '%s_mvariablevalues.htm' % pmac.name,
+                'M variable values')
+            if pmac.numMacroStationIcs == 0:
+                indexPage.tableColumn(row, '-')
+            elif pmac.numMacroStationIcs is None and \
+                    not os.path.exists('%s/%s_msivariables.htm' % (self.resultsDir, pmac.name)):
+                indexPage.tableColumn(row, '-')
+            else:
+                link('htmlMsIVariablePages', '%s_msivariables.htm' % pmac.name, 'MS variables')
+            link('htmlCoordSystemPages', '%s_coordsystems.htm' % pmac.name,
+                'Coordinate systems')
+            link('htmlPlcPages', '%s_plcs.htm' % pmac.name, 'PLCs')
+            link('htmlMotionProgramPages', '%s_motionprogs.htm' % pmac.name,
+                'Motion programs')
+        indexPage.write()
     def loadFactorySettings(self, pmac, fileName, includeFiles):
         for i in range(8192):
             pmac.getIVariable(i)
@@ -843,129 +1407,650 @@ class GlobalConfig(object):
         xmlDoc = getDOMImplementation().createDocument(None, "testsuite", None)
         xmlTop = xmlDoc.documentElement
         xmlTop.setAttribute("tests", str(len(self.pmacs)))
-        xmlTop.setAttribute("time", "0")
-        xmlTop.setAttribute("timestamp", "0")
+        xmlTop.setAttribute("time", "%.3f" % (time.time() - self.startTime))
+        xmlTop.setAttribute("timestamp",
+            datetime.datetime.fromtimestamp(int(self.startTime)).isoformat())
+        xmlTop.appendChild(self.xmlProperties(xmlDoc,
+            [('factorySettings', self.factorySettingsTime)]))
         for name,pmac in self.pmacs.iteritems():
             element = xmlDoc.createElement("testcase")
             xmlTop.appendChild(element)
             element.setAttribute("classname", "pmac")
             element.setAttribute("name", name)
-            element.setAttribute("time", "0")
-            if not pmac.compareResult:
+            element.setAttribute("time", "%.3f" % pmac.totalPhaseTime())
+            element.appendChild(self.xmlProperties(xmlDoc, pmac.phaseTimeList()))
+            if pmac.readFailure is not None:
                 errorElement = xmlDoc.createElement("error")
                 element.appendChild(errorElement)
-                errorElement.setAttribute("message", "Compare mismatch")
-                textNode = xmlDoc.createTextNode("See file:///%s/index.htm for details" % self.resultsDir)
+                errorElement.setAttribute("message", "Read failed: %s" % pmac.readFailure)
+            elif not pmac.compareResult:
+                errorElement = xmlDoc.createElement("error")
+                element.appendChild(errorElement)
+                errorElement.setAttribute("message", "Compare mismatch (%s differences)" %
+                    len(pmac.compareDiff.differences))
+                # Watching writes no index page
+                if self.watchInterval is None:
+                    details = 'index.htm'
+                else:
+                    details = '%s_compare.json' % name
+                textNode = xmlDoc.createTextNode("See file:///%s/%s for details" %
+                    (self.resultsDir, details))
                 errorElement.appendChild(textNode)
         wFile = open('%s/report.xml' % self.resultsDir, "w")
         xmlDoc.writexml(wFile, indent="", addindent="  ", newl="\n")
+    def xmlProperties(self, xmlDoc, times):
+        '''Returns a JUnit properties element holding the (name, seconds) times.'''
+        result = xmlDoc.createElement("properties")
+        for name, seconds in times:
+            element = xmlDoc.createElement("property")
+            result.appendChild(element)
+            element.setAttribute("name", "%sTime" % name)
+            element.setAttribute("value", "%.3f" % seconds)
+        return result
+    def timingReport(self):
+        '''Writes the phase timings of each PMAC to report_timings.json in the
+           results directory, alongside report.xml.'''
+        pmacs = {}
+        for name,pmac in self.pmacs.iteritems():
+            pmacs[name] = {'time': pmac.totalPhaseTime(),
+                'phases': dict(pmac.phaseTimeList()),
+                'matches': pmac.compareResult}
+        wFile = open('%s/report_timings.json' % self.resultsDir, 'w')
+        json.dump({'timestamp': datetime.datetime.fromtimestamp(int(self.startTime)).isoformat(),
+            'time': time.time() - self.startTime,
+            'factorySettingsTime': self.factorySettingsTime,
+            'pmacs': pmacs}, wFile, indent=2, sort_keys=True)
+        wFile.close()
+    def readoutStatsReport(self):
+        '''Prints a summary of the hardware readout statistics and writes them
+           to readout_stats.json in the results directory.'''
+        stats = [pmac.stats for name,pmac in sorted(self.pmacs.iteritems())
+            if pmac.stats is not None]
+        if len(stats) == 0:
+            return
+        print 'Readout statistics:'
+        print '  %-20s %9s %9s %10s %10s %7s %10s' % ('PMAC', 'Time(s)', 'Commands',
+            'Bytes out', 'Bytes in', 'Errors', 'Mean(ms)')
+        for s in stats:
+            meanLatency = 0.0
+            if s.commands > 0:
+                meanLatency = s.latencyTotal / s.commands
+            print '  %-20s %9.2f %9d %10d %10d %7d %10.2f' % (s.name, s.elapsed,
+                s.commands, s.bytesOut, s.bytesIn, s.errors, meanLatency * 1000.0)
+            sections = [(s.sections[name]['elapsed'], name) for name in s.sectionOrder]
+            sections.sort(reverse=True)
+            print '    %s' % ', '.join(['%s %.2fs' % (name, elapsed)
+                for elapsed, name in sections[:5]])
+        if self.writeAnalysis is True:
+            wFile = open('%s/readout_stats.json' % self.resultsDir, 'w')
+            json.dump({'timestamp': datetime.datetime.today().isoformat(),
+                'pmacs': [s.toDict() for s in stats]}, wFile, indent=2, sort_keys=True)
+            wFile.close()
+
+# Increment when the rendering of the pages changes so that pages left
+# untouched by an earlier version are regenerated.
+htmlPageVersion = 1
+
+# The files written by WebPage.write during the current page job
+pagesWritten = []
+
+# The pages being built, whose temporary files are removed if building fails
+pagesOpen = []
+
+def discardOpenPages():
+    '''Discards the pages left open by a failure while they were built.'''
+    for page in list(pagesOpen):
+        page.discard()
+
+def runPageJob(job):
+    '''Renders the web pages of a job, a (function, arguments) tuple.  Returns
+       the names of the files written and the time taken.  Used by GlobalConfig
+       to render pages on a process pool.'''
+    (function, args) = job
+    started = time.time()
+    del pagesWritten[:]
+    try:
+        function(*args)
+    except:
+        discardOpenPages()
+        raise
+    return (list(pagesWritten), time.time() - started)
+
+def pageJobKey(job):
+    '''Returns the manifest key of a page job, the PMAC name and function.'''
+    (function, args) = job
+    return '%s:%s' % (args[1], function.__name__)
+
+def pageJobHash(job):
+    '''Returns a hash of everything a page job renders.'''
+    (function, args) = job
+    digest = hashlib.sha1('%s %s' % (htmlPageVersion, function.__name__))
+    for arg in args:
+        if isinstance(arg, PmacState):
+            for addr in sorted(arg.vars.keys()):
+                digest.update(arg.vars[addr].fingerprint())
+                digest.update('\n')
+        else:
+            digest.update(repr(arg))
+    return digest.hexdigest()
+
+def htmlIVariablePages(resultsDir, name, numAxes, geobrick, state):
+    '''Writes the I variable pages of a PMAC.'''
+    # Create the I variables top level web page
+    page = WebPage('I Variables for %s (%s)' % (name, datetime.datetime.today().strftime('%x %X')),
+        '%s/%s_ivariables.htm' % (resultsDir, name),
+        styleSheet='analysis.css')
+    page.href(page.body(), '%s_ivars_glob.htm' % name, 'Global I variables')
+    page.lineBreak(page.body())
+    for motor in range(1, numAxes+1):
+        page.href(page.body(), '%s_ivars_motor%s.htm' % (name, motor),
+            'Motor %s I variables' % motor)
+        page.lineBreak(page.body())
+    page.write()
+    # Create the global I variables page
+    page = WebPage('Global I Variables for %s' % name,
+        '%s/%s_ivars_glob.htm' % (resultsDir, name),
+        styleSheet='analysis.css')
+    state.htmlGlobalIVariables(page)
+    page.write()
+    # Create each I variables page
+    for motor in range(1, numAxes+1):
+        page = WebPage('Motor %s I Variables for %s' % (motor, name),
+            '%s/%s_ivars_motor%s.htm' % (resultsDir, name, motor),
+            styleSheet='analysis.css')
+        state.htmlMotorIVariables(motor, page, geobrick)
+        page.write()
+
+def htmlMsIVariablePages(resultsDir, name, numAxes, state):
+    '''Writes the macrostation I variable pages of a PMAC.'''
+    # Create the MS,I variables top level web page
+    page = WebPage('Macrostation I Variables for %s (%s)' % (name, datetime.datetime.today().strftime('%x %X')),
+        '%s/%s_msivariables.htm' % (resultsDir, name),
+        styleSheet='analysis.css')
+    page.href(page.body(), '%s_msivars_glob.htm' % name, 'Global macrostation I variables')
+    page.lineBreak(page.body())
+    for motor in range(1, numAxes+1):
+        page.href(page.body(), '%s_msivars_motor%s.htm' % (name, motor),
+            'Motor %s macrostation I variables' % motor)
+        page.lineBreak(page.body())
+    page.write()
+    # Create the global macrostation I variables page
+    page = WebPage('Global Macrostation I Variables for %s' % name,
+        '%s/%s_msivars_glob.htm' % (resultsDir, name),
+        styleSheet='analysis.css')
+    state.htmlGlobalMsIVariables(page)
+    page.write()
+    # Create each motor macrostation I variables page
+    for motor in range(1, numAxes+1):
+        page = WebPage('Motor %s Macrostation I Variables for %s' % (motor, name),
+            '%s/%s_msivars_motor%s.htm' % (resultsDir, name, motor),
+            styleSheet='analysis.css')
+        state.htmlMotorMsIVariables(motor, page)
+        page.write()
+
+def htmlMVariablePages(resultsDir, name, state):
+    '''Writes the M variable definition and value pages of a PMAC.'''
+    page = WebPage('M Variables for %s (%s)' % (name, datetime.datetime.today().strftime('%x %X')),
+        '%s/%s_mvariables.htm' % (resultsDir, name),
+        styleSheet='analysis.css')
+    table = page.table(page.body(), ['','0','1','2','3','4','5','6','7','8','9'])
+    row = None
+    for m in range(8192):
+        if m % 10 == 0:
+            row = page.tableRow(table)
+            page.tableColumn(row, 'm%s->' % m)
+        var = state.getMVariable(m)
+        page.tableColumn(row, var.valStr())
+    for i in range(8):
+        page.tableColumn(row, '')
+    page.write()
+    page = WebPage('M Variable values for %s (%s)' % (name, datetime.datetime.today().strftime('%x %X')),
+        '%s/%s_mvariablevalues.htm' % (resultsDir, name),
+        styleSheet='analysis.css')
+    table = page.table(page.body(), ['','0','1','2','3','4','5','6','7','8','9'])
+    row = None
+    for m in range(8192):
+        if m % 10 == 0:
+            row = page.tableRow(table)
+            page.tableColumn(row, 'm%s' % m)
+        var = state.getMVariable(m)
+        page.tableColumn(row, var.contentsStr())
+    for i in range(8):
+        page.tableColumn(row, '')
+    page.write()
+
+def htmlPVariablePage(resultsDir, name, state):
+    '''Writes the P variable page of a PMAC.'''
+    page = WebPage('P Variables for %s (%s)' % (name, datetime.datetime.today().strftime('%x %X')),
+        '%s/%s_pvariables.htm' % (resultsDir, name),
+        styleSheet='analysis.css')
+    table = page.table(page.body(), ['','0','1','2','3','4','5','6','7','8','9'])
+    row = None
+    for m in range(8192):
+        if m % 10 == 0:
+            row = page.tableRow(table)
+            page.tableColumn(row, 'p%s' % m)
+        var = state.getPVariable(m)
+        page.tableColumn(row, var.valStr())
+    for i in range(8):
+        page.tableColumn(row, '')
+    page.write()
+
+def htmlPlcPages(resultsDir, name, state):
+    '''Writes the PLC pages of a PMAC.'''
+    # Create the PLC top level web page
+    page = WebPage('PLCs for %s (%s)' % (name, datetime.datetime.today().strftime('%x %X')),
+        '%s/%s_plcs.htm' % (resultsDir, name),
+        styleSheet='analysis.css')
+    table = page.table(page.body(),
+        ['PLC', 'Code', 'P Variables'])
+    for id in range(32):
+        plc = state.getPlcProgramNoCreate(id)
+        row = page.tableRow(table)
+        page.tableColumn(row, '%s' % id)
+        if plc is not None:
+            page.href(page.tableColumn(row), '%s_plc_%s.htm' % (name, id), 'Code')
+        else:
+            page.tableColumn(row, '-')
+        page.href(page.tableColumn(row), '%s_plc%s_p.htm' % (name, id),
+            'P%d..%d' % (id*100, id*100+99))
+    page.write()
+    # Create the listing pages
+    for id in range(32):
+        plc = state.getPlcProgramNoCreate(id)
+        if plc is not None:
+            page = WebPage('%s PLC%s' % (name, id),
+                '%s/%s_plc_%s.htm' % (resultsDir, name, id),
+                styleSheet='analysis.css')
+            plc.html2(page, page.body())
+            page.write()
+    # Create the P variable pages
+    for id in range(32):
+        page = WebPage('P Variables for %s PLC %s' % (name, id),
+            '%s/%s_plc%s_p.htm' % (resultsDir, name, id),
+            styleSheet='analysis.css')
+        table = page.table(page.body(), ['','0','1','2','3','4','5','6','7','8','9'])
+        row = None
+        for m in range(100):
+            if m % 10 == 0:
+                row = page.tableRow(table)
+                page.tableColumn(row, 'p%s' % (m+id*100))
+            var = state.getPVariable(m+id*100)
+            page.tableColumn(row, var.valStr())
+        page.write()
+
+def htmlMotionProgramPages(resultsDir, name, state):
+    '''Writes the motion program pages of a PMAC.'''
+    # Create the motion program top level web page
+    page = WebPage('Motion Programs for %s (%s)' % (name, datetime.datetime.today().strftime('%x %X')),
+        '%s/%s_motionprogs.htm' % (resultsDir, name),
+        styleSheet='analysis.css')
+    table = page.table(page.body())
+    for id in range(256):
+        prog = state.getMotionProgramNoCreate(id)
+        if prog is not None:
+            row = page.tableRow(table)
+            page.tableColumn(row, 'prog%s' % id)
+            page.href(page.tableColumn(row), '%s_prog_%s.htm' % (name, id), 'Code')
+    page.write()
+    # Create the listing pages
+    for id in range(256):
+        prog = state.getMotionProgramNoCreate(id)
+        if prog is not None:
+            page = WebPage('Motion Program %s for %s' % (id, name),
+                '%s/%s_prog_%s.htm' % (resultsDir, name, id),
+                styleSheet='analysis.css')
+            prog.html2(page, page.body())
+            page.write()
+
+def htmlCoordSystemPages(resultsDir, name, state):
+    '''Writes the coordinate system pages of a PMAC.'''
+    # Create the coordinate systems top level web page
+    page = WebPage('Coordinate Systems for %s (%s)' % (name, datetime.datetime.today().strftime('%x %X')),
+        '%s/%s_coordsystems.htm' % (resultsDir, name),
+        styleSheet='analysis.css')
+    table = page.table(page.body(),
+        ['CS', 'Axis def', 'Forward Kinematic', 'Inverse Kinematic', 'Q Variables', '%'])
+    for id in range(1, 17):
+        row = page.tableRow(table)
+        page.tableColumn(row, '%s' % id)
+        col = page.tableColumn(row)
+        for m in range(1,33):
+            var = state.getCsAxisDefNoCreate(id, m)
+            if var is not None and not var.isZero():
+                page.text(col, '#%s->' % m)
+                var.html(page, col)
+        col = page.tableColumn(row)
+        var = state.getForwardKinematicProgramNoCreate(id)
+        if var is not None:
+            var.html(page, col)
+        col = page.tableColumn(row)
+        var = state.getInverseKinematicProgramNoCreate(id)
+        if var is not None:
+            var.html(page, col)
+        page.href(page.tableColumn(row), '%s_cs%s_q.htm' % (name, id),
+            'Q Variables')
+        col = page.tableColumn(row)
+        var = state.getFeedrateOverrideNoCreate(id)
+        if var is not None:
+            var.html(page, col)
+    page.write()
+    for id in range(1,17):
+        page = WebPage('Q Variables for %s CS %s' % (name, id),
+            '%s/%s_cs%s_q.htm' % (resultsDir, name, id),
+            styleSheet='analysis.css')
+        table = page.table(page.body(), ['','0','1','2','3','4','5','6','7','8','9'])
+        row = None
+        for m in range(100):
+            if m % 10 == 0:
+                row = page.tableRow(table)
+                page.tableColumn(row, 'q%s' % m)
+            var = state.getQVariable(id, m)
+            page.tableColumn(row, var.valStr())
+        page.write()
+
+def bundleTable(id, title, headings, rows):
+    '''Returns a bundle section holding a table.'''
+    return {'id': id, 'title': title, 'headings': headings, 'rows': rows}
+
+def bundleGrid(id, title, prefix, first, count, value):
+    '''Returns a bundle section holding variables in rows of ten.'''
+    rows = []
+    for m in range(first, first+count, 10):
+        row = ['%s%s' % (prefix, m)]
+        for n in range(m, min(m+10, first+count)):
+            row.append(value(n))
+        rows.append(row)
+    return bundleTable(id, title, ['','0','1','2','3','4','5','6','7','8','9'], rows)
+
+def bundleSections(numAxes, geobrick, numMacroStationIcs, state):
+    '''Returns the sections of the JSON bundle of a PMAC, the same tables and
+       listings as the HTML pages.'''
+    sections = []
+    # I variables
+    sections.append(bundleTable('ivars_glob', 'Global I Variables',
+        ['I-Variable', 'Value', 'Description'],
+        [['i%s' % i, state.getIVariable(i).valStr(), PmacState.globalIVariableDescriptions[i]]
+            for i in range(100)]))
+    for motor in range(1, numAxes+1):
+        rows = [['i%s' % (motor*100+n), state.getIVariable(motor*100+n).valStr(),
+            PmacState.motorIVariableDescriptions[n]] for n in range(100)]
+        if geobrick:
+            for n in range(10):
+                i = 7000 + PmacState.axisToMn[motor] + n
+                rows.append(['i%s' % i, state.getIVariable(i).valStr(),
+                    PmacState.motorI7000VariableDescriptions[n]])
+        sections.append(bundleTable('ivars_motor%s' % motor, 'Motor %s I Variables' % motor,
+            ['I-Variable', 'Value', 'Description'], rows))
+    # Macrostation I variables
+    if numMacroStationIcs > 0:
+        rows = []
+        for i,description in PmacState.globalMsIVariableDescriptions.iteritems():
+            for node in [0,16,32,64]:
+                rows.append(['i%s' % i, '%s' % node, state.getMsIVariable(0,i).valStr(),
+                    description])
+        sections.append(bundleTable('msivars_glob', 'Global Macrostation I Variables',
+            ['MS I-Variable', 'Node', 'Value', 'Description'], rows))
+        for motor in range(1, numAxes+1):
+            node = PmacState.axisToNode[motor]
+            sections.append(bundleTable('msivars_motor%s' % motor,
+                'Motor %s Macrostation I Variables' % motor,
+                ['MS I-Variable', 'Value', 'Description'],
+                [['i%s' % i, state.getMsIVariable(node, i).valStr(), description]
+                    for i,description in PmacState.motorMsIVariableDescriptions.iteritems()]))
+    # M and P variables
+    sections.append(bundleGrid('mvariables', 'M Variables', 'm', 0, 8192,
+        lambda m: state.getMVariable(m).valStr()))
+    sections.append(bundleGrid('mvariablevalues', 'M Variable values', 'm', 0, 8192,
+        lambda m: state.getMVariable(m).contentsStr()))
+    sections.append(bundleGrid('pvariables', 'P Variables', 'p', 0, 8192,
+        lambda p: state.getPVariable(p).valStr()))
+    # PLCs
+    for id in range(32):
+        plc = state.getPlcProgramNoCreate(id)
+        if plc is not None:
+            sections.append({'id': 'plc_%s' % id, 'title': 'PLC%s' % id,
+                'code': programListing(plc)})
+    # Motion programs
+    for id in range(256):
+        prog = state.getMotionProgramNoCreate(id)
+        if prog is not None:
+            sections.append({'id': 'prog_%s' % id, 'title': 'Motion Program %s' % id,
+                'code': programListing(prog)})
+    # Coordinate systems
+    rows = []
+    for id in range(1, 17):
+        axes = ''
+        for m in range(1,33):
+            var = state.getCsAxisDefNoCreate(id, m)
+            if var is not None and not var.isZero():
+                axes += '#%s->%s' % (m, programText(var))
+        row = ['%s' % id, axes]
+        for var in [state.getForwardKinematicProgramNoCreate(id),
+                state.getInverseKinematicProgramNoCreate(id)]:
+            if var is None:
+                row.append('')
+            else:
+                row.append(programText(var))
+        var = state.getFeedrateOverrideNoCreate(id)
+        if var is None:
+            row.append('')
+        else:
+            row.append(var.valStr())
+        rows.append(row)
+    sections.append(bundleTable('coordsystems', 'Coordinate Systems',
+        ['CS', 'Axis def', 'Forward Kinematic', 'Inverse Kinematic', '%'], rows))
+    for id in range(1, 17):
+        sections.append(bundleGrid('cs%s_q' % id, 'CS %s Q Variables' % id, 'q', 0, 100,
+            lambda q: state.getQVariable(id, q).valStr()))
+    return sections
+
+def programText(prog):
+    '''Returns the text of a program as shown in a table column.'''
+    return ''.join(['%s\n' % line for line in prog.valueText(typ=1).split()])
+
+def programListing(prog):
+    '''Returns the listing of a program as shown on its web page.'''
+    text = ''
+    for i in range(len(prog.lines)):
+        text += '%s:\t%s\n' % (prog.offsets[i], prog.lines[i])
+    return text
+
+# The static page that displays the JSON bundles in a browser.
+bundleViewerHtml = '''<!DOCTYPE html>
+<html><head><title>PMAC analysis viewer</title>
+<link rel="stylesheet" type="text/css" href="analysis.css"/>
+<style>#menu a{margin-right:8px} td{white-space:pre-line} #code{white-space:pre}</style>
+</head><body><h1 id="title">PMAC analysis viewer</h1>
+<p id="menu"></p><div id="content"></div>
+<script>
+function element(parent, tag, text) {
+    var e = document.createElement(tag);
+    if (text !== undefined) { e.textContent = text; }
+    parent.appendChild(e);
+    return e;
+}
+function show(section) {
+    var content = document.getElementById('content');
+    content.innerHTML = '';
+    element(content, 'h2', section.title);
+    if (section.code !== undefined) {
+        element(content, 'p', section.code).id = 'code';
+        return;
+    }
+    var table = element(content, 'table');
+    var row = element(table, 'tr');
+    section.headings.forEach(function(h) { element(row, 'th', h); });
+    section.rows.forEach(function(r) {
+        var row = element(table, 'tr');
+        r.forEach(function(c) { element(row, 'td', c); });
+    });
+}
+function display(bundle) {
+    document.getElementById('title').textContent =
+        'PMAC analysis of ' + bundle.name + ' (' + bundle.timestamp + ')';
+    var menu = document.getElementById('menu');
+    bundle.sections.forEach(function(section) {
+        var a = element(menu, 'a', section.title);
+        a.href = '#' + section.id;
+        a.onclick = function() { show(section); };
+        if (location.hash == '#' + section.id) { show(section); }
+    });
+}
+var match = location.search.match(/[?&]bundle=([^&]*)/);
+if (match) {
+    var name = decodeURIComponent(match[1]);
+    fetch(name).then(function(response) {
+        if (/\\.gz$/.test(name)) {
+            response = new Response(response.body.pipeThrough(new DecompressionStream('gzip')));
+        }
+        return response.json();
+    }).then(display, function(err) {
+        element(document.getElementById('content'), 'p', 'Could not load ' + name + ': ' + err);
+    });
+}
+</script>
+</body></html>
+'''
+
+class WebElement(object):
+    '''An element of a WebPage that is still being written.'''
+    def __init__(self, tag, parent):
+        self.tag = tag
+        self.parent = parent
+        self.empty = True
+        self.open = True
+
+class WebMarkup(object):
+    '''A fragment of already escaped HTML that can be placed in a table column.'''
+    def __init__(self, html):
+        self.html = html
 
 class WebPage(object):
+    '''An HTML page that is written to a temporary file as it is built.  The
+       elements are created in document order; adding to an element closes
+       any of its children still open, after which they cannot be added to.
+       The file only replaces fileName when write is called.  Pages neither
+       written nor discarded are in pagesOpen.'''
+    bufferSize = 65536
     def __init__(self, title, fileName, styleSheet=None):
         '''Initialises a web page, creating all the necessary header stuff'''
         self.fileName = fileName
-        self.doc = getDOMImplementation().createDocument(None, "html", None)
-        self.topElement = self.doc.documentElement
-        h = self.doc.createElement('head')
-        self.topElement.appendChild(h)
+        self.tempFileName = '%s.tmp%s' % (fileName, os.getpid())
+        self.wFile = open(self.tempFileName, 'w', self.bufferSize)
+        pagesOpen.append(self)
+        self.wFile.write('<?xml version="1.0" ?>')
+        self.stack = []
+        self.topElement = self.element(None, 'html')
+        h = self.element(self.topElement, 'head')
         if styleSheet is not None:
-            l = self.doc.createElement('link')
-            h.appendChild(l)
-            l.setAttribute('rel', 'stylesheet')
-            l.setAttribute('type', 'text/css')
-            l.setAttribute('href', styleSheet)
-        t = self.doc.createElement('title')
-        self.topElement.appendChild(t)
-        t.appendChild(self.doc.createTextNode(str(title)))
-        self.theBody = self.doc.createElement('body')
-        self.topElement.appendChild(self.theBody)
-        h = self.doc.createElement('h1')
-        self.theBody.appendChild(h)
-        h.appendChild(self.doc.createTextNode(str(title)))
+            self.element(h, 'link', {'rel': 'stylesheet', 'type': 'text/css',
+                'href': styleSheet})
+        t = self.element(self.topElement, 'title')
+        self.text(t, title)
+        self.theBody = self.element(self.topElement, 'body')
+        h = self.element(self.theBody, 'h1')
+        self.text(h, title)
+    def escape(self, text):
+        '''Returns the text escaped for HTML.'''
+        return str(text).replace('&', '&amp;').replace('<', '&lt;').\
+            replace('"', '&quot;').replace('>', '&gt;')
+    def select(self, parent):
+        '''Closes any open elements below the parent so that content can
+           be added to it.'''
+        if parent is not None and not parent.open:
+            raise GeneralError('Web page element <%s> already closed' % parent.tag)
+        while len(self.stack) > 0 and self.stack[-1] is not parent:
+            self.close(self.stack.pop())
+        if parent is not None and parent.empty:
+            self.wFile.write('>')
+            parent.empty = False
+    def close(self, element):
+        if element.empty:
+            self.wFile.write('/>')
+        else:
+            self.wFile.write('</%s>' % element.tag)
+        element.open = False
+    def element(self, parent, tag, attributes=None):
+        '''Starts a new element as the last child of the parent.'''
+        self.select(parent)
+        self.wFile.write('<%s' % tag)
+        if attributes is not None:
+            for name in sorted(attributes.keys()):
+                self.wFile.write(' %s="%s"' % (name, self.escape(attributes[name])))
+        result = WebElement(tag, parent)
+        self.stack.append(result)
+        return result
+    def idAttribute(self, id):
+        if id is None:
+            return None
+        return {'id': id}
     def body(self):
         return self.theBody
     def href(self, parent, tag, descr):
         '''Creates a hot link.'''
-        a = self.doc.createElement('a')
-        parent.appendChild(a)
-        a.setAttribute('href', tag)
-        a.appendChild(self.doc.createTextNode(descr))
+        a = self.element(parent, 'a', {'href': tag})
+        self.text(a, descr)
     def lineBreak(self, parent):
         '''Creates a line break.'''
-        parent.appendChild(self.doc.createElement('br'))
+        self.element(parent, 'br')
     def doc_node(self, text, desc):
-        anode = self.doc.createElement('a')
-        anode.setAttribute('class','body_con')
-        anode.setAttribute('title',desc)
-        self.text(anode,text)
-        return anode
+        return WebMarkup('<a class="body_con" title="%s">%s</a>' %
+            (self.escape(desc), self.escape(text)))
     def text(self, parent, t):
         '''Creates text.'''
-        parent.appendChild(self.doc.createTextNode(str(t)))
+        self.select(parent)
+        self.wFile.write(self.escape(t))
     def paragraph(self, parent, text=None, id=None):
         '''Creates a paragraph optionally containing text'''
-        para = self.doc.createElement("p")
-        if id is not None:
-            para.setAttribute('id', id)
+        para = self.element(parent, 'p', self.idAttribute(id))
         if text is not None:
-            para.appendChild(self.doc.createTextNode(str(text)))
-        parent.appendChild(para)
+            self.text(para, text)
         return para
     def write(self):
-        '''Writes out the HTML file.'''
-        wFile = open(self.fileName, "w+")
-        self.doc.writexml(wFile, indent="", addindent="", newl="")
+        '''Finishes the HTML file and moves it into place.'''
+        self.select(None)
+        self.wFile.close()
+        os.rename(self.tempFileName, self.fileName)
+        pagesOpen.remove(self)
+        pagesWritten.append(self.fileName)
+    def discard(self):
+        '''Abandons the HTML file, leaving any existing file in place.'''
+        self.wFile.close()
+        os.remove(self.tempFileName)
+        pagesOpen.remove(self)
     def table(self, parent, colHeadings=None, id=None):
         '''Returns a table with optional column headings.'''
-        table = self.doc.createElement("table")
-        if id is not None:
-            table.setAttribute('id', id)
-        parent.appendChild(table)
+        table = self.element(parent, 'table', self.idAttribute(id))
         if colHeadings is not None:
-            row = self.doc.createElement("tr")
-            if id is not None:
-                row.setAttribute('id', id)
-            table.appendChild(row)
+            row = self.element(table, 'tr', self.idAttribute(id))
             for colHeading in colHeadings:
-                col = self.doc.createElement("th")
-                if id is not None:
-                    col.setAttribute('id', id)
-                row.appendChild(col)
-                col.appendChild(self.doc.createTextNode(str(colHeading)))
+                col = self.element(row, 'th', self.idAttribute(id))
+                self.text(col, colHeading)
         return table
     def tableRow(self, table, columns=None, id=None):
         '''Returns a table row, optionally with columns already created.'''
-        row = self.doc.createElement("tr")
-        if id is not None:
-            row.setAttribute('id', id)
-        table.appendChild(row)
+        row = self.element(table, 'tr', self.idAttribute(id))
         if columns is not None:
             for column in columns:
-                col = self.doc.createElement("td")
-                if id is not None:
-                    col.setAttribute('id', id)
-                row.appendChild(col)
-                col.appendChild(self.doc.createTextNode(str(column)))
+                col = self.element(row, 'td', self.idAttribute(id))
+                self.text(col, column)
         return row
     def tableColumn(self, tableRow, text=None, id=None):
         '''Returns a table column, optionally containing the text.'''
-        col = self.doc.createElement("td")
-        if id is not None:
-            col.setAttribute('id', id)
-        tableRow.appendChild(col)
+        col = self.element(tableRow, 'td', self.idAttribute(id))
         if text is not None:
-            if hasattr(text, "appendChild"):
-                # this is a node
-                col.appendChild(text)
+            if isinstance(text, WebMarkup):
+                self.select(col)
+                self.wFile.write(text.html)
             else:
-                col.appendChild(self.doc.createTextNode(str(text)))
+                self.text(col, text)
         return col
     def emphasize(self, parent, text=None):
         '''Returns an emphasis object, optionally containing the text.'''
-        result = self.doc.createElement('em')
-        parent.appendChild(result)
+        result = self.element(parent, 'em')
         if text is not None:
-            result.appendChild(self.doc.createTextNode(str(text)))
+            self.text(result, text)
         return result
 
 class PmacVariable(object):
@@ -1004,6 +2089,9 @@ class PmacVariable(object):
         return False
     def htmlCompare(self, page, parent, other):
         return self.html(page, parent)
+    def fingerprint(self):
+        '''Returns a string that changes whenever the rendering would.'''
+        return '%s %s' % (self.typeStr, self.valStr())
 
 class PmacIVariable(PmacVariable):
     useHexAxis = [2, 3, 4, 5, 10, 24, 25, 42, 43, 44, 55, 81, 82, 83, 84, 91, 95]
@@ -1086,6 +2174,8 @@ class PmacMVariable(PmacVariable):
         return result
     def contentsStr(self):
         return PmacVariable.valStr(self)
+    def fingerprint(self):
+        return '%s %s %s' % (self.typeStr, self.valStr(), self.contentsStr())
     def set(self, type, address, offset, width, format):
         self.type = type
         self.address = address
@@ -1233,6 +2323,8 @@ class PmacProgram(PmacVariable):
         self.v.append(t)
     def clear(self):
         self.v = []
+    def fingerprint(self):
+        return '%s %s %s %s' % (self.typeStr, self.valueText(), self.lines, self.offsets)
     def valueText(self, typ=0, ignore_ret=False):
         result = ''
         for t in self.v:
@@ -1836,6 +2928,14 @@ class PmacState(object):
         return self.getVar2('&', cs, '#', m)
     def getCsAxisDefNoCreate(self,cs,m):
         return self.getVarNoCreate2('&', cs, '#', m)
+    def slice(self, descr, types):
+        '''Returns a new state sharing the variables of this one that are of
+           the given types.'''
+        result = PmacState(descr)
+        for a,v in self.vars.iteritems():
+            if type(v) in types:
+                result.vars[a] = v
+        return result
     def dump(self):
         result = ''
         for a,v in self.vars.iteritems():
@@ -1879,93 +2979,53 @@ class PmacState(object):
                 ['i%s' % i,
                 '%s' % self.getMsIVariable(node, i).valStr(),
                 '%s' % description])
-    def compare(self, other, noCompare, pmacName, page, fixfile, unfixfile):
-        '''Compares the state of this PMAC with the other.'''
-        result = True
-        table = page.table(page.body(), ["Element", "Reason", "Reference", "Hardware"])
+    def compare(self, other, noCompare, pmacName, addrs=None, checkPlcs=True):
+        '''Compares the state of this PMAC, the hardware, with the other, the
+           reference.  Only the given addresses are compared if addrs is not
+           None.  Returns a PmacCompareResult.'''
+        result = PmacCompareResult(pmacName)
         # Build the list of variable addresses to test
-        addrs = sorted((set(self.vars.keys()) | set(other.vars.keys())) - \
-            set(noCompare.vars.keys()), numericSort)
+        if addrs is None:
+            addrs = set(self.vars.keys()) | set(other.vars.keys())
+        addrs = sorted(set(addrs) - set(noCompare.vars.keys()), numericSort)
         # For each of these addresses, compare the variable
         for a in addrs:
-            texta = a
-            commentargs = {}
-            if texta.endswith("%0"):
-                texta = texta[:-1]
-            if texta.startswith("i") and not texta.startswith("inv"):
-                i = int(texta[1:])
+            desc = None
+            comment = None
+            if a.startswith("i") and not a.startswith("inv"):
+                i = int(a[1:])
                 if i in range(100):
                     desc = PmacState.globalIVariableDescriptions[i]
-                    commentargs["comment"] = desc
+                    comment = desc
                 elif i in range(3300):
                     desc = PmacState.motorIVariableDescriptions[i%100]
-                    commentargs["comment"] = desc
+                    comment = desc
                 elif i in range(7000, 7350):
                     desc = PmacState.motorI7000VariableDescriptions[i%10]
-                    commentargs["comment"] = desc
+                    comment = desc
                 else:
                     desc = "No description available"
-                texta = page.doc_node(a, desc)
             if a not in other.vars:
                 if not self.vars[a].ro and not self.vars[a].isEmpty():
-                    result = False
-                    self.writeHtmlRow(page, table, texta, 'Missing', None, self.vars[a])
-                    if unfixfile is not None:
-                        unfixfile.write(self.vars[a].dump(**commentargs))
+                    result.add(PmacDifference(a, 'Missing', None, self.vars[a], desc, comment))
             elif a not in self.vars:
                 if not other.vars[a].ro and not other.vars[a].isEmpty():
-                    result = False
-                    self.writeHtmlRow(page, table, texta, 'Missing', other.vars[a], None)
-                    if fixfile is not None:
-                        fixfile.write(other.vars[a].dump())
+                    result.add(PmacDifference(a, 'Missing', other.vars[a], None, desc, comment))
             elif not self.vars[a].compare(other.vars[a]):
                 if not other.vars[a].ro and not self.vars[a].ro:
-                    result = False
-                    self.writeHtmlRow(page, table, texta, 'Mismatch', other.vars[a],
-                        self.vars[a])
-                    if fixfile is not None:
-                        fixfile.write(other.vars[a].dump())
-                    if unfixfile is not None:
-                        unfixfile.write(self.vars[a].dump(**commentargs))
+                    result.add(PmacDifference(a, 'Mismatch', other.vars[a], self.vars[a],
+                        desc, comment))
         # Check the running PLCs
         for n in range(32):
             plc = self.getPlcProgramNoCreate(n)
-            if plc is not None:
+            if plc is not None and checkPlcs:
                 plc.setShouldBeRunning()
                 #print "PLC%s, isRunning=%s, shouldBeRunning=%s" % (n, plc.isRunning, plc.shouldBeRunning)
                 if plc.shouldBeRunning and not plc.isRunning:
-                    result = False
-                    self.writeHtmlRow(page, table, 'plc%s'%n, 'Not running', None, None)
-                    if fixfile is not None:
-                        fixfile.write('enable plc %s\n' % n)
-                    if unfixfile is not None:
-                        unfixfile.write('disable plc %s\n' % n)
+                    result.add(PmacDifference('plc%s'%n, 'Not running', None, None))
                 elif not plc.shouldBeRunning and plc.isRunning:
-                    result = False
-                    self.writeHtmlRow(page, table, 'plc%s'%n, 'Running', None, None)
-                    if fixfile is not None:
-                        fixfile.write('disable plc %s\n' % n)
-                    if unfixfile is not None:
-                        unfixfile.write('enable plc %s\n' % n)
-        return result
-    def writeHtmlRow(self, page, parent, addr, reason, referenceVar, hardwareVar):
-        row = page.tableRow(parent)
-        # The address column
-        col = page.tableColumn(row, addr)
-        # The reason column
-        col = page.tableColumn(row, reason)
-        # The reference column
-        col = page.tableColumn(row)
-        if referenceVar is None:
-            page.text(col, '-')
-        else:
-            referenceVar.htmlCompare(page, col, hardwareVar)
-        # The hardware column
-        col = page.tableColumn(row)
-        if hardwareVar is None:
-            page.text(col, '-')
-        else:
-            hardwareVar.htmlCompare(page, col, referenceVar)
+                    result.add(PmacDifference('plc%s'%n, 'Running', None, None))
+        return result
     def loadPmcFile(self, fileName):
         '''Loads a PMC file into this PMAC state.'''
         file = open(fileName, 'r')
@@ -1987,8 +3047,1405 @@ class PmacState(object):
         parser = PmacParser(p.output, self)
         parser.onLine()
 
+class PmacDifference(object):
+    '''A difference between the hardware and reference states of a PMAC.  The
+       kind is one of 'Missing', 'Mismatch', 'Running', 'Not running' or, for
+       a fix that could not be read back, 'Unverified'.  Either variable may
+       be None.  The description is the tooltip shown for I
+       variables and the comment is written into the unfix file.'''
+    def __init__(self, addr, kind, referenceVar, hardwareVar, description=None, comment=None):
+        self.addr = addr
+        self.kind = kind
+        self.referenceVar = referenceVar
+        self.hardwareVar = hardwareVar
+        self.description = description
+        self.comment = comment
+    def label(self):
+        '''Returns the address as displayed.'''
+        if self.addr.endswith('%0'):
+            return self.addr[:-1]
+        return self.addr
+    def valueText(self, var):
+        '''Returns the value of one of the variables as text.'''
+        if var is None:
+            result = None
+        elif isinstance(var, PmacProgram):
+            result = var.valueText()
+        else:
+            result = var.valStr()
+        return result
+    def fixText(self):
+        '''Returns the text that makes the hardware match the reference.'''
+        result = None
+        if self.kind == 'Not running':
+            result = 'enable plc %s\n' % self.addr[3:]
+        elif self.kind == 'Running':
+            result = 'disable plc %s\n' % self.addr[3:]
+        elif self.referenceVar is not None:
+            result = self.referenceVar.dump()
+        return result
+    def unfixText(self):
+        '''Returns the text that makes the reference match the hardware.'''
+        result = None
+        if self.kind == 'Not running':
+            result = 'disable plc %s\n' % self.addr[3:]
+        elif self.kind == 'Running':
+            result = 'enable plc %s\n' % self.addr[3:]
+        elif self.hardwareVar is not None and self.comment is not None:
+            result = self.hardwareVar.dump(comment=self.comment)
+        elif self.hardwareVar is not None:
+            result = self.hardwareVar.dump()
+        return result
+    def toDict(self):
+        return {'addr': self.label(), 'kind': self.kind,
+            'reference': self.valueText(self.referenceVar),
+            'hardware': self.valueText(self.hardwareVar),
+            'description': self.description}
+
+def coalesceRanges(numbers, increments):
+    '''Splits the numbers into a list of (start, count, increment) runs, taking
+       the longest run allowed by the increments from the lowest number left.'''
+    remaining = set(numbers)
+    result = []
+    for n in sorted(numbers):
+        if n in remaining:
+            best = (n, 1, 1)
+            for increment in increments:
+                count = 1
+                while n + count*increment in remaining:
+                    count += 1
+                if count > best[1]:
+                    best = (n, count, increment)
+            for i in range(best[1]):
+                remaining.discard(n + i*best[2])
+            result.append(best)
+    return result
+
+def batchFixCommands(text, maxLength=250):
+    '''Turns fix file text into a list of PMAC command lines.  Comments and
+       blank lines are dropped and consecutive commands outside program
+       buffers are joined into lines of up to maxLength characters.'''
+    result = []
+    line = ''
+    inBuffer = False
+    for command in text.split('\n'):
+        command = command.split(';', 1)[0].strip()
+        if len(command) == 0:
+            pass
+        elif inBuffer or re.search(r'\bopen\b', command, re.IGNORECASE) is not None:
+            # Program buffer lines are sent as they are
+            if len(line) > 0:
+                result.append(line)
+                line = ''
+            result.append(command)
+            inBuffer = command.lower() != 'close'
+        elif len(line) > 0 and len(line) + len(command) + 1 <= maxLength:
+            line += ' ' + command
+        else:
+            if len(line) > 0:
+                result.append(line)
+            line = command
+    if len(line) > 0:
+        result.append(line)
+    return result
+
+class PmacCompareResult(object):
+    '''The differences found by comparing the hardware state of a PMAC with
+       its reference.  Rendered into the HTML page, fix files and JSON by the
+       methods below, each of which can be used independently.'''
+    # The range increments that may be used in fix files, motor I variables
+    # repeat every 100
+    rangeIncrements = {PmacIVariable: [1, 100], PmacPVariable: [1], PmacQVariable: [1]}
+    def __init__(self, pmacName):
+        self.pmacName = pmacName
+        self.differences = []
+    def add(self, difference):
+        self.differences.append(difference)
+    def matches(self):
+        return len(self.differences) == 0
+    def html(self, page):
+        '''Renders the differences as a table.'''
+        table = page.table(page.body(), ["Element", "Reason", "Reference", "Hardware"])
+        for d in self.differences:
+            row = page.tableRow(table)
+            # The address column
+            if d.description is None:
+                page.tableColumn(row, d.label())
+            else:
+                page.tableColumn(row, page.doc_node(d.addr, d.description))
+            # The reason column
+            page.tableColumn(row, d.kind)
+            # The reference column
+            col = page.tableColumn(row)
+            if d.referenceVar is None:
+                page.text(col, '-')
+            else:
+                d.referenceVar.htmlCompare(page, col, d.hardwareVar)
+            # The hardware column
+            col = page.tableColumn(row)
+            if d.hardwareVar is None:
+                page.text(col, '-')
+            else:
+                d.hardwareVar.htmlCompare(page, col, d.referenceVar)
+    def writeFixFile(self, file):
+        '''Writes the commands that make the hardware match the reference.'''
+        self.writeCoalesced(file, [(d.referenceVar, d.fixText()) for d in self.differences])
+    def writeUnfixFile(self, file):
+        '''Writes the PMC text that makes the reference match the hardware.'''
+        self.writeCoalesced(file, [(d.hardwareVar, d.unfixText()) for d in self.differences])
+    def writeCoalesced(self, file, items):
+        '''Writes the text of each (var, text) item, replacing runs of I, P and
+           Q variables that are given the same value with a single range
+           assignment, p100..199=0 or i130,8,100=0, in place of the first.'''
+        groups = {}
+        for (var, text) in items:
+            if text is not None and type(var) in self.rangeIncrements:
+                prefix = var.typeStr[:-len(str(var.n))]
+                groups.setdefault((prefix, var.valStr()), []).append(var)
+        ranges = {}
+        for ((prefix, value), vars) in groups.iteritems():
+            increments = self.rangeIncrements[type(vars[0])]
+            for (start, count, increment) in coalesceRanges([v.n for v in vars], increments):
+                if count == 1:
+                    continue
+                elif increment == 1:
+                    text = '%s%s..%s=%s\n' % (prefix, start, start+count-1, value)
+                else:
+                    text = '%s%s,%s,%s=%s\n' % (prefix, start, count, increment, value)
+                ranges['%s%s' % (prefix, start)] = text
+                for i in range(1, count):
+                    ranges['%s%s' % (prefix, start+i*increment)] = None
+        for (var, text) in items:
+            if var is not None and var.addr() in ranges:
+                text = ranges[var.addr()]
+            if text is not None:
+                file.write(text)
+    def toDict(self):
+        return {'pmac': self.pmacName, 'matches': self.matches(),
+            'differences': [d.toDict() for d in self.differences]}
+    def writeJson(self, fileName):
+        '''Writes the differences to a JSON file.'''
+        tempFileName = '%s.tmp%s' % (fileName, os.getpid())
+        wFile = open(tempFileName, 'w')
+        json.dump(self.toDict(), wFile, indent=1, sort_keys=True)
+        wFile.close()
+        os.rename(tempFileName, fileName)
+
+class PmacLiveResolver(object):
+    '''Resolves the inline expressions of a reference PMC file by reading the
+       variables they use straight from the connected PMAC.  Used by the quick
+       check, which loads the reference before the hardware has been read.'''
+    def __init__(self, pmac):
+        self.pmac = pmac
+        self.cache = PmacState('live')
+    def read(self, var, command):
+        '''Returns the cached variable, reading its value from the PMAC first
+           if necessary.'''
+        if var.addr() in self.cache.vars:
+            return self.cache.vars[var.addr()]
+        (returnStr, status) = self.pmac.sendCommand(command)
+        if not status or not returnStr.endswith('\r\x06'):
+            raise PmacReadError('Could not read %s for an inline expression' % command)
+        value = self.pmac.toNumber(returnStr[:-2])
+        if isinstance(var, PmacMVariable):
+            var.setValue(value)
+        else:
+            var.set(value)
+        self.cache.addVar(var)
+        return var
+    def getIVariable(self, n):
+        return self.read(PmacIVariable(n), 'i%s' % n)
+    def getPVariable(self, n):
+        return self.read(PmacPVariable(n), 'p%s' % n)
+    def getQVariable(self, cs, n):
+        return self.read(PmacQVariable(cs, n), '&%sq%s' % (cs, n))
+    def getMVariable(self, n):
+        return self.read(PmacMVariable(n), 'm%s' % n)
+
+class PmacQuickCheck(object):
+    '''Compares the hardware of a PMAC with its reference section by section
+       as it is read so that the readout can stop at the first mismatch.'''
+    def __init__(self, pmac, pmacFactorySettings, geobrickFactorySettings, includePaths):
+        self.pmac = pmac
+        self.pmacFactorySettings = pmacFactorySettings
+        self.geobrickFactorySettings = geobrickFactorySettings
+        self.includePaths = includePaths
+        self.referenceLoaded = False
+        self.checked = set()
+        self.result = PmacCompareResult(pmac.name)
+        self.failedSection = None
+    def loadReference(self, resolutionState=None):
+        '''Loads the reference state of the PMAC once its type and number of
+           coordinate systems are known.'''
+        factoryDefs = None
+        if self.pmac.useFactoryDefs:
+            if self.pmac.geobrick:
+                factoryDefs = self.geobrickFactorySettings
+            else:
+                factoryDefs = self.pmacFactorySettings
+        self.pmac.loadReference(factoryDefs, self.includePaths, resolutionState)
+        self.referenceLoaded = True
+    def check(self, section):
+        '''Compares the variables read since the last check.  Returns False if
+           a mismatch has been found.'''
+        addrs = set(self.pmac.hardwareState.vars.keys()) - self.checked
+        self.checked |= addrs
+        for d in self.pmac.hardwareState.compare(self.pmac.referenceState,
+                self.pmac.noCompare, self.pmac.name, addrs, False).differences:
+            self.result.add(d)
+        if not self.result.matches() and self.failedSection is None:
+            self.failedSection = section
+            print 'Quick check: %s mismatch in %s, stopping readout' % \
+                (self.result.differences[0].label(), section)
+        return self.result.matches()
+
+class PmacPipeline(object):
+    '''Wraps a connected dls_pmaclib interface so that several commands can be
+       in flight at once.  Replies are matched to the commands in the order
+       they were sent.  Interfaces other than Ethernet and terminal server ones
+       fall back to sending one command at a time.  Once a batch fails, replies
+       may still be in flight, so every later command fails with it.'''
+    replyTerminator = re.compile('\x06|\x07ERR[0-9]{3}\r')
+    maxEthernetReply = 1400
+    def __init__(self, pti, depth):
+        self.pti = pti
+        self.depth = depth
+        self.failure = None
+    def sendCommands(self, commands):
+        '''Sends the commands keeping up to depth of them outstanding.  Returns
+           a list of (returnStr, status) tuples in command order.'''
+        if self.failure is not None:
+            results = [(self.failure, False)] * len(commands)
+        elif self.depth <= 1 or len(commands) <= 1:
+            results = [self.pti.sendCommand(c) for c in commands]
+        elif isinstance(self.pti, PmacEthernetInterface):
+            results = self.sendEthernet(commands)
+        elif isinstance(self.pti, PmacTelnetInterface):
+            results = self.sendTelnet(commands)
+        else:
+            results = [self.pti.sendCommand(c) for c in commands]
+        return results
+    def connection(self):
+        '''Returns the socket of an Ethernet interface or the telnetlib session
+           of a terminal server interface.  These are the sock attribute of
+           dls_pmaclib's PmacEthernetInterface and the tn attribute of its
+           PmacTelnetInterface, which have no public accessors.'''
+        if isinstance(self.pti, PmacEthernetInterface):
+            return self.pti.sock
+        return self.pti.tn
+    def fail(self, message, count):
+        '''Invalidates the connection, as the replies to commands in flight
+           would be read by the next command, and returns the results of the
+           count commands not answered.'''
+        self.failure = message
+        return [(message, False)] * count
+    def ethernetPacket(self, command):
+        '''Returns the VR_PMAC_GETRESPONSE packet for the command.'''
+        return struct.pack('>BBHHH', 0x40, 0xbf, 0, 0, len(command)) + command
+    def sendEthernet(self, commands):
+        '''Pipelines the commands over the socket of an Ethernet interface.'''
+        sock = self.connection()
+        results = []
+        pending = ''
+        sent = 0
+        message = None
+        try:
+            while len(results) < len(commands):
+                while sent < len(commands) and sent - len(results) < self.depth:
+                    sock.sendall(self.ethernetPacket(commands[sent]))
+                    sent += 1
+                data = sock.recv(2048)
+                if len(data) == 0:
+                    raise socket.error('Connection closed by PMAC')
+                pending += data
+                match = self.replyTerminator.search(pending)
+                while match is not None:
+                    results.append((pending[:match.end()], True))
+                    pending = pending[match.end():]
+                    match = self.replyTerminator.search(pending)
+                if len(pending) >= self.maxEthernetReply:
+                    # The rest of this reply would need a VR_PMAC_GETBUFFER request,
+                    # which cannot be interleaved with the commands already sent.
+                    message = 'Reply to %s too long for pipelined mode' % \
+                        repr(commands[len(results)])
+                    break
+        except socket.error, err:
+            message = 'I/O error during comm with PMAC: %s' % err
+        if message is not None:
+            results += self.fail(message, len(commands) - len(results))
+        return results
+    def sendTelnet(self, commands):
+        '''Pipelines the commands over the session of a terminal server interface.'''
+        tn = self.connection()
+        timeout = getattr(self.pti, 'timeout', 3.0)
+        results = []
+        sent = 0
+        try:
+            while len(results) < len(commands):
+                while sent < len(commands) and sent - len(results) < self.depth:
+                    tn.write(commands[sent] + '\r\n')
+                    sent += 1
+                (index, match, returnStr) = tn.expect([self.replyTerminator], timeout)
+                if index < 0:
+                    raise socket.error('Timed out waiting for reply to %s' %
+                        repr(commands[len(results)]))
+                results.append((returnStr, True))
+        except (socket.error, EOFError), err:
+            message = 'I/O error during comm with PMAC: %s' % err
+            results += self.fail(message, len(commands) - len(results))
+        return results
+
+class PmacReadoutStats(object):
+    '''Collects timing, traffic and error statistics for the hardware readout
+       of a PMAC.  Command latencies are recorded per command; for pipelined
+       batches this is the batch time divided by the number of commands.'''
+    latencyBucketsMs = [1, 2, 5, 10, 20, 50, 100, 200, 500, 1000]
+    def __init__(self, name):
+        self.name = name
+        self.started = time.time()
+        self.elapsed = 0.0
+        self.commands = 0
+        self.bytesOut = 0
+        self.bytesIn = 0
+        self.errors = 0
+        self.ioErrors = 0
+        self.latencyCounts = [0] * (len(self.latencyBucketsMs) + 1)
+        self.latencyMin = None
+        self.latencyMax = 0.0
+        self.latencyTotal = 0.0
+        self.sections = {}
+        self.sectionOrder = []
+        self.curSection = None
+        self.sectionStarted = None
+    def beginSection(self, name):
+        '''Starts timing a readout section.'''
+        if name not in self.sections:
+            self.sections[name] = {'elapsed': 0.0, 'commands': 0, 'bytesOut': 0,
+                'bytesIn': 0, 'errors': 0}
+            self.sectionOrder.append(name)
+        self.curSection = name
+        self.sectionStarted = time.time()
+    def endSection(self):
+        '''Stops timing the current readout section.'''
+        if self.curSection is not None:
+            self.sections[self.curSection]['elapsed'] += time.time() - self.sectionStarted
+            self.curSection = None
+    def record(self, commands, results, elapsed):
+        '''Records a batch of commands, their (returnStr, status) replies and the
+           time the batch took.'''
+        if len(commands) == 0:
+            return
+        latency = elapsed / len(commands)
+        bucket = 0
+        while bucket < len(self.latencyBucketsMs) and \
+                latency * 1000.0 >= self.latencyBucketsMs[bucket]:
+            bucket += 1
+        self.latencyCounts[bucket] += len(commands)
+        bytesOut = 0
+        bytesIn = 0
+        errors = 0
+        for text, (returnStr, status) in zip(commands, results):
+            bytesOut += len(text)
+            bytesIn += len(returnStr)
+            if not status:
+                self.ioErrors += 1
+                errors += 1
+            elif '\x07' in returnStr:
+                errors += 1
+        self.commands += len(commands)
+        self.bytesOut += bytesOut
+        self.bytesIn += bytesIn
+        self.errors += errors
+        self.latencyTotal += elapsed
+        self.latencyMax = max(self.latencyMax, latency)
+        if self.latencyMin is None or latency < self.latencyMin:
+            self.latencyMin = latency
+        if self.curSection is not None:
+            section = self.sections[self.curSection]
+            section['commands'] += len(commands)
+            section['bytesOut'] += bytesOut
+            section['bytesIn'] += bytesIn
+            section['errors'] += errors
+    def finish(self):
+        '''Marks the end of the readout.'''
+        self.endSection()
+        self.elapsed = time.time() - self.started
+    def toDict(self):
+        '''Returns the statistics as a dictionary suitable for JSON.'''
+        labels = []
+        low = 0
+        for high in self.latencyBucketsMs:
+            labels.append('%s-%sms' % (low, high))
+            low = high
+        labels.append('>=%sms' % low)
+        meanLatency = 0.0
+        if self.commands > 0:
+            meanLatency = self.latencyTotal / self.commands
+        return {'name': self.name,
+            'elapsed': self.elapsed,
+            'commands': self.commands,
+            'bytesOut': self.bytesOut,
+            'bytesIn': self.bytesIn,
+            'errors': self.errors,
+            'ioErrors': self.ioErrors,
+            'latency': {'min': self.latencyMin or 0.0, 'max': self.latencyMax,
+                'mean': meanLatency, 'buckets': labels, 'counts': self.latencyCounts},
+            'sections': [dict(self.sections[name], name=name) for name in self.sectionOrder]}
+
+class PmacBackupWriter(object):
+    '''Writes a backup file through a temporary file that only replaces the
+       previous backup when the readout completes.  The backup can be
+       compressed with gzip or, if the lzma module is available, xz.'''
+    extensions = {None: '', 'gzip': '.gz', 'xz': '.xz'}
+    bufferSize = 65536
+    def __init__(self, fileName, compression=None):
+        self.fileName = fileName + self.extensions[compression]
+        self.tempFileName = '%s.tmp%s' % (self.fileName, os.getpid())
+        if compression == 'gzip':
+            self.file = gzip.open(self.tempFileName, 'wb')
+        elif compression == 'xz':
+            self.file = lzma.LZMAFile(self.tempFileName, 'wb')
+        else:
+            self.file = open(self.tempFileName, 'w', self.bufferSize)
+        self.buffer = []
+        self.bufferLength = 0
+    def write(self, text):
+        self.buffer.append(text)
+        self.bufferLength += len(text)
+        if self.bufferLength >= self.bufferSize:
+            self.flush()
+    def flush(self):
+        self.file.write(''.join(self.buffer))
+        self.buffer = []
+        self.bufferLength = 0
+    def commit(self):
+        '''Finishes the backup and moves it into place.'''
+        self.flush()
+        self.file.close()
+        os.rename(self.tempFileName, self.fileName)
+    def abort(self):
+        '''Abandons the backup, leaving any previous one in place.'''
+        self.file.close()
+        os.remove(self.tempFileName)
+
+def openBackupFile(fileName):
+    '''Opens a backup file for reading, decompressing it if necessary.'''
+    if fileName.endswith('.gz'):
+        result = gzip.open(fileName, 'rb')
+    elif fileName.endswith('.xz'):
+        if lzma is None:
+            raise AnalyseError('Reading %s requires the lzma module' % fileName)
+        result = lzma.LZMAFile(fileName, 'rb')
+    else:
+        result = open(fileName, 'r')
+    return result
+
+class PmacDeltaBackup(object):
+    '''A differential backup that holds only the lines that changed since a
+       full base backup.  Loading the base followed by the delta restores the
+       state at the time of the delta.  A new full base is due every
+       fullEvery runs, which the delta header counts.'''
+    headerPattern = re.compile(r'^; Differential backup against (\S+) sha1 ([0-9a-f]+) run (\d+)$')
+    def __init__(self, baseFileName, deltaFileName, fullEvery, compression=None):
+        extension = PmacBackupWriter.extensions[compression]
+        self.baseFileName = baseFileName + extension
+        self.deltaFileName = deltaFileName
+        self.compression = compression
+        self.baseHash = None
+        self.run = 1
+        if os.path.exists(self.baseFileName):
+            file = open(self.baseFileName, 'rb')
+            self.baseHash = hashlib.sha1(file.read()).hexdigest()
+            file.close()
+            (baseHash, run) = self.readHeader(self.deltaFileName + extension)
+            if baseHash == self.baseHash:
+                self.run = run + 1
+        self.full = self.baseHash is None or self.run >= fullEvery
+    def readHeader(self, fileName):
+        '''Returns the base hash and run number of an existing delta.'''
+        result = (None, 0)
+        if os.path.exists(fileName):
+            file = openBackupFile(fileName)
+            match = self.headerPattern.match(file.readline().rstrip())
+            file.close()
+            if match is not None:
+                result = (match.group(2), int(match.group(3)))
+        return result
+    def removeDelta(self):
+        '''Removes a delta made obsolete by a new full base.'''
+        fileName = self.deltaFileName + PmacBackupWriter.extensions[self.compression]
+        if os.path.exists(fileName):
+            os.remove(fileName)
+    def write(self, hardwareState, pmacName):
+        '''Writes the lines of the hardware state that differ from the base.
+           Returns the differences.'''
+        base = PmacState('base')
+        file = openBackupFile(self.baseFileName)
+        parser = PmacParser(file, base)
+        parser.onLine()
+        file.close()
+        diff = hardwareState.compare(base, PmacState('noCompare'), pmacName, checkPlcs=False)
+        writer = PmacBackupWriter(self.deltaFileName, self.compression)
+        writer.write('; Differential backup against %s sha1 %s run %s\n' %
+            (os.path.basename(self.baseFileName), self.baseHash, self.run))
+        diff.writeUnfixFile(writer)
+        writer.commit()
+        print 'Differential backup %s holds %s changes since %s' % (writer.fileName,
+            len(diff.differences), self.baseFileName)
+        return diff
+
+class PmacBackupStore(object):
+    '''A content-addressed store of backups.  Each section of a backup is
+       stored once, gzip compressed, in the objects directory under the SHA-1
+       of its text, and each readout adds a small manifest listing the
+       sections it consists of.'''
+    def __init__(self, directory):
+        self.directory = directory
+    def objectFileName(self, key):
+        return os.path.join(self.directory, 'objects', key[:2], key[2:])
+    def manifestDir(self, pmacName):
+        return os.path.join(self.directory, 'manifests', pmacName)
+    def writeFile(self, fileName, text, compress=False):
+        '''Writes a file through a temporary file so that readers never see
+           a partial one.'''
+        dirName = os.path.dirname(fileName)
+        if not os.path.isdir(dirName):
+            try:
+                os.makedirs(dirName)
+            except OSError, err:
+                if err.errno != errno.EEXIST:
+                    raise
+        tempFileName = '%s.tmp%s' % (fileName, os.getpid())
+        if compress:
+            file = gzip.open(tempFileName, 'wb')
+        else:
+            file = open(tempFileName, 'w')
+        file.write(text)
+        file.close()
+        os.rename(tempFileName, fileName)
+    def putObject(self, text):
+        '''Stores the text if it is not already present, returns its key.'''
+        key = hashlib.sha1(text).hexdigest()
+        fileName = self.objectFileName(key)
+        if not os.path.exists(fileName):
+            self.writeFile(fileName, text, compress=True)
+        return key
+    def getObject(self, key):
+        file = gzip.open(self.objectFileName(key), 'rb')
+        text = file.read()
+        file.close()
+        return text
+    def writeManifest(self, pmacName, started, sections):
+        '''Writes the manifest of a readout, sections is a list of
+           [sectionName, key] pairs in backup order.'''
+        fileName = os.path.join(self.manifestDir(pmacName),
+            '%s.json' % started.strftime('%Y%m%d-%H%M%S'))
+        manifest = {'pmac': pmacName, 'started': started.isoformat(),
+            'sections': sections}
+        self.writeFile(fileName, json.dumps(manifest, indent=1))
+        return fileName
+    def manifests(self, pmacName):
+        '''Returns the manifest file names of a PMAC, oldest first.'''
+        result = []
+        dirName = self.manifestDir(pmacName)
+        if os.path.isdir(dirName):
+            for fileName in sorted(os.listdir(dirName)):
+                if fileName.endswith('.json'):
+                    result.append(os.path.join(dirName, fileName))
+        return result
+    def restore(self, manifestFileName):
+        '''Returns the backup text described by a manifest.'''
+        manifest = json.load(open(manifestFileName))
+        text = []
+        for (section, key) in manifest['sections']:
+            text.append(self.getObject(key))
+        return ''.join(text)
+
+class PmacBackupSnapshot(object):
+    '''Collects the backup of one readout by section and adds it to a
+       PmacBackupStore when the readout completes.'''
+    def __init__(self, store, pmacName):
+        self.store = store
+        self.pmacName = pmacName
+        self.started = datetime.datetime.now()
+        self.sections = []
+        self.section('header')
+    def section(self, name):
+        self.sections.append((name, []))
+    def write(self, text):
+        self.sections[-1][1].append(text)
+    def commit(self):
+        '''Stores the sections and writes the manifest.'''
+        sections = []
+        for (name, parts) in self.sections:
+            text = ''.join(parts)
+            if len(text) > 0:
+                sections.append([name, self.store.putObject(text)])
+        self.fileName = self.store.writeManifest(self.pmacName, self.started, sections)
+        print "Backup of %s stored as %s" % (self.pmacName, self.fileName)
+    def abort(self):
+        self.sections = []
+
+class PmacPollBuffer(object):
+    '''A preallocated ring buffer of the samples taken by polling a PMAC.  Each
+       row is the time of the sample followed by the value of each column, NaN
+       for a sample that failed.'''
+    def __init__(self, columns, size):
+        self.columns = columns
+        self.data = numpy.zeros((size, len(columns) + 1))
+        self.count = 0
+        self.flushed = 0
+        self.lost = 0
+        self.failed = 0
+    def add(self, t, values):
+        '''Adds a sample, overwriting the oldest if the buffer is full.  The
+           values are None for a sample that failed.'''
+        row = self.data[self.count % len(self.data)]
+        row[0] = t
+        if values is None:
+            row[1:] = numpy.nan
+            self.failed += 1
+        else:
+            row[1:] = values
+        self.count += 1
+    def rows(self, first):
+        '''Returns the samples from number first onwards, oldest first.'''
+        first = max(first, self.count - len(self.data))
+        indices = numpy.arange(first, self.count) % len(self.data)
+        return self.data[indices]
+    def flush(self, file):
+        '''Writes the samples added since the last flush to the binary file.
+           Samples overwritten before they could be written are counted as lost.'''
+        if self.count - self.flushed > len(self.data):
+            self.lost += self.count - self.flushed - len(self.data)
+        self.rows(self.flushed).astype('<f8').tofile(file)
+        self.flushed = self.count
+    def statistics(self):
+        '''Returns the minimum, maximum, mean and standard deviation of each
+           column over the samples in the buffer that did not fail.'''
+        result = {}
+        window = self.rows(0)
+        window = window[~numpy.isnan(window[:, 1:]).any(axis=1)]
+        if len(window) > 0:
+            for i, column in enumerate(self.columns):
+                values = window[:, i+1]
+                result[column] = {'min': float(values.min()), 'max': float(values.max()),
+                    'mean': float(values.mean()), 'std': float(values.std())}
+        return result
+    def toDict(self):
+        window = self.rows(0)
+        result = {'columns': ['time'] + self.columns, 'samples': self.count,
+            'lost': self.lost, 'failed': self.failed, 'statistics': self.statistics()}
+        if len(window) > 0:
+            result['window'] = [float(window[0, 0]), float(window[-1, 0])]
+        return result
+
+def jsonStrings(value):
+    '''Returns the loaded JSON value with its unicode strings converted to str,
+       as sent to and received from the PMAC.'''
+    if isinstance(value, unicode):
+        result = str(value)
+    elif isinstance(value, list):
+        result = [jsonStrings(x) for x in value]
+    elif isinstance(value, dict):
+        result = {}
+        for k, v in value.iteritems():
+            result[str(k)] = jsonStrings(v)
+    else:
+        result = value
+    return result
+
+class PmacTopologyCache(object):
+    '''The topology of PMACs, discovered by previous runs, in a JSON file keyed
+       by host and port.  Each entry holds the discovered values along with the
+       probe, the discovery commands as a single command line, and its reply.'''
+    def __init__(self, fileName):
+        self.fileName = fileName
+        self.entries = {}
+        if os.path.exists(fileName):
+            try:
+                rFile = open(fileName, 'r')
+                self.entries = jsonStrings(json.load(rFile))
+                rFile.close()
+            except ValueError:
+                print 'Ignoring unreadable topology cache %s' % fileName
+    def key(self, pmac):
+        return '%s:%s' % (pmac.host, pmac.port)
+    def get(self, pmac):
+        return self.entries.get(self.key(pmac))
+    def put(self, pmac, entry):
+        '''Stores the entry of the PMAC and rewrites the cache file.'''
+        self.entries[self.key(pmac)] = entry
+        tempFileName = '%s.tmp%s' % (self.fileName, os.getpid())
+        wFile = open(tempFileName, 'w')
+        json.dump(self.entries, wFile, indent=1, sort_keys=True)
+        wFile.close()
+        os.rename(tempFileName, self.fileName)
+
+class PmacProgramCache(object):
+    '''The listings of the program buffers of PMACs, read by previous runs, in
+       a JSON file keyed by host and port and then by buffer.  Each entry holds
+       the lines and offsets of the listing and the (command, reply) of each
+       block of it, which fingerprint it.  The file is only rewritten by
+       save.'''
+    def __init__(self, fileName):
+        self.fileName = fileName
+        self.entries = {}
+        self.changed = False
+        if os.path.exists(fileName):
+            try:
+                rFile = open(fileName, 'r')
+                self.entries = jsonStrings(json.load(rFile))
+                rFile.close()
+            except ValueError:
+                print 'Ignoring unreadable program cache %s' % fileName
+    def key(self, pmac):
+        return '%s:%s' % (pmac.host, pmac.port)
+    def get(self, pmac, thing):
+        return self.entries.get(self.key(pmac), {}).get(thing)
+    def put(self, pmac, thing, entry):
+        self.entries.setdefault(self.key(pmac), {})[thing] = entry
+        self.changed = True
+    def save(self):
+        '''Rewrites the cache file if any listing has changed.'''
+        if self.changed:
+            tempFileName = '%s.tmp%s' % (self.fileName, os.getpid())
+            wFile = open(tempFileName, 'w')
+            json.dump(self.entries, wFile, sort_keys=True)
+            wFile.close()
+            os.rename(tempFileName, self.fileName)
+            self.changed = False
+
+historyAddrPattern = re.compile(r'(?:&(\d+)|ms(\d+))?([a-z]+|#|%)(\d+)$')
+
+def splitHistoryAddr(addr):
+    '''Returns the (family, node, number) of an address, where the node is
+       the coordinate system or macro station, if any.'''
+    match = historyAddrPattern.match(addr)
+    if match is None:
+        raise GeneralError('Cannot store address %s' % addr)
+    (cs, ms, family, number) = match.groups()
+    node = cs or ms
+    if ms is not None:
+        family = 'ms%s' % family
+    if node is not None:
+        node = int(node)
+    return (family, node, int(number))
+
+def historyValues(state):
+    '''Returns a dictionary of the (family, node, number) values of a state,
+       the text of programs and the value of variables.'''
+    result = {}
+    for var in state.vars.itervalues():
+        if isinstance(var, PmacProgram):
+            value = var.valueText()
+        else:
+            value = var.valStr()
+        result[splitHistoryAddr(var.addr())] = value
+    return result
+
+def historyFileValues(fileName):
+    '''Parses a PMC snapshot file, compressed or not, and returns its
+       historyValues, or None if it cannot be parsed.  Used by GlobalConfig to
+       index snapshot files on a process pool.'''
+    state = PmacState(fileName)
+    try:
+        file = openBackupFile(fileName)
+        PmacParser(file, state).onLine()
+        file.close()
+    except (IOError, AnalyseError, ParserError, LexerError, GeneralError), err:
+        print >> sys.stderr, 'Cannot index %s: %s' % (fileName, err)
+        return None
+    return historyValues(state)
+
+class PmacQuery(object):
+    '''A query of stored PMAC states.  Either a variable specification, as for
+       nocompare, optionally compared with a value, for example i7000!=$1F or
+       p100..199>5, or refs:<word> for the programs that use the word.'''
+    families = {'i': 'i', 'p': 'p', 'm': 'm', 'ms': 'msi', '&': 'q'}
+    programFamilies = ['plc', 'prog', 'fwd', 'inv']
+    def __init__(self, text):
+        self.text = text
+        self.refs = None
+        self.keys = []
+        self.operator = None
+        self.value = None
+        if text.lower().startswith('refs:'):
+            self.refs = re.compile(r'(?<![A-Z0-9])%s(?![0-9])' % re.escape(text[5:].upper()))
+        else:
+            spec = text
+            match = re.match(r'(.*?)(!=|<=|>=|=|<|>)(.*)$', text)
+            if match is not None:
+                (spec, self.operator, self.value) = match.groups()
+            parser = PmacParser([spec], None)
+            (varType, nodeList, start, count, increment) = parser.parseVarSpec()
+            for node in nodeList or [None]:
+                for n in range(start, start + count*increment, increment):
+                    self.keys.append((self.families[varType], node, n))
+    def number(self, text):
+        '''Returns the number of a value, or None if it is not one.'''
+        text = text.upper()
+        sign = 1
+        if text.startswith('-'):
+            sign = -1
+            text = text[1:]
+        result = None
+        if isNumber(text):
+            result = toNumber(text) * sign
+        return result
+    def compare(self, value):
+        '''Returns whether the value satisfies the comparison, if any.  Numbers
+           are compared by value, anything else as text.'''
+        if self.operator is None:
+            return True
+        (a, b) = (self.number(value), self.number(self.value))
+        if a is None or b is None:
+            (a, b) = (value.upper(), self.value.upper())
+        return {'!=': a != b, '<=': a <= b, '>=': a >= b, '=': a == b,
+            '<': a < b, '>': a > b}[self.operator]
+    def run(self, values):
+        '''Returns the (addr, value) results of the query of the values of a
+           state, a dictionary keyed by (family, node, number).'''
+        results = []
+        if self.refs is not None:
+            for (family, node, number), value in sorted(values.iteritems()):
+                if family in self.programFamilies:
+                    lines = [line for line in value.split('\n')
+                        if self.refs.search(line.upper())]
+                    if len(lines) > 0:
+                        results.append(('%s%s' % (family, number), lines[0].strip()))
+        else:
+            for key in self.keys:
+                value = values.get(key)
+                if value is not None and self.compare(value):
+                    (family, node, number) = key
+                    if family == 'msi':
+                        addr = 'ms%si%s' % (node, number)
+                    elif node is not None:
+                        addr = '&%s%s%s' % (node, family, number)
+                    else:
+                        addr = '%s%s' % (family, number)
+                    results.append((addr, value))
+        return results
+
+class PmacHistory(object):
+    '''A SQLite database of the hardware states of PMACs.  Each readout adds a
+       run along with the value of every variable it read, so that the state
+       as of any run is read by an index rather than rebuilt.'''
+    schema = ['CREATE TABLE IF NOT EXISTS runs (run INTEGER PRIMARY KEY, pmac TEXT, started REAL)',
+        'CREATE TABLE IF NOT EXISTS vars (run INTEGER, pmac TEXT, family TEXT, node INTEGER, '
+            'number INTEGER, value TEXT)',
+        'CREATE INDEX IF NOT EXISTS runsByPmac ON runs (pmac, run)',
+        'CREATE INDEX IF NOT EXISTS varsByRun ON vars (run)',
+        'CREATE INDEX IF NOT EXISTS varsByAddr ON vars (pmac, family, node, number, run)',
+        'CREATE TABLE IF NOT EXISTS files (path TEXT PRIMARY KEY, mtime REAL, size INTEGER, run INTEGER)']
+    def __init__(self, fileName):
+        self.db = sqlite3.connect(fileName)
+        columns = [row[1] for row in self.db.execute('PRAGMA table_info(vars)')]
+        if len(columns) > 0 and 'pmac' not in columns:
+            self.db.close()
+            raise GeneralError('History %s holds only changes, an earlier format, '
+                'and must be recreated' % fileName)
+        for statement in self.schema:
+            self.db.execute(statement)
+        self.db.commit()
+    def close(self):
+        self.db.close()
+    def pmacNames(self):
+        return [str(row[0]) for row in
+            self.db.execute('SELECT DISTINCT pmac FROM runs ORDER BY pmac')]
+    def state(self, pmacName, run=None):
+        '''Returns a dictionary of the (family, node, number) values of the
+           PMAC as of the run, or the latest run.'''
+        if run is None:
+            run = sys.maxint
+        [(run,)] = self.db.execute('SELECT MAX(run) FROM runs WHERE pmac = ? AND run <= ?',
+            (pmacName, run)).fetchall()
+        result = {}
+        for (family, node, number, value) in self.db.execute(
+                'SELECT family, node, number, value FROM vars WHERE run = ?', (run,)):
+            result[(family, node, number)] = value
+        return result
+    def store(self, pmacName, started, state):
+        '''Adds a run of the PMAC with the variables of the state, returns the
+           run number.'''
+        return self.storeValues(pmacName, started, historyValues(state))
+    def storeValues(self, pmacName, started, values):
+        '''Adds a run of the PMAC with the (family, node, number) values,
+           returns the run number.'''
+        run = self.db.execute('INSERT INTO runs (pmac, started) VALUES (?, ?)',
+            (pmacName, started)).lastrowid
+        self.db.executemany('INSERT INTO vars VALUES (?, ?, ?, ?, ?, ?)',
+            [(run, pmacName) + key + (value,) for key, value in values.iteritems()])
+        self.db.commit()
+        return run
+    def fileRun(self, path, mtime, size):
+        '''Returns the run of a snapshot file if it is indexed and unchanged.'''
+        for (run,) in self.db.execute('SELECT run FROM files WHERE path = ? AND '
+                'mtime = ? AND size = ?', (path, mtime, size)):
+            return run
+        return None
+    def storeFile(self, path, mtime, size, values):
+        '''Indexes the values of a snapshot file as a run named after it.'''
+        run = self.storeValues(path, mtime, values)
+        self.db.execute('INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?)',
+            (path, mtime, size, run))
+        self.db.commit()
+        return run
+    def changes(self, pmacName, addr):
+        '''Returns the (started, value) changes of a variable of the PMAC,
+           oldest first.  The value is None when the variable went.'''
+        (family, node, number) = splitHistoryAddr(addr)
+        result = []
+        previous = None
+        for (started, value) in self.db.execute(
+                'SELECT started, value FROM runs LEFT JOIN vars ON vars.run = runs.run AND '
+                'vars.pmac = runs.pmac AND family = ? AND node IS ? AND number = ? '
+                'WHERE runs.pmac = ? ORDER BY runs.run', (family, node, number, pmacName)):
+            if value != previous:
+                result.append((started, value))
+                previous = value
+        return result
+
+class PmacTraceWriter(object):
+    '''Records the commands sent to a PMAC, their replies and the time at
+       which each reply arrived into a gzipped trace file that can be replayed
+       by PmacReplayInterface.'''
+    def __init__(self, fileName, pmac):
+        self.file = gzip.open(fileName, 'wb')
+        self.started = time.time()
+        self.file.write('# dls-pmac-analyse trace\n')
+        self.file.write('# pmac %s\n' % pmac.name)
+        self.file.write('# host %s\n' % pmac.host)
+        self.file.write('# port %s\n' % pmac.port)
+        self.file.write('# termserv %d\n' % int(pmac.termServ))
+        self.file.write('# pipelined %d\n' % int(pmac.pipelined))
+        self.file.write('# started %s\n' % datetime.datetime.today().isoformat())
+    def record(self, commands, results):
+        '''Records a batch of commands and their (returnStr, status) replies.'''
+        offset = time.time() - self.started
+        for text, (returnStr, status) in zip(commands, results):
+            self.file.write('%.6f\t%d\t%s\t%s\n' % (offset, int(status),
+                text.encode('string_escape'), returnStr.encode('string_escape')))
+    def close(self):
+        self.file.close()
+
+class PmacReplayInterface(object):
+    '''Stands in for a dls_pmaclib interface, answering commands from a trace
+       recorded by PmacTraceWriter.  The readout must send exactly the commands
+       that were recorded.  If realTime is set each reply is delayed until the
+       time it arrived in the recording, otherwise the trace is replayed as
+       fast as possible.'''
+    def __init__(self, fileName, realTime=False):
+        self.fileName = fileName
+        self.realTime = realTime
+        self.header = {}
+        self.records = []
+        self.index = 0
+        self.started = None
+    def setConnectionParams(self, host, port):
+        pass
+    def connect(self):
+        '''Loads the trace.  Returns None on success or an error message.'''
+        try:
+            file = gzip.open(self.fileName, 'rb')
+            try:
+                for line in file:
+                    line = line.rstrip('\n')
+                    if line.startswith('#'):
+                        words = line[1:].split(None, 1)
+                        if len(words) == 2:
+                            self.header[words[0]] = words[1]
+                    elif len(line) > 0:
+                        (offset, status, text, returnStr) = line.split('\t')
+                        self.records.append((float(offset), bool(int(status)),
+                            text.decode('string_escape'), returnStr.decode('string_escape')))
+            finally:
+                file.close()
+        except (IOError, ValueError), err:
+            return 'Could not load trace %s: %s' % (self.fileName, err)
+        self.index = 0
+        self.started = time.time()
+        return None
+    def disconnect(self):
+        return None
+    def isPipelined(self):
+        '''Returns True if the recorded readout used pipelined block sizes.'''
+        return self.header.get('pipelined', '0') == '1'
+    def sendCommand(self, command):
+        '''Returns the recorded (returnStr, status) reply to the command.'''
+        if self.index >= len(self.records):
+            raise PmacReadError('Trace %s exhausted at command %s' %
+                (self.fileName, repr(command)))
+        (offset, status, text, returnStr) = self.records[self.index]
+        if text != command:
+            raise PmacReadError('Trace %s diverged at record %d: expected %s, got %s' %
+                (self.fileName, self.index, repr(text), repr(command)))
+        self.index += 1
+        if self.realTime:
+            delay = self.started + offset - time.time()
+            if delay > 0:
+                time.sleep(delay)
+        return (returnStr, status)
+
+class PmacReturn(object):
+    '''Yielded by a readout coroutine to return a value to its caller.'''
+    def __init__(self, value):
+        self.value = value
+
+class PmacCoroutine(object):
+    '''Runs a readout coroutine.  A readout coroutine is a generator that yields
+       either a list of PMAC commands, and is sent back the list of
+       (returnStr, status) replies, or another readout coroutine, which is run
+       to completion and whose PmacReturn value (if any) is sent back.  If a
+       PmacReadoutStats is given, each coroutine yielded by the top level one
+       is timed as a readout section.'''
+    def __init__(self, generator, stats=None):
+        self.stack = [generator]
+        self.stats = stats
+    def advance(self, value=None):
+        '''Resumes the coroutine with the value.  Returns the next list of
+           commands to send or None when the coroutine has finished.'''
+        result = None
+        while result is None and len(self.stack) > 0:
+            try:
+                step = self.stack[-1].send(value)
+            except StopIteration:
+                self.pop()
+                value = None
+            else:
+                if isinstance(step, types.GeneratorType):
+                    if self.stats is not None and len(self.stack) == 1:
+                        self.stats.beginSection(step.__name__)
+                    self.stack.append(step)
+                    value = None
+                elif isinstance(step, PmacReturn):
+                    self.pop().close()
+                    value = step.value
+                else:
+                    result = step
+        return result
+    def pop(self):
+        '''Removes the innermost coroutine, ending its section if timed.'''
+        result = self.stack.pop()
+        if self.stats is not None and len(self.stack) == 1:
+            self.stats.endSection()
+        return result
+
+class PmacAsyncInterface(object):
+    '''A non-blocking connection to a PMAC, the counterpart of the dls_pmaclib
+       interfaces for use by PmacReadoutLoop.  Batches of commands are queued
+       by submit and up to depth of them are kept in flight.  Do not
+       instantiate this class directly, use one of the subclasses.'''
+    replyTerminator = PmacPipeline.replyTerminator
+    handshakeCommand = 'ver'
+    maxReply = None
+    def __init__(self, host, port, depth, timeout=3.0):
+        self.host = host
+        self.port = int(port)
+        self.depth = max(depth, 1)
+        self.timeout = timeout
+        self.sock = None
+        self.connected = False
+        self.handshaking = True
+        self.error = None
+        self.queue = []
+        self.inFlight = []
+        self.replies = []
+        self.outBuffer = ''
+        self.inBuffer = ''
+        self.lastActivity = time.time()
+    def connect(self):
+        '''Starts connecting to the PMAC and queues the handshake command.'''
+        self.queue.append(self.handshakeCommand)
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.setblocking(0)
+        try:
+            err = self.sock.connect_ex((self.host, self.port))
+        except socket.gaierror:
+            self.fail('ERROR: unknown host')
+        else:
+            if err not in (0, errno.EINPROGRESS, errno.EWOULDBLOCK):
+                self.fail('ERROR: connection refused by host')
+    def disconnect(self):
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+        self.connected = False
+    def fileno(self):
+        return self.sock.fileno()
+    def submit(self, commands):
+        '''Queues a batch of commands.'''
+        if self.error is not None:
+            self.replies += [(self.error, False)] * len(commands)
+        else:
+            self.queue += commands
+        self.lastActivity = time.time()
+    def busy(self):
+        '''Returns True while commands of the current batch are outstanding.'''
+        return len(self.queue) > 0 or len(self.inFlight) > 0
+    def takeReplies(self):
+        '''Returns the replies to the current batch in command order.'''
+        result = self.replies
+        self.replies = []
+        return result
+    def wantsRead(self):
+        return self.sock is not None and self.connected
+    def wantsWrite(self):
+        return self.sock is not None and (not self.connected or len(self.outBuffer) > 0 or
+            (len(self.queue) > 0 and len(self.inFlight) < self.depth))
+    def handleWrite(self):
+        '''Completes the connection and sends as much as possible.'''
+        if not self.connected:
+            if self.sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR) != 0:
+                self.fail('ERROR: connection refused by host')
+                return
+            self.connected = True
+        while len(self.queue) > 0 and len(self.inFlight) < self.depth:
+            command = self.queue.pop(0)
+            self.outBuffer += self.frame(command)
+            self.inFlight.append(command)
+        try:
+            sent = self.sock.send(self.outBuffer)
+        except socket.error, err:
+            self.fail('I/O error during comm with PMAC: %s' % err)
+        else:
+            self.outBuffer = self.outBuffer[sent:]
+            self.lastActivity = time.time()
+    def handleRead(self):
+        '''Receives data and matches complete replies to the commands in flight.'''
+        try:
+            data = self.sock.recv(4096)
+        except socket.error, err:
+            self.fail('I/O error during comm with PMAC: %s' % err)
+            return
+        if len(data) == 0:
+            self.fail('I/O error during comm with PMAC: connection closed')
+            return
+        self.lastActivity = time.time()
+        self.inBuffer += self.unframe(data)
+        match = self.replyTerminator.search(self.inBuffer)
+        while match is not None and len(self.inFlight) > 0:
+            reply = self.inBuffer[:match.end()]
+            self.inBuffer = self.inBuffer[match.end():]
+            self.inFlight.pop(0)
+            if self.handshaking:
+                self.handshaking = False
+                if not self.handshakeOk(reply):
+                    self.fail('Device did not respond correctly to a "ver" command')
+                    return
+            else:
+                self.replies.append((reply, True))
+            match = self.replyTerminator.search(self.inBuffer)
+        if self.maxReply is not None and len(self.inBuffer) >= self.maxReply:
+            self.fail('Reply to %s too long for pipelined mode' % repr(self.inFlight[0]))
+    def checkTimeout(self, now):
+        if self.busy() and self.error is None and now - self.lastActivity > self.timeout:
+            if len(self.inFlight) > 0:
+                self.fail('Timed out waiting for reply to %s' % repr(self.inFlight[0]))
+            else:
+                self.fail('Timed out connecting to PMAC')
+    def fail(self, message):
+        '''Closes the connection and fails every outstanding command.'''
+        self.error = message
+        self.disconnect()
+        outstanding = len(self.inFlight) + len(self.queue)
+        if self.handshaking:
+            outstanding -= 1
+        self.replies += [(message, False)] * outstanding
+        self.inFlight = []
+        self.queue = []
+        self.outBuffer = ''
+    def handshakeOk(self, reply):
+        return True
+    def frame(self, command):
+        return command
+    def unframe(self, data):
+        return data
+
+class PmacAsyncEthernetInterface(PmacAsyncInterface):
+    '''Non-blocking counterpart of PmacEthernetInterface.  Each reply must fit
+       in a single Ethernet packet.'''
+    handshakeCommand = 'i6=1 i3=2 ver'
+    versionReply = re.compile(r'^\d+\.\d+\s*\r\x06$')
+    maxReply = PmacPipeline.maxEthernetReply
+    def handshakeOk(self, reply):
+        return self.versionReply.match(reply) is not None
+    def frame(self, command):
+        return struct.pack('>BBHHH', 0x40, 0xbf, 0, 0, len(command)) + command
+
+class PmacAsyncTelnetInterface(PmacAsyncInterface):
+    '''Non-blocking counterpart of PmacTelnetInterface.  Telnet option
+       negotiation from the terminal server is refused.'''
+    IAC = chr(255)
+    DONT = chr(254)
+    DO = chr(253)
+    WONT = chr(252)
+    WILL = chr(251)
+    SB = chr(250)
+    SE = chr(240)
+    def __init__(self, host, port, depth, timeout=3.0):
+        PmacAsyncInterface.__init__(self, host, port, depth, timeout)
+        self.rawBuffer = ''
+    def frame(self, command):
+        return command + '\r\n'
+    def unframe(self, data):
+        '''Strips telnet commands from the data, answering option negotiations.'''
+        data = self.rawBuffer + data
+        self.rawBuffer = ''
+        result = ''
+        pos = 0
+        while pos < len(data):
+            iac = data.find(self.IAC, pos)
+            if iac < 0:
+                result += data[pos:]
+                pos = len(data)
+            else:
+                result += data[pos:iac]
+                if iac + 1 >= len(data):
+                    self.rawBuffer = data[iac:]
+                    pos = len(data)
+                elif data[iac+1] == self.IAC:
+                    result += self.IAC
+                    pos = iac + 2
+                elif data[iac+1] in (self.DO, self.DONT, self.WILL, self.WONT):
+                    if iac + 2 >= len(data):
+                        self.rawBuffer = data[iac:]
+                        pos = len(data)
+                    else:
+                        if data[iac+1] == self.DO:
+                            self.outBuffer += self.IAC + self.WONT + data[iac+2]
+                        elif data[iac+1] == self.WILL:
+                            self.outBuffer += self.IAC + self.DONT + data[iac+2]
+                        pos = iac + 3
+                elif data[iac+1] == self.SB:
+                    end = data.find(self.IAC + self.SE, iac)
+                    if end < 0:
+                        self.rawBuffer = data[iac:]
+                        pos = len(data)
+                    else:
+                        pos = end + 2
+                else:
+                    pos = iac + 2
+        # Like telnetlib, drop NULs and XONs
+        return result.replace('\x00', '').replace('\x11', '')
+
+class PmacReadoutLoop(object):
+    '''Reads the hardware of several PMACs concurrently from a single thread
+       using non-blocking connections.  At most maxConnections PMACs are read
+       at once and each PMAC has at most its pipeline depth of commands in
+       flight.'''
+    def __init__(self, maxConnections, backupDir, checkPositions, debug, comments,
+            timeout=3.0, compression=None):
+        self.maxConnections = maxConnections
+        self.backupDir = backupDir
+        self.compression = compression
+        self.checkPositions = checkPositions
+        self.debug = debug
+        self.comments = comments
+        self.timeout = timeout
+    def run(self, pmacs):
+        '''Reads the hardware of each of the PMACs.  Returns a dictionary of
+           error messages, keyed by PMAC name, for those that failed.'''
+        failures = {}
+        waiting = list(pmacs)
+        active = {}
+        try:
+            while len(waiting) > 0 or len(active) > 0:
+                while len(waiting) > 0 and len(active) < self.maxConnections:
+                    pmac = waiting.pop(0)
+                    pmac.beginReadout(self.backupDir, self.checkPositions, self.debug,
+                        self.comments, self.compression)
+                    pmac.pipelined = True
+                    pmac.beginRecording()
+                    client = pmac.createAsyncInterface(self.timeout)
+                    client.connect()
+                    active[client] = [pmac, None, [], time.time()]
+                readers = [c for c in active if c.wantsRead()]
+                writers = [c for c in active if c.wantsWrite()]
+                if len(readers) > 0 or len(writers) > 0:
+                    (readable, writable, x) = select.select(readers, writers, [], 0.1)
+                    for client in writable:
+                        client.handleWrite()
+                    for client in readable:
+                        if client.wantsRead():
+                            client.handleRead()
+                now = time.time()
+                for client, entry in active.items():
+                    client.checkTimeout(now)
+                    try:
+                        finished = self.step(client, entry)
+                    except PmacReadError, err:
+                        failures[entry[0].name] = str(err)
+                        finished = True
+                    except Exception, err:
+                        # Such as an error reply where a number was expected,
+                        # which must not stop the readout of the other PMACs
+                        failures[entry[0].name] = '%s: %s' % (err.__class__.__name__, err)
+                        finished = True
+                    if entry[0].name in failures:
+                        print "FAILED TO READ %s: %s" % (entry[0].name, failures[entry[0].name])
+                    if finished:
+                        client.disconnect()
+                        entry[0].endReadout()
+                        del active[client]
+        finally:
+            for client, entry in active.items():
+                client.disconnect()
+                entry[0].endReadout()
+        return failures
+    def step(self, client, entry):
+        '''Advances the readout of one PMAC if its current batch is complete.
+           Returns True when the readout has finished.'''
+        (pmac, coroutine, commands, submitted) = entry
+        finished = False
+        if client.handshaking and client.error is not None:
+            raise PmacReadError(client.error)
+        elif not client.busy() and not client.handshaking:
+            if coroutine is None:
+                print 'Connected to a PMAC via "%s" using port %s.' % (pmac.host, pmac.port)
+                pmac.addPhaseTime('connect', time.time() - submitted)
+                pmac.readoutStarted = time.time()
+                coroutine = PmacCoroutine(pmac.readHardwareSteps(), pmac.stats)
+                commands = coroutine.advance()
+            else:
+                replies = client.takeReplies()
+                pmac.traceCommands(commands, replies, time.time() - entry[3])
+                commands = coroutine.advance(replies)
+            if commands is None:
+                pmac.addPhaseTime('readout', time.time() - pmac.readoutStarted)
+                finished = True
+            else:
+                client.submit(commands)
+            entry[1] = coroutine
+            entry[2] = commands
+            entry[3] = time.time()
+        return finished
+
 class Pmac(object):
     '''A class that represents a single PMAC and its state.'''
+    pipelinedVarsPerBlock = 50
+    phases = ['connect', 'readout', 'reference', 'compare', 'render']
+    # The I variables that are read only, commented out in backups and not compared
+    readOnlyIVariables = set([3,4,6,9,20,21,22,23,24,41,58]+range(4900,5000)+
+        [5111,5112,5211,5212,5311,5312,5411,5412,5511,5512,5611,5612,5711,
+        5712,5811,5812,5911,5912,6011,6012,6111,6112,6211,6212,6311,6312,
+        6411,6412,6511,6512,6611,6612])
+    # The sections that can be selected by name, with their readers, a
+    # pattern matching the addresses they compare and the pages they render
+    readSections = {
+        'ivars': (['readIvars'], r'i\d+$', ['htmlIVariablePages']),
+        'pvars': (['readPvars'], r'p\d+$', ['htmlPVariablePage']),
+        'qvars': (['readQvars'], r'&\d+q\d+$', ['htmlCoordSystemPages']),
+        'mdefs': (['readMvarDefinitions'], r'm\d+$', ['htmlMVariablePages']),
+        'mvals': (['readMvarValues'], None, ['htmlMVariablePages']),
+        'plcs': (['readPlcPrograms', 'readPlcDisableState'], r'plc\d+$', ['htmlPlcPages']),
+        'progs': (['readMotionPrograms'], r'prog\d+$', ['htmlMotionProgramPages']),
+        'kinematics': (['readKinematicPrograms'], r'(fwd|inv)\d+$', ['htmlCoordSystemPages']),
+        'cs': (['readCoordinateSystemDefinitions'], r'&\d+#\d+$', ['htmlCoordSystemPages']),
+        'msivars': (['readMsIvars', 'readGlobalMsIvars'], r'ms\d+i\d+$',
+            ['htmlMsIVariablePages']),
+        'feedrate': (['readFeedrateOverrides'], r'&\d+%\d+$', ['htmlCoordSystemPages'])}
     def __init__(self, name):
         self.name = name
         self.noCompare = PmacState('noCompare')
@@ -2001,13 +4458,47 @@ class Pmac(object):
         self.numMacroStationIcs = None
         self.pti = None
         self.backupFile = None
+        self.backupStore = None
+        self.backupSnapshot = None
+        self.deltaBackupEvery = 0
+        self.deltaBackup = None
+        self.readSpecs = None
+        self.readAddrs = set()
+        self.sections = None
         self.referenceState = PmacState('reference')
         self.hardwareState = PmacState('hardware')
         self.compareResult = True
+        self.compareDiff = None
+        self.readFailure = None
         self.useFactoryDefs = True
         self.numAxes = 0
         self.positionsBefore = []
         self.positionsAfter = []
+        self.pipelineDepth = 1
+        self.pipeline = None
+        self.pipelined = False
+        self.recordFile = None
+        self.recorder = None
+        self.replayFile = None
+        self.replayRealTime = False
+        self.stats = None
+        self.quickCheck = None
+        self.readoutComplete = False
+        self.referenceLoaded = False
+        self.pollPlan = None
+        self.topologyCache = None
+        self.programCache = None
+        self.macroStations = None
+        self.phaseTimes = {}
+    def addPhaseTime(self, phase, seconds):
+        '''Adds to the time spent in one of the phases of the analysis.'''
+        self.phaseTimes[phase] = self.phaseTimes.get(phase, 0.0) + seconds
+    def phaseTimeList(self):
+        '''Returns the (phase, seconds) times spent in each phase so far.'''
+        return [(phase, self.phaseTimes[phase]) for phase in self.phases
+            if phase in self.phaseTimes]
+    def totalPhaseTime(self):
+        return sum(self.phaseTimes.values())
     def readCurrentPositions(self):
         '''Read the current motor positions of the PMAC.'''
         for axis in range(self.numAxes):
@@ -2015,6 +4506,51 @@ class Pmac(object):
             self.initialPositions[axis+1] = returnStr
             text += '%s ' % returnStr[:-2]
         print text
+    def bundleFileName(self, format):
+        '''Returns the file name of the JSON bundle of this PMAC.'''
+        if format == 'gzip':
+            return '%s_bundle.json.gz' % self.name
+        return '%s_bundle.json' % self.name
+    def writeBundle(self, resultsDir, format):
+        '''Writes the state of this PMAC as a single JSON bundle for the viewer.'''
+        bundle = {'name': self.name,
+            'timestamp': datetime.datetime.today().strftime('%x %X'),
+            'sections': bundleSections(self.numAxes, self.geobrick,
+                self.numMacroStationIcs, self.hardwareState)}
+        fileName = '%s/%s' % (resultsDir, self.bundleFileName(format))
+        tempFileName = '%s.tmp%s' % (fileName, os.getpid())
+        if format == 'gzip':
+            wFile = gzip.open(tempFileName, 'wb')
+        else:
+            wFile = open(tempFileName, 'w')
+        json.dump(bundle, wFile, separators=(',', ':'))
+        wFile.close()
+        os.rename(tempFileName, fileName)
+    def htmlPageJobs(self, resultsDir):
+        '''Returns the (function, arguments) jobs that render the web pages of
+           this PMAC.  Each job is given only the part of the state it needs.'''
+        state = self.hardwareState
+        jobs = [(htmlIVariablePages, (resultsDir, self.name, self.numAxes, self.geobrick,
+                state.slice('ivars', [PmacIVariable])))]
+        if self.numMacroStationIcs > 0:
+            jobs.append((htmlMsIVariablePages, (resultsDir, self.name, self.numAxes,
+                state.slice('msivars', [PmacMsIVariable]))))
+        jobs += [(htmlMVariablePages, (resultsDir, self.name,
+                state.slice('mvars', [PmacMVariable]))),
+            (htmlPVariablePage, (resultsDir, self.name,
+                state.slice('pvars', [PmacPVariable]))),
+            (htmlPlcPages, (resultsDir, self.name,
+                state.slice('plcs', [PmacPlcProgram, PmacPVariable]))),
+            (htmlMotionProgramPages, (resultsDir, self.name,
+                state.slice('progs', [PmacMotionProgram]))),
+            (htmlCoordSystemPages, (resultsDir, self.name,
+                state.slice('coordsystems', [PmacCsAxisDef, PmacForwardKinematicProgram,
+                PmacInverseKinematicProgram, PmacFeedrateOverride, PmacQVariable])))]
+        # Only the pages of the sections read if limited
+        pages = self.selectedSectionParts(2)
+        if pages is not None:
+            jobs = [job for job in jobs if job[0].__name__ in pages]
+        return jobs
     def htmlMotorIVariables(self, motor, page):
         self.hardwareState.htmlMotorIVariables(motor, page, self.geobrick)
     def htmlGlobalIVariables(self, page):
@@ -2023,14 +4559,25 @@ class Pmac(object):
         self.hardwareState.htmlMotorMsIVariables(motor, page)
     def htmlGlobalMsIVariables(self, page):
         self.hardwareState.htmlGlobalMsIVariables(page)
-    def compare(self, page, fixfile, unfixfile):
+    def compare(self):
+        '''Compares the hardware with the reference.  Returns a PmacCompareResult.
+           If a quick check stopped the readout its differences are used.'''
         print 'Comparing...'
-        self.compareResult = self.hardwareState.compare(self.referenceState, self.noCompare, self.name, page, fixfile, unfixfile)
+        started = time.time()
+        if self.quickCheck is not None and self.quickCheck.failedSection is not None:
+            self.compareDiff = self.quickCheck.result
+        elif self.selectedSections() is not None:
+            self.compareDiff = self.hardwareState.compare(self.referenceState, self.noCompare,
+                self.name, addrs=self.targetAddrs(), checkPlcs='plcs' in self.selectedSections())
+        else:
+            self.compareDiff = self.hardwareState.compare(self.referenceState, self.noCompare, self.name)
+        self.compareResult = self.compareDiff.matches()
+        self.addPhaseTime('compare', time.time() - started)
         if self.compareResult:
             print 'Hardware matches reference'
         else:
             print 'Hardware to reference mismatch detected'
-        return self.compareResult
+        return self.compareDiff
     def setProtocol(self, host, port, termServ):
         self.host = host
         self.port = port
@@ -2039,8 +4586,54 @@ class Pmac(object):
         self.geobrick = g
     def setNumMacroStationIcs(self, n):
         self.numMacroStationIcs = n
+    def setPipelineDepth(self, depth):
+        self.pipelineDepth = depth
     def setNoFactoryDefs(self):
         self.useFactoryDefs = False
+    def setQuickCheck(self, quickCheck):
+        self.quickCheck = quickCheck
+    def setReadSpecs(self, specs):
+        self.readSpecs = specs
+    def setSections(self, sections):
+        self.sections = sections
+    def selectedSections(self):
+        '''Returns the names of the sections selected by the sections and read
+           statements, or None if the whole PMAC is read.'''
+        result = None
+        if self.readSpecs is not None or self.sections is not None:
+            result = list(self.sections or [])
+            for spec in self.readSpecs or []:
+                if spec.lower() in self.readSections:
+                    result.append(spec.lower())
+        return result
+    def selectedSectionParts(self, part):
+        '''Returns the set of the readers (part 0), address patterns (part 1)
+           or page functions (part 2) of the selected sections, or None if the
+           whole PMAC is read.'''
+        result = None
+        sections = self.selectedSections()
+        if sections is not None:
+            result = set()
+            for name in sections:
+                value = self.readSections[name][part]
+                if isinstance(value, list):
+                    result.update(value)
+                elif value is not None:
+                    result.add(value)
+        return result
+    def setBackupStore(self, store):
+        self.backupStore = store
+    def setTopologyCache(self, cache):
+        self.topologyCache = cache
+    def setProgramCache(self, cache):
+        self.programCache = cache
+    def setDeltaBackupEvery(self, fullEvery):
+        self.deltaBackupEvery = fullEvery
+    def setRecordFile(self, fileName):
+        self.recordFile = fileName
+    def setReplayFile(self, fileName, realTime):
+        self.replayFile = fileName
+        self.replayRealTime = realTime
     def setReference(self, reference):
         self.reference = reference
     def setCompareWith(self, compareWith):
@@ -2053,69 +4646,360 @@ class Pmac(object):
             self.noCompare.removeVar(var)
     def copyNoComparesFrom(self, otherPmac):
         self.noCompare.copyFrom(otherPmac.noCompare)
-    def readHardware(self, backupDir, checkPositions, debug, comments, verbose):
+    def readHardware(self, backupDir, checkPositions, debug, comments, verbose,
+            compression=None):
         '''Loads the current state of the PMAC.  If a backupDir is provided, the
            state is written as it is read.'''
+        try:
+            self.beginReadout(backupDir, checkPositions, debug, comments, compression)
+            self.connect(verbose)
+            self.beginRecording()
+            started = time.time()
+            referenceTime = self.phaseTimes.get('reference', 0.0)
+            self.runSteps(self.readHardwareSteps())
+            # A quick check loads the reference during the readout
+            self.addPhaseTime('readout', time.time() - started -
+                (self.phaseTimes.get('reference', 0.0) - referenceTime))
+        finally:
+            self.disconnect()
+            self.endReadout()
+    def beginPolling(self, specs, bufferSize, debug, verbose):
+        '''Plans the commands that sample the poll specifications.  Returns the
+           PmacPollBuffer for the samples.'''
+        self.beginReadout(None, False, debug, False)
+        self.pollPlan = []
+        columns = []
+        for spec in specs:
+            match = re.match(r'#(\d+)(?:\.\.(\d+))?$', spec)
+            if match is not None:
+                first = int(match.group(1))
+                for motor in range(first, int(match.group(2) or first) + 1):
+                    self.pollPlan.append(('#%sP' % motor, 1))
+                    columns.append('#%s' % motor)
+                continue
+            parser = PmacParser([spec], None)
+            (varType, nodeList, start, count, increment) = parser.parseVarSpec()
+            numbers = range(start, start + count*increment, increment)
+            if varType == 'ms':
+                for ms in nodeList:
+                    for n in numbers:
+                        self.pollPlan.append(('ms%s,i%s' % (ms, n), 1))
+                        columns.append('ms%si%s' % (ms, n))
+                continue
+            if varType != '&':
+                nodeList = [None]
+            for node in nodeList:
+                prefix = varType
+                if varType == '&':
+                    prefix = '&%sq' % node
+                for (first, c, i) in coalesceRanges(numbers, [1]):
+                    plan = self.rangeCommands(prefix, first, first+c-1)
+                    ends = [n for (n, cmd) in plan[1:]] + [first+c]
+                    for (n, cmd), end in zip(plan, ends):
+                        self.pollPlan.append((cmd, end - n))
+                        columns += ['%s%s' % (prefix, x) for x in range(n, end)]
+        print 'Polling %s values of %s in %s commands' % (len(columns), self.name,
+            len(self.pollPlan))
+        return PmacPollBuffer(columns, bufferSize)
+    def pollSample(self, verbose):
+        '''Sends the poll commands, connecting first if there is no connection,
+           and returns the values read.  The connection is closed if the sample
+           fails.'''
+        try:
+            if self.pti is None:
+                self.connect(verbose)
+            results = self.sendCommands([cmd for (cmd, count) in self.pollPlan])
+            values = []
+            for (cmd, count), (returnStr, status) in zip(self.pollPlan, results):
+                if not status or returnStr.find('\x07') >= 0:
+                    raise PmacReadError(returnStr)
+                lines = returnStr.split('\r')[:-1]
+                if len(lines) != count:
+                    raise PmacReadError('Expected %s values from %s, got %s' %
+                        (count, cmd, repr(returnStr)))
+                try:
+                    values += [self.toNumber(x) for x in lines]
+                except (ValueError, IndexError):
+                    raise PmacReadError('Expected numbers from %s, got %s' %
+                        (cmd, repr(returnStr)))
+        except PmacReadError:
+            self.disconnect()
+            raise
+        return values
+    def watchReadout(self, checkPositions, debug, comments, verbose):
+        '''Reads the hardware into a new state over the connection kept open
+           by the previous readout, connecting first if there is none.  The
+           connection is closed if the readout fails.  The phase times are
+           those of this readout.'''
+        self.phaseTimes = {}
+        self.hardwareState = PmacState('hardware')
+        self.readAddrs = set()
+        try:
+            self.beginReadout(None, checkPositions, debug, comments)
+            if self.pti is None:
+                self.connect(verbose)
+            started = time.time()
+            self.runSteps(self.readHardwareSteps())
+            self.addPhaseTime('readout', time.time() - started)
+        except PmacReadError:
+            self.disconnect()
+            raise
+        finally:
+            self.endReadout()
+    def connect(self, verbose):
+        '''Opens either a recorded trace, a Telnet connection to a terminal
+           server, or a direct TCP/IP connection to the PMAC.'''
+        if self.replayFile is not None:
+            self.pti = PmacReplayInterface(self.replayFile, self.replayRealTime)
+        elif self.termServ:
+            self.pti = PmacTelnetInterface(verbose=verbose)
+        else:
+            self.pti = PmacEthernetInterface(verbose=verbose)
+        self.pti.setConnectionParams(self.host, self.port)
+        started = time.time()
+        msg = self.pti.connect()
+        self.addPhaseTime('connect', time.time() - started)
+        if msg != None:
+            raise PmacReadError(msg)
+        if self.replayFile is not None:
+            print 'Replaying PMAC trace %s.' % self.replayFile
+            self.pipelined = self.pti.isPipelined()
+        else:
+            print 'Connected to a PMAC via "%s" using port %s.' % (self.host, self.port)
+            if self.pipelineDepth > 1:
+                self.pipeline = PmacPipeline(self.pti, self.pipelineDepth)
+                self.pipelined = True
+    def disconnect(self):
+        '''Closes the connection to the PMAC, if open.'''
+        if self.pti is not None:
+            print 'Disconnecting from PMAC...'
+            msg = self.pti.disconnect()
+            self.pti = None
+            self.pipeline = None
+            print 'Connection to the PMAC closed.'
+    def applyFix(self, diff, verbose):
+        '''Downloads the fix for the differences to the PMAC in batched command
+           lines, then reads back only the variables and programs it touched.
+           Returns a PmacCompareResult of those that still differ.'''
+        text = StringIO.StringIO()
+        diff.writeFixFile(text)
+        commands = batchFixCommands(text.getvalue())
+        result = PmacCompareResult(self.name)
+        readoutStats = self.stats
+        self.stats = PmacReadoutStats(self.name)
+        try:
+            self.connect(verbose)
+            print 'Applying fix to %s in %s command lines...' % (self.name, len(commands))
+            self.runSteps(self.applyFixSteps(commands, diff, result))
+        finally:
+            self.disconnect()
+            self.stats = readoutStats
+        print 'Fix applied to %s, %s of %s differences remain' % (self.name,
+            len(result.differences), len(diff.differences))
+        return result
+    def applyFixSteps(self, commands, diff, result):
+        '''Coroutine that sends the fix commands and verifies what they touched,
+           adding the differences that remain to the result.'''
+        replies = yield commands
+        for command, (returnStr, status) in zip(commands, replies):
+            if not status or returnStr.find('\x07') >= 0:
+                raise PmacReadError('Fix command %s failed: %s' % (repr(command), repr(returnStr)))
+        # Sort what was touched into variable ranges, programs and PLC states
+        touched = {}
+        singles = []
+        programs = []
+        plcStates = []
+        for d in diff.differences:
+            var = d.referenceVar
+            if d.kind in ['Running', 'Not running']:
+                plcStates.append(d)
+            elif isinstance(var, PmacMsIVariable):
+                singles.append((d, 'ms%s,i%s' % (var.ms, var.n)))
+            elif isinstance(var, PmacCsAxisDef):
+                singles.append((d, '&%s#%s->' % (var.cs, var.n)))
+            elif isinstance(var, PmacFeedrateOverride):
+                singles.append((d, '&%s%%' % var.cs))
+            elif isinstance(var, PmacMVariable):
+                touched.setdefault(('m', '->'), {})[var.n] = d
+            elif isinstance(var, PmacIVariable):
+                touched.setdefault(('i', ''), {})[var.n] = d
+            elif isinstance(var, PmacPVariable):
+                touched.setdefault(('p', ''), {})[var.n] = d
+            elif isinstance(var, PmacQVariable):
+                touched.setdefault(('&%sq' % var.cs, ''), {})[var.n] = d
+            elif isinstance(var, (PmacPlcProgram, PmacMotionProgram,
+                    PmacForwardKinematicProgram, PmacInverseKinematicProgram)):
+                programs.append(d)
+        # Read back the variables using the range readers
+        plan = []
+        for ((prefix, suffix), diffs) in touched.iteritems():
+            for (start, count, increment) in coalesceRanges(diffs.keys(), [1]):
+                for (n, cmd) in self.rangeCommands(prefix, start, start+count-1, suffix):
+                    plan.append((prefix, suffix, n, cmd))
+        replies = yield [cmd for (prefix, suffix, n, cmd) in plan]
+        for (prefix, suffix, n, cmd), (returnStr, status) in zip(plan, replies):
+            if not status:
+                raise PmacReadError(returnStr)
+            for o,x in enumerate(returnStr.split('\r')[:-1]):
+                d = touched[(prefix, suffix)][n+o]
+                if suffix == '->':
+                    var = PmacMVariable(n+o)
+                    parser = PmacParser([x], self)
+                    parser.parseMVariableAddress(variable=var)
+                else:
+                    var = d.referenceVar.copyFrom()
+                    var.set(self.toNumber(x))
+                if not var.compare(d.referenceVar):
+                    result.add(PmacDifference(d.addr, 'Mismatch', d.referenceVar, var,
+                        d.description, d.comment))
+        # Read back the macro station I variables, axis definitions and
+        # feedrate overrides one at a time
+        replies = yield [cmd for (d, cmd) in singles]
+        for (d, cmd), (returnStr, status) in zip(singles, replies):
+            ref = d.referenceVar
+            if not status or not returnStr.endswith('\r\x06') or returnStr.find('\x07') >= 0:
+                result.add(PmacDifference(d.addr, 'Unverified', ref, None,
+                    d.description, d.comment))
+                continue
+            if isinstance(ref, PmacMsIVariable):
+                var = PmacMsIVariable(ref.ms, ref.n, self.toNumber(returnStr[:-2]), ro=ref.ro)
+            elif isinstance(ref, PmacCsAxisDef):
+                var = PmacCsAxisDef(ref.cs, ref.n, PmacParser([returnStr[:-2]], self).tokens())
+            else:
+                var = PmacFeedrateOverride(ref.cs, self.toNumber(returnStr[:-2]))
+            if not var.compare(ref):
+                result.add(PmacDifference(d.addr, 'Mismatch', ref, var,
+                    d.description, d.comment))
+        # List the programs again
+        for d in programs:
+            ref = d.referenceVar
+            if isinstance(ref, PmacForwardKinematicProgram):
+                [(returnStr, status)] = yield ['&%s list forward' % ref.n]
+                var = PmacForwardKinematicProgram(ref.n,
+                    PmacParser(returnStr.split('\r')[:-1], self).tokens())
+            elif isinstance(ref, PmacInverseKinematicProgram):
+                [(returnStr, status)] = yield ['&%s list inverse' % ref.n]
+                var = PmacInverseKinematicProgram(ref.n,
+                    PmacParser(returnStr.split('\r')[:-1], self).tokens())
+            elif isinstance(ref, PmacPlcProgram):
+                (lines, offsets) = yield self.getListingLines('plc %s' % ref.n)
+                var = PmacPlcProgram(ref.n, PmacParser(lines, self).tokens(), lines, offsets)
+            else:
+                (lines, offsets) = yield self.getListingLines('program %s' % ref.n)
+                var = PmacMotionProgram(ref.n, PmacParser(lines, self).tokens(), lines, offsets)
+            if not var.compare(ref):
+                result.add(PmacDifference(d.addr, 'Mismatch', ref, var))
+        # Check the PLCs that were enabled or disabled
+        if len(plcStates) > 0:
+            [(returnStr, status)] = yield ['m5000..5031']
+            if not status:
+                raise PmacReadError(returnStr)
+            running = [x == '0' for x in returnStr.split('\r')[:-1]]
+            for d in plcStates:
+                if running[int(d.addr[3:])] != (d.kind == 'Not running'):
+                    result.add(PmacDifference(d.addr, d.kind, None, None))
+    def beginReadout(self, backupDir, checkPositions, debug, comments, compression=None):
+        '''Prepares for a hardware readout, opening the backup file if required.'''
         self.checkPositions = checkPositions
         self.debug = debug
         self.comments = comments
-        try:
-            # Open the backup file if required
-            if backupDir is not None:
-                fileName = '%s/%s.pmc' % (backupDir, self.name)
-                print "Opening backup file %s" % fileName
-                self.backupFile = open(fileName, 'w')
-                if file is None:
-                    raise AnalyseError('Could not open backup file: %s' % fileName)
-            # Open either a Telnet connection to a terminal server,
-            # or a direct TCP/IP connection to a PMAC
-            if self.termServ:
-                self.pti = PmacTelnetInterface(verbose=verbose)
+        self.pipelined = False
+        self.readoutComplete = False
+        self.stats = PmacReadoutStats(self.name)
+        if backupDir is not None:
+            fileName = '%s/%s.pmc' % (backupDir, self.name)
+            if self.deltaBackupEvery > 0:
+                self.deltaBackup = PmacDeltaBackup(fileName,
+                    '%s/%s.delta.pmc' % (backupDir, self.name), self.deltaBackupEvery,
+                    compression)
+            if self.deltaBackup is None or self.deltaBackup.full:
+                self.backupFile = PmacBackupWriter(fileName, compression)
+                print "Opening backup file %s" % self.backupFile.fileName
+        if self.backupStore is not None:
+            self.backupSnapshot = PmacBackupSnapshot(self.backupStore, self.name)
+    def beginRecording(self):
+        '''Starts recording the readout to a trace file if required.'''
+        if self.recordFile is not None:
+            print "Recording trace file %s" % self.recordFile
+            self.recorder = PmacTraceWriter(self.recordFile, self)
+    def endReadout(self):
+        '''Closes the backup and trace files at the end of a hardware readout.
+           The backup only replaces the previous one if the readout completed.'''
+        self.stats.finish()
+        if self.backupFile is not None:
+            if self.readoutComplete:
+                self.backupFile.commit()
             else:
-                self.pti = PmacEthernetInterface(verbose=verbose)
-            self.pti.setConnectionParams(self.host, self.port)
-            msg = self.pti.connect()
-            if msg != None:
-                raise PmacReadError(msg)
-            print 'Connected to a PMAC via "%s" using port %s.' % (self.host, self.port)
-            # Work out what kind of PMAC we have, if necessary
-            self.determinePmacType()
-            self.determineNumAxes()
-            self.determineNumCoordSystems()
-            # Read the axis current positions
-            self.positionsBefore = self.readCurrentPositions()
-            #print 'Current positions: %s' % self.positionsBefore
-            # Read the data
-            self.readCoordinateSystemDefinitions()
-            self.readMotionPrograms()
-            self.readKinematicPrograms()
-            self.readPlcPrograms()
-            self.readPvars()
-            self.readQvars()
-            self.readFeedrateOverrides()
-            self.readIvars()
-            self.readMvarDefinitions()
-            self.readMvarValues()
-            self.readMsIvars()
-            self.readGlobalMsIvars()
-            self.readPlcDisableState()
-            self.verifyCurrentPositions(self.positionsBefore)
+                print "Backup of %s incomplete, previous backup left in place" % self.name
+                self.backupFile.abort()
+            self.backupFile = None
+        if self.deltaBackup is not None:
+            if self.readoutComplete and self.deltaBackup.full:
+                self.deltaBackup.removeDelta()
+            elif self.readoutComplete:
+                self.deltaBackup.write(self.hardwareState, self.name)
+            self.deltaBackup = None
+        if self.backupSnapshot is not None:
+            if self.readoutComplete:
+                self.backupSnapshot.commit()
+            else:
+                self.backupSnapshot.abort()
+            self.backupSnapshot = None
+        if self.recorder is not None:
+            self.recorder.close()
+            self.recorder = None
+        if self.programCache is not None:
+            self.programCache.save()
+    def readHardwareSteps(self):
+        '''Readout coroutine that reads the state of the PMAC once connected.'''
+        # Work out what kind of PMAC we have, if necessary
+        yield self.determineTopology()
+        if self.quickCheck is not None:
+            self.quickCheck.loadReference(PmacLiveResolver(self))
+        # Read the axis current positions
+        if self.readSpecs is None:
+            self.positionsBefore = yield self.readCurrentPositions()
+        #print 'Current positions: %s' % self.positionsBefore
+        # Read the data, only the selected sections if limited
+        readers = self.selectedSectionParts(0)
+        for section in [self.readCoordinateSystemDefinitions, self.readMotionPrograms,
+                self.readKinematicPrograms, self.readPlcPrograms, self.readPvars,
+                self.readQvars, self.readFeedrateOverrides, self.readIvars,
+                self.readMvarDefinitions, self.readMvarValues, self.readMsIvars,
+                self.readGlobalMsIvars, self.readPlcDisableState]:
+            if readers is not None and section.__name__ not in readers:
+                continue
+            if self.backupSnapshot is not None:
+                self.backupSnapshot.section(section.__name__)
+            yield section()
+            if self.quickCheck is not None and not self.quickCheck.check(section.__name__):
+                return
+        if self.readSpecs is not None:
+            # Read the variables asked for
+            for spec in self.readSpecs:
+                if spec.lower() not in self.readSections:
+                    yield self.readVarSpec(spec)
+        else:
             # Read the current axis positions again
-        finally:
-            # Disconnect from the PMAC
-            if self.pti is not None:
-                print 'Disconnecting from PMAC...'
-                msg = self.pti.disconnect()
-                self.pti = None
-                print 'Connection to the PMAC closed.'
-            # Close the backup file
-            if self.backupFile is not None:
-                self.backupFile.close()
-                self.backupFile = None
+            yield self.verifyCurrentPositions(self.positionsBefore)
+            self.readoutComplete = readers is None
+    def runSteps(self, steps):
+        '''Runs a readout coroutine to completion over the current connection.'''
+        coroutine = PmacCoroutine(steps, self.stats)
+        commands = coroutine.advance()
+        while commands is not None:
+            commands = coroutine.advance(self.sendCommands(commands))
+    def createAsyncInterface(self, timeout):
+        '''Returns an unconnected non-blocking interface for this PMAC.'''
+        if self.termServ:
+            result = PmacAsyncTelnetInterface(self.host, self.port, self.pipelineDepth, timeout)
+        else:
+            result = PmacAsyncEthernetInterface(self.host, self.port, self.pipelineDepth, timeout)
+        return result
     def verifyCurrentPositions(self, positions):
         ''' Checks the axis current positions to see if any have moved.'''
         if self.checkPositions:
-            now = self.readCurrentPositions()
+            now = yield self.readCurrentPositions()
             match = True
             for i in range(len(now)):
                 if match and now[i] < positions[i]+10.0 and now[i] > positions[i]-10.0:
@@ -2129,21 +5013,161 @@ class Pmac(object):
                 print '  Before: %s' % positions
                 print '  Now:    %s' % now
     def sendCommand(self, text):
-        (returnStr, status) = self.pti.sendCommand(text)
-        if self.debug:
-            print '%s --> %s' % (repr(text), repr(returnStr))
+        started = time.time()
+        if self.pipeline is not None and self.pipeline.failure is not None:
+            (returnStr, status) = (self.pipeline.failure, False)
+        else:
+            (returnStr, status) = self.pti.sendCommand(text)
+        self.traceCommands([text], [(returnStr, status)], time.time() - started)
         return (returnStr, status)
+    def sendCommands(self, commands):
+        '''Sends a list of commands, through the pipeline if there is one.
+           Returns a list of (returnStr, status) tuples in command order.'''
+        if self.pipeline is None:
+            return [self.sendCommand(text) for text in commands]
+        started = time.time()
+        results = self.pipeline.sendCommands(commands)
+        self.traceCommands(commands, results, time.time() - started)
+        return results
+    def traceCommands(self, commands, results, elapsed):
+        '''Prints the commands and their replies in debug mode, adds them to the
+           readout statistics and records them if a trace is being recorded.'''
+        self.stats.record(commands, results, elapsed)
+        if self.debug:
+            for text, (returnStr, status) in zip(commands, results):
+                print '%s --> %s' % (repr(text), repr(returnStr))
+        if self.recorder is not None:
+            self.recorder.record(commands, results)
+    def readVarSpec(self, spec):
+        '''Reads the variables of a variable specification, as used by the
+           nocompare statement, for example i100..199, &1q1..50 or ms[0,1],i910.'''
+        print 'Reading %s...' % spec
+        parser = PmacParser([spec], None)
+        (varType, nodeList, start, count, increment) = parser.parseVarSpec()
+        numbers = range(start, start + count*increment, increment)
+        plan = []
+        if varType == 'ms':
+            for ms in nodeList:
+                for n in numbers:
+                    plan.append((ms, n, 'ms%s,i%s' % (ms, n)))
+        else:
+            if varType != '&':
+                nodeList = [None]
+            for node in nodeList:
+                (prefix, suffix) = {'i': ('i', ''), 'p': ('p', ''), 'm': ('m', '->'),
+                    '&': ('&%sq' % node, '')}[varType]
+                for (first, c, i) in coalesceRanges(numbers, [1]):
+                    for (n, cmd) in self.rangeCommands(prefix, first, first+c-1, suffix):
+                        plan.append((node, n, cmd))
+        results = yield [cmd for (node, n, cmd) in plan]
+        for (node, n, cmd), (returnStr, status) in zip(plan, results):
+            if not status or returnStr.find('\x07') >= 0:
+                raise PmacReadError(returnStr)
+            for o,x in enumerate(returnStr.split('\r')[:-1]):
+                if varType == 'i':
+                    var = PmacIVariable(n+o, self.toNumber(x),
+                        ro=n+o in self.readOnlyIVariables)
+                elif varType == 'p':
+                    var = PmacPVariable(n+o, self.toNumber(x))
+                elif varType == 'm':
+                    var = PmacMVariable(n+o)
+                    parser = PmacParser([x], self)
+                    parser.parseMVariableAddress(variable=var)
+                elif varType == 'ms':
+                    var = PmacMsIVariable(node, n, self.toNumber(x))
+                else:
+                    var = PmacQVariable(node, n+o, self.toNumber(x))
+                self.hardwareState.addVar(var)
+                self.readAddrs.add(var.addr())
+    def targetAddrs(self):
+        '''Returns the addresses to compare after a readout limited to some
+           variables or sections, the variables read and every address of the
+           sections read in either state.'''
+        result = set(self.readAddrs)
+        for pattern in self.selectedSectionParts(1):
+            pattern = re.compile(pattern)
+            for state in [self.hardwareState, self.referenceState]:
+                for addr in state.vars.iterkeys():
+                    if pattern.match(addr):
+                        result.add(addr)
+        return result
+    def rangeCommands(self, prefix, first, last, suffix='', varsPerBlock=100):
+        '''Returns a list of (start, command) tuples that read the variables
+           first..last in blocks.  Pipelined blocks are kept small enough for
+           each reply to fit in a single Ethernet packet.'''
+        if self.pipelined:
+            varsPerBlock = min(varsPerBlock, self.pipelinedVarsPerBlock)
+        plan = []
+        i = first
+        while i <= last:
+            iend = min(i + varsPerBlock - 1, last)
+            if iend == i:
+                plan.append((i, '%s%s%s' % (prefix, i, suffix)))
+            else:
+                plan.append((i, '%s%s..%s%s' % (prefix, i, iend, suffix)))
+            i += varsPerBlock
+        return plan
     def readCurrentPositions(self):
         ''' Returns the current position as a list.'''
         positions = []
-        for axis in range(self.numAxes):
-            (returnStr, status) = self.sendCommand('#%sP' % (axis+1))
+        results = yield ['#%sP' % (axis+1) for axis in range(self.numAxes)]
+        for (returnStr, status) in results:
+            if not status or returnStr.find('\x07') >= 0:
+                raise PmacReadError(returnStr)
             positions.append(float(returnStr[:-2]))
-        return positions
+        yield PmacReturn(positions)
+    def determineTopology(self):
+        '''Discovers the type, axes, coordinate systems and macro stations of
+           the PMAC.  With a topology cache, a single probe validates the cached
+           topology and a PMAC that has to be discovered is added to the cache.'''
+        entry = None
+        if self.topologyCache is not None:
+            entry = self.topologyCache.get(self)
+        if entry is not None:
+            [(returnStr, status)] = yield [entry['probe']]
+            if status and returnStr == entry['reply']:
+                print 'Topology of %s from cache' % self.name
+                if self.geobrick is None:
+                    self.geobrick = entry['geobrick']
+                if self.numMacroStationIcs is None:
+                    self.numMacroStationIcs = entry['numMacroStationIcs']
+                    self.macroStations = entry['macroStations']
+                self.numAxes = self.numMacroStationIcs * 8
+                if self.geobrick:
+                    self.numAxes += 8
+                self.numCoordSystems = entry['numCoordSystems']
+                return
+            print 'Topology cache of %s out of date' % self.name
+        yield self.determinePmacType()
+        yield self.determineNumAxes()
+        yield self.determineNumCoordSystems()
+        if self.topologyCache is not None:
+            yield self.determineMacroStations()
+            probe = ' '.join(['cid', 'i20 i21 i22 i23', 'i68'] +
+                ['i%s' % (6841 + 50*ic) for ic in range(min(self.numMacroStationIcs, 4))])
+            [(returnStr, status)] = yield [probe]
+            if status:
+                self.topologyCache.put(self, {'probe': probe, 'reply': returnStr,
+                    'geobrick': self.geobrick, 'numMacroStationIcs': self.numMacroStationIcs,
+                    'numCoordSystems': self.numCoordSystems,
+                    'macroStations': self.macroStations})
+    def determineMacroStations(self):
+        '''Discovers the macro stations in use from the node enables of each
+           macro station IC, if not already known.'''
+        if self.macroStations is None:
+            self.macroStations = []
+            for ic in range(min(self.numMacroStationIcs, 4)):
+                [(bits, status)] = yield ['i%s' % (6841 + 50*ic)]
+                if status and bits[0] != '\x07':
+                    bits = self.toNumber(bits[:-2])
+                    for i in range(0, 14):
+                        if bits & 1 == 1:
+                            self.macroStations += [i + 16*ic]
+                        bits = bits >> 1
     def determinePmacType(self):
         '''Discovers whether the PMAC is a Geobrick or a VME style PMAC'''
         if self.geobrick is None:
-            (returnStr, status) = self.sendCommand('cid')
+            [(returnStr, status)] = yield ['cid']
             if not status:
                 raise PmacReadError(returnStr)
             id = returnStr[:-2]
@@ -2158,7 +5182,7 @@ class Pmac(object):
         '''Determines the number of axes the PMAC has by determining the
            number of macro station ICs.'''
         if self.numMacroStationIcs is None:
-            (returnStr, status) = self.sendCommand('i20 i21 i22 i23')
+            [(returnStr, status)] = yield ['i20 i21 i22 i23']
             if not status:
                 raise PmacReadError(returnStr)
             macroIcAddresses = returnStr[:-2].split('\r')
@@ -2173,7 +5197,7 @@ class Pmac(object):
     def determineNumCoordSystems(self):
         '''Determines the number of coordinate systems that are active by
            reading i68.'''
-        (returnStr, status) = self.sendCommand('i68')
+        [(returnStr, status)] = yield ['i68']
         if not status:
             raise PmacReadError(returnStr)
         self.numCoordSystems = int(returnStr[:-2]) + 1
@@ -2181,26 +5205,20 @@ class Pmac(object):
         '''If a backup file is open, write the text.'''
         if self.backupFile is not None:
             self.backupFile.write(text)
+        if self.backupSnapshot is not None:
+            self.backupSnapshot.write(text)
     def readIvars(self):
         '''Reads the I variables.'''
         print 'Reading I-variables...'
         self.writeBackup('\n; I-variables\n')
-        roVars = set([3,4,6,9,20,21,22,23,24,41,58]+range(4900,5000)+
-            [5111,5112,5211,5212,5311,5312,5411,5412,5511,5512,5611,5612,5711,
-            5712,5811,5812,5911,5912,6011,6012,6111,6112,6211,6212,6311,6312,
-            6411,6412,6511,6512,6611,6612])
-        varsPerBlock = 100
-        i = 0
-        while i < 8192:
-            iend = i + varsPerBlock - 1
-            if iend >= 8192:
-                iend = 8191
-            (returnStr, status) = self.sendCommand('i%s..%s' % (i, iend))
+        plan = self.rangeCommands('i', 0, 8191)
+        results = yield [cmd for (i, cmd) in plan]
+        for (i, cmd), (returnStr, status) in zip(plan, results):
             if not status:
                 raise PmacReadError(returnStr)
             ivars = enumerate(returnStr.split("\r")[:-1])
             for o,x in ivars:
-                ro = i+o in roVars
+                ro = i+o in self.readOnlyIVariables
                 var = PmacIVariable(i+o, self.toNumber(x), ro=ro)
                 self.hardwareState.addVar(var)
                 motor = (i+o) / 100
@@ -2212,10 +5230,9 @@ class Pmac(object):
                    if motor >= 1 and motor <= 32 and index in PmacState.motorIVariableDescriptions:
                        text = PmacState.motorIVariableDescriptions[index]
                 self.writeBackup(var.dump(comment=text))
-            i += varsPerBlock
     def readPlcDisableState(self):
         '''Reads the PLC disable state from the M variables 5000..5031.'''
-        (returnStr, status) = self.sendCommand('m5000..5031')
+        [(returnStr, status)] = yield ['m5000..5031']
         if not status:
             raise PmacReadError(returnStr)
         mvars = enumerate(returnStr.split("\r")[:-1])
@@ -2230,13 +5247,9 @@ class Pmac(object):
         '''Reads the P variables.'''
         print 'Reading P-variables...'
         self.writeBackup('\n; P-variables\n')
-        varsPerBlock = 100
-        i = 0
-        while i < 8192:
-            iend = i + varsPerBlock - 1
-            if iend >= 8192:
-                iend = 8191
-            (returnStr, status) = self.sendCommand('p%s..%s' % (i, iend))
+        plan = self.rangeCommands('p', 0, 8191)
+        results = yield [cmd for (i, cmd) in plan]
+        for (i, cmd), (returnStr, status) in zip(plan, results):
             if not status:
                 raise PmacReadError(returnStr)
             pvars = enumerate(returnStr.split("\r")[:-1])
@@ -2244,26 +5257,32 @@ class Pmac(object):
                 var = PmacPVariable(i+o, self.toNumber(x))
                 self.hardwareState.addVar(var)
                 self.writeBackup(var.dump())
-            i += varsPerBlock
     def readQvars(self):
         '''Reads the Q variables of a coordinate system.'''
         print 'Reading Q-variables...'
+        plan = []
         for cs in range(1,self.numCoordSystems+1):
-            self.writeBackup('\n; &%s Q-variables\n' % cs)
-            (returnStr, status) = self.sendCommand('&%sq1..199' % cs)
+            for (q, cmd) in self.rangeCommands('&%sq' % cs, 1, 199, varsPerBlock=199):
+                plan.append((cs, q, cmd))
+        results = yield [cmd for (cs, q, cmd) in plan]
+        lastCs = None
+        for (cs, q, cmd), (returnStr, status) in zip(plan, results):
+            if cs != lastCs:
+                self.writeBackup('\n; &%s Q-variables\n' % cs)
+                lastCs = cs
             if not status:
                 raise PmacReadError(returnStr)
             qvars = enumerate(returnStr.split("\r")[:-1])
             for o,x in qvars:
-                var = PmacQVariable(cs, o+1, self.toNumber(x))
+                var = PmacQVariable(cs, q+o, self.toNumber(x))
                 self.hardwareState.addVar(var)
                 self.writeBackup(var.dump())
     def readFeedrateOverrides(self):
         '''Reads the feedrate overrides of the coordinate systems.'''
         print 'Reading feedrate overrides...'
         self.writeBackup('\n; Feedrate overrides\n')
-        for cs in range(1,self.numCoordSystems+1):
-            (returnStr, status) = self.sendCommand('&%s%%' % cs)
+        results = yield ['&%s%%' % cs for cs in range(1,self.numCoordSystems+1)]
+        for cs, (returnStr, status) in zip(range(1,self.numCoordSystems+1), results):
             if not status:
                 raise PmacReadError(returnStr)
             val = returnStr.split("\r")[0]
@@ -2274,13 +5293,9 @@ class Pmac(object):
         '''Reads the M variable definitions.'''
         print 'Reading M-variable definitions...'
         self.writeBackup('\n; M-variables\n')
-        varsPerBlock = 100
-        i = 0
-        while i < 8192:
-            iend = i + varsPerBlock - 1
-            if iend >= 8192:
-                iend = 8191
-            (returnStr, status) = self.sendCommand('m%s..%s->' % (i, iend))
+        plan = self.rangeCommands('m', 0, 8191, '->')
+        results = yield [cmd for (i, cmd) in plan]
+        for (i, cmd), (returnStr, status) in zip(plan, results):
             if not status:
                 raise PmacReadError(returnStr)
             mvars = enumerate(returnStr.split("\r")[:-1])
@@ -2290,17 +5305,12 @@ class Pmac(object):
                 parser.parseMVariableAddress(variable=var)
                 self.hardwareState.addVar(var)
                 self.writeBackup(var.dump())
-            i += varsPerBlock
     def readMvarValues(self):
         '''Reads the M variable values.'''
         print 'Reading M-variable values...'
-        varsPerBlock = 100
-        i = 0
-        while i < 8192:
-            iend = i + varsPerBlock - 1
-            if iend >= 8192:
-                iend = 8191
-            (returnStr, status) = self.sendCommand('m%s..%s' % (i, iend))
+        plan = self.rangeCommands('m', 0, 8191)
+        results = yield [cmd for (i, cmd) in plan]
+        for (i, cmd), (returnStr, status) in zip(plan, results):
             if not status:
                 raise PmacReadError(returnStr)
             mvars = enumerate(returnStr.split("\r")[:-1])
@@ -2309,24 +5319,25 @@ class Pmac(object):
                 var.setValue(self.toNumber(x))
                 #if (i+o) == 99:
                 #    print "m99 ->%s, =%s, x=%s" % (var.valStr(), var.contentsStr(), x)
-            i += varsPerBlock
     def readCoordinateSystemDefinitions(self):
         '''Reads the coordinate system definitions.'''
         print 'Reading coordinate system definitions...'
         self.writeBackup('\n; Coordinate system definitions\n')
         self.writeBackup('undefine all\n')
+        plan = []
         for cs in range(1,self.numCoordSystems+1):
             for axis in range(1,32+1):  # Note range is always 32 NOT self.numAxes
-                # Ask for the motor status in the coordinate system
-                cmd = '&%s#%s->' % (cs, axis)
-                (returnStr, status) = self.sendCommand(cmd)
-                if not status or len(returnStr) <= 2:
-                    raise PmacReadError(returnStr)
-                # Note the dropping of the last two characters, ^m^f
-                parser = PmacParser([returnStr[:-2]], self)
-                var = PmacCsAxisDef(cs, axis, parser.tokens())
-                self.hardwareState.addVar(var)
-                self.writeBackup(var.dump())
+                plan.append((cs, axis))
+        # Ask for the motor status in the coordinate system
+        results = yield ['&%s#%s->' % (cs, axis) for (cs, axis) in plan]
+        for (cs, axis), (returnStr, status) in zip(plan, results):
+            if not status or len(returnStr) <= 2:
+                raise PmacReadError(returnStr)
+            # Note the dropping of the last two characters, ^m^f
+            parser = PmacParser([returnStr[:-2]], self)
+            var = PmacCsAxisDef(cs, axis, parser.tokens())
+            self.hardwareState.addVar(var)
+            self.writeBackup(var.dump())
     def readKinematicPrograms(self):
         '''Reads the kinematic programs.  Note that this
            function will fail if a program exceeds 1350 characters and small buffers
@@ -2334,7 +5345,7 @@ class Pmac(object):
         print 'Reading kinematic programs...'
         self.writeBackup('\n; Kinematic programs\n')
         for cs in range(1,self.numCoordSystems+1):
-            (returnStr, status) = self.sendCommand('&%s list forward' % cs)
+            [(returnStr, status)] = yield ['&%s list forward' % cs]
             if not status:
                 raise PmacReadError(returnStr)
             if not self.termServ and len(returnStr) > 1350:
@@ -2345,7 +5356,7 @@ class Pmac(object):
                 var = PmacForwardKinematicProgram(cs, parser.tokens())
                 self.hardwareState.addVar(var)
                 self.writeBackup(var.dump())
-            (returnStr, status) = self.sendCommand('&%s list inverse' % cs)
+            [(returnStr, status)] = yield ['&%s list inverse' % cs]
             if not status:
                 raise PmacReadError(returnStr)
             if not self.termServ and len(returnStr) > 1350:
@@ -2356,19 +5367,48 @@ class Pmac(object):
                 var = PmacInverseKinematicProgram(cs, parser.tokens())
                 self.hardwareState.addVar(var)
                 self.writeBackup(var.dump())
-    def getListingLines(self, thing):
+    def readListing(self, thing):
+        '''Returns the listing of a motion program or PLC.  If the program cache
+           holds the listing, the commands of all its blocks are sent at once and
+           the cached listing is returned if their replies are unchanged.'''
+        entry = None
+        if self.programCache is not None:
+            entry = self.programCache.get(self, thing)
+        if entry is not None:
+            results = yield [command for (command, reply) in entry['probes']]
+            unchanged = True
+            for (command, reply), (returnStr, status) in zip(entry['probes'], results):
+                if not status or returnStr != reply:
+                    unchanged = False
+            if unchanged:
+                yield PmacReturn((entry['lines'], entry['offsets']))
+                return
+        blocks = []
+        (lines, offsets) = yield self.getListingLines(thing, blocks)
+        if self.programCache is not None and len(blocks) > 0 and \
+                len([status for (command, reply, status) in blocks if not status]) == 0:
+            # Fingerprint with every block, so that no edit can be missed
+            probes = [(command, reply) for (command, reply, status) in blocks]
+            self.programCache.put(self, thing, {'probes': probes, 'lines': lines,
+                'offsets': offsets})
+        yield PmacReturn((lines, offsets))
+    def getListingLines(self, thing, blocks=None):
         '''Returns the listing of a motion program or PLC using
            small blocks.  It uses the start and length parameters
            of the list command to slowly build up the listing.  Note
            that the function fails if any chuck exceeds 1350 characters.
-           For use in small buffer mode.'''
+           For use in small buffer mode.  The (command, reply, status) of
+           each block is appended to blocks if given.'''
         lines = []
         offsets = []
         startPos = 0
         increment = 80
         going = True
         while going:
-            (returnStr, status) = self.sendCommand('list %s,%s,%s' % (thing, startPos, increment))
+            command = 'list %s,%s,%s' % (thing, startPos, increment)
+            [(returnStr, status)] = yield [command]
+            if blocks is not None:
+                blocks.append((command, returnStr, status))
             startPos += increment
             if not status:
                 if returnStr.endswith('PMAC communication error'):
@@ -2403,13 +5443,13 @@ class Pmac(object):
                     lines = lines[:-1]
                     offsets = offsets[:-1]
                     startPos = lastStartPos
-        return (lines, offsets)
+        yield PmacReturn((lines, offsets))
     def readPlcPrograms(self):
         '''Reads the PLC programs'''
         print 'Reading PLC programs...'
         self.writeBackup('\n; PLC programs\n')
         for plc in range(32):
-            (lines, offsets) = self.getListingLines('plc %s' % plc)
+            (lines, offsets) = yield self.readListing('plc %s' % plc)
             if len(lines) > 0:
                 parser = PmacParser(lines, self)
                 var = PmacPlcProgram(plc, parser.tokens(), lines, offsets)
@@ -2421,7 +5461,7 @@ class Pmac(object):
         print 'Reading motion programs...'
         self.writeBackup('\n; Motion programs\n')
         for prog in range(1,256):
-            (lines, offsets) = self.getListingLines('program %s' % prog)
+            (lines, offsets) = yield self.readListing('program %s' % prog)
             if len(lines) == 1 and lines[0].find('ERR003') >= 0:
                 lines = []
                 offsets = []
@@ -2435,43 +5475,11 @@ class Pmac(object):
         if self.numMacroStationIcs > 0:
             print 'Reading macro station I-variables'
             self.writeBackup('\n; Macro station I-variables\n')
-            reqMacroStations = []
-            if self.numMacroStationIcs >= 1:
-                (bits, status) = self.sendCommand('i6841')
-                if status and bits[0] != '\x07':
-                    bits = self.toNumber(bits[:-2])
-                    for i in range(0, 14):
-                        if bits & 1 == 1:
-                            reqMacroStations += [i]
-                        bits = bits >> 1
-            if self.numMacroStationIcs >= 2:
-                (bits, status) = self.sendCommand('i6891')
-                if status and bits[0] != '\x07':
-                    bits = self.toNumber(bits[:-2])
-                    for i in range(0, 14):
-                        if bits & 1 == 1:
-                            reqMacroStations += [i + 16]
-                        bits = bits >> 1
-            if self.numMacroStationIcs >= 3:
-                (bits, status) = self.sendCommand('i6941')
-                if status and bits[0] != '\x07':
-                    bits = self.toNumber(bits[:-2])
-                    for i in range(0, 14):
-                        if bits & 1 == 1:
-                            reqMacroStations += [i + 32]
-                        bits = bits >> 1
-            if self.numMacroStationIcs >= 4:
-                (bits, status) = self.sendCommand('i6991')
-                if status and bits[0] != '\x07':
-                    bits = self.toNumber(bits[:-2])
-                    for i in range(0, 14):
-                        if bits & 1 == 1:
-                            reqMacroStations += [i + 48]
-                        bits = bits >> 1
+            yield self.determineMacroStations()
             reqVars = [910,911,912,913,914,915,916,917,918,923,925,926,927,928,929]
             roVars = [921,922,924,930,938,939]
-            for ms in reqMacroStations:
-                self.doMsIvars(ms, reqVars, roVars)
+            for ms in self.macroStations:
+                yield self.doMsIvars(ms, reqVars, roVars)
     def readGlobalMsIvars(self):
         '''Reads the global macrostation I variables.'''
         if self.numMacroStationIcs > 0:
@@ -2496,7 +5504,7 @@ class Pmac(object):
             reqVars += [987,988,989,992,993,994,995,996,996,998,999]
             roVars = [4,5,12,13,209,974]
             for ms in reqMacroStations:
-                self.doMsIvars(ms, reqVars, roVars)
+                yield self.doMsIvars(ms, reqVars, roVars)
             reqVars = range(16,100)
             reqVars += range(101,109)
             reqVars += range(111,119)
@@ -2508,23 +5516,21 @@ class Pmac(object):
             roVars = [4,5,12,13,209,974]
             reqMacroStations = [16,48]
             for ms in reqMacroStations:
-                self.doMsIvars(ms, reqVars, roVars)
+                yield self.doMsIvars(ms, reqVars, roVars)
     def doMsIvars(self, ms, reqVars, roVars):
         '''Reads the specified set of global macrostation I variables.'''
-        for v in reqVars:
-            (returnStr, status) = self.sendCommand('ms%s,i%s' % (ms, v))
+        plan = [(v, False) for v in reqVars] + [(v, True) for v in roVars]
+        results = yield ['ms%s,i%s' % (ms, v) for (v, ro) in plan]
+        for (v, ro), (returnStr, status) in zip(plan, results):
             if status and returnStr[0] != '\x07':
-                var = PmacMsIVariable(ms, v, self.toNumber(returnStr[:-2]))
+                var = PmacMsIVariable(ms, v, self.toNumber(returnStr[:-2]), ro=ro)
                 self.hardwareState.addVar(var)
                 self.writeBackup(var.dump())
-        for v in roVars:
-            (returnStr, status) = self.sendCommand('ms%s,i%s' % (ms, v))
-            if status and returnStr[0] != '\x07':
-                var = PmacMsIVariable(ms, v, self.toNumber(returnStr[:-2]), ro=True)
-                self.hardwareState.addVar(var)
-                self.writeBackup(var.dump())
-    def loadReference(self, factorySettings, includePaths=None):
-        '''Loads the reference PMC file after first initialising the state.'''
+    def loadReference(self, factorySettings, includePaths=None, resolutionState=None):
+        '''Loads the reference PMC file after first initialising the state.
+           Inline expressions are resolved against the hardware state unless
+           another resolution state is given.'''
+        started = time.time()
         # Feedrate overrides default to 100
         for cs in range(1,self.numCoordSystems+1):
             var = PmacFeedrateOverride(cs, 100.0)
@@ -2532,8 +5538,11 @@ class Pmac(object):
         if factorySettings is not None:
             self.referenceState.copyFrom(factorySettings)
         if self.reference is not None:
-            self.referenceState.setInlineExpressionResolutionState(self.hardwareState)
+            if resolutionState is None:
+                resolutionState = self.hardwareState
+            self.referenceState.setInlineExpressionResolutionState(resolutionState)
             self.referenceState.loadPmcFileWithPreprocess(self.reference, includePaths)
+        self.addPhaseTime('reference', time.time() - started)
     def loadCompareWith(self):
         '''Loads the compare with file.'''
         self.hardwareState.loadPmcFile(self.compareWith)
@@ -2918,7 +5927,8 @@ class PmacParser(object):
         result = self.parseE1()
         going = True
         while going:
-            t = self.lexer.getToken()
+            # An expression ends at the end of the line
+            t = self.lexer.getToken(wantEol=True)
             if t == '+':
                 result = result + self.parseE1()
             elif t == '-':
@@ -2936,7 +5946,7 @@ class PmacParser(object):
         result = self.parseE2()
         going = True
         while going:
-            t = self.lexer.getToken()
+            t = self.lexer.getToken(wantEol=True)
             if t == '*':
                 result = result * self.parseE2()
             elif t == '/':
@@ -3319,11 +6329,21 @@ class PmacLexer(object):
 def main():
     '''Main entry point of the script.'''
     config = GlobalConfig()
-    if config.processArguments():
-        config.processConfigFile()
-        config.analyse()
-    else:
+    if not config.processArguments():
         print helpText
+    elif config.restoreManifest is not None:
+        config.restoreBackup()
+    else:
+        config.processConfigFile()
+        try:
+            if config.changesSpec is not None:
+                config.printChanges()
+            elif config.queryText is not None:
+                config.query()
+            else:
+                config.analyse()
+        finally:
+            discardOpenPages()
     return 0
 
 if __name__ == '__main__':
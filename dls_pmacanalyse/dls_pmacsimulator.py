@@ -0,0 +1,388 @@
+#!/bin/env dls-python
+# ------------------------------------------------------------------------------
+# pmacsimulator.py
+#
+# Purpose: A TCP server that pretends to be a PMAC, answering the commands
+#          dls-pmac-analyse sends from a state loaded from a PMC file.  Used
+#          to benchmark and test the analyser without real hardware.
+# ------------------------------------------------------------------------------
+
+import getopt, sys, re, os, os.path, socket, struct, threading, time, SocketServer
+
+if __name__ == '__main__':
+    sys.path.append(os.path.abspath(os.path.join(__file__, "..", "..", "..", "dls_pmaclib")))
+
+from dls_pmacanalyse import PmacState, PmacIVariable, PmacMVariable, \
+    PmacPVariable, PmacQVariable, PmacFeedrateOverride, PmacMsIVariable, PmacCsAxisDef, \
+    PmacParser, ArgumentError, ParserError, LexerError, GeneralError
+
+helpText = '''
+  Simulate a Delta-Tau PMAC motor controller for dls-pmac-analyse.
+
+  Syntax:
+    dls-pmac-simulator.py [<options>] <pmcFile>
+        where <options> is one or more of:
+        -h, --help                Print the help text and exit
+        --port=<port>             TCP port to listen on, defaults to 1025
+        --ts                      Talk like a terminal server rather than the
+                                  PMAC Ethernet protocol
+        --geobrick                Identify as a Geobrick rather than a VME PMAC
+        --nofactorydefs           Do not initialise the state from the factory defaults
+        --include=<paths>         Colon seperated include paths for the PMC preprocessor
+        --latency=<seconds>       Delay before each reply, defaults to 0
+        --maxreply=<bytes>        Largest reply sent in one Ethernet packet, the rest
+                                  must be fetched with VR_PMAC_GETBUFFER.  Defaults to 1400
+  '''
+
+class PmacSimulatorState(object):
+    '''Answers PMAC commands from a PmacState, which assignments, M-variable
+       definitions and program downloads change.'''
+    version = '1.945  '
+    hexGlobalIVariables = range(20, 25)
+    wordsPerLine = 4
+    def __init__(self, state, geobrick=False):
+        self.state = state
+        self.geobrick = geobrick
+        self.curCs = 1
+        self.download = None
+        self.lock = threading.Lock()
+    def execute(self, command):
+        '''Returns the reply to a command line, including the terminator.'''
+        self.lock.acquire()
+        try:
+            result = ''
+            text = command.strip().upper()
+            if self.download is not None or re.search(r'\bOPEN\b', text) is not None:
+                return self.doDownload(text)
+            while len(text) > 0:
+                reply = None
+                for regex, handler in self.handlers:
+                    match = regex.match(text)
+                    if match is not None:
+                        reply = handler(self, *match.groups())
+                        text = text[match.end():].lstrip()
+                        break
+                if reply is None:
+                    return '\x07ERR003\r'
+                result += reply
+            return result + '\x06'
+        finally:
+            self.lock.release()
+    def valueList(self, values):
+        return ''.join(['%s\r' % v for v in values])
+    def numbers(self, start, end):
+        start = int(start)
+        if end is None:
+            end = start
+        return range(start, int(end)+1)
+    def doVersion(self):
+        return '%s\r' % self.version
+    def doCid(self):
+        if self.geobrick:
+            result = '603382\r'
+        else:
+            result = '602413\r'
+        return result
+    def load(self, lines):
+        '''Loads PMC text into the state with the analyser's parser.  Returns
+           False if it could not be parsed.'''
+        try:
+            PmacParser(['%s\n' % line for line in lines], self.state).onLine()
+        except (ParserError, LexerError, GeneralError):
+            return False
+        return True
+    def doAssign(self, text):
+        if not self.load([text]):
+            return None
+        return ''
+    def doDownload(self, text):
+        '''Collects the lines of a program buffer from open to close and
+           then loads them.'''
+        if self.download is None:
+            self.download = []
+        self.download.append(text)
+        result = '\x06'
+        if text == 'CLOSE':
+            if not self.load(self.download):
+                result = '\x07ERR003\r'
+            self.download = None
+        return result
+    def doIRead(self, start, end):
+        values = []
+        for n in self.numbers(start, end):
+            var = self.state.getVarNoCreate('i', n)
+            if var is None:
+                var = PmacIVariable(n)
+            if n in self.hexGlobalIVariables and not isinstance(var.v, float):
+                values.append('$%x' % var.v)
+            else:
+                values.append(var.valStr())
+        return self.valueList(values)
+    def doPRead(self, start, end):
+        values = []
+        for n in self.numbers(start, end):
+            var = self.state.getVarNoCreate('p', n)
+            if var is None:
+                var = PmacPVariable(n)
+            values.append(var.valStr())
+        return self.valueList(values)
+    def doMDefinitions(self, start, end):
+        values = []
+        for n in self.numbers(start, end):
+            var = self.state.getVarNoCreate('m', n)
+            if var is None:
+                var = PmacMVariable(n)
+            values.append(var.valStr())
+        return self.valueList(values)
+    def doMValues(self, start, end):
+        values = []
+        for n in self.numbers(start, end):
+            if n >= 5000 and n < 5032:
+                values.append(self.plcDisableState(n - 5000))
+            else:
+                var = self.state.getVarNoCreate('m', n)
+                if var is None:
+                    var = PmacMVariable(n)
+                values.append(var.contentsStr())
+        return self.valueList(values)
+    def plcDisableState(self, n):
+        '''Returns the PLC disable M-variable value, 0 for a running PLC.'''
+        result = '1'
+        plc = self.state.getPlcProgramNoCreate(n)
+        if plc is not None and not plc.isEmpty():
+            plc.setShouldBeRunning()
+            if plc.shouldBeRunning:
+                result = '0'
+        return result
+    def doQRead(self, cs, start, end):
+        if cs is None:
+            cs = self.curCs
+        values = []
+        for n in self.numbers(start, end):
+            var = self.state.getVarNoCreate2('&', int(cs), 'q', n)
+            if var is None:
+                var = PmacQVariable(int(cs), n)
+            values.append(var.valStr())
+        return self.valueList(values)
+    def doAxisDef(self, cs, axis):
+        var = self.state.getCsAxisDefNoCreate(int(cs), int(axis))
+        if var is None:
+            var = PmacCsAxisDef(int(cs), int(axis))
+        return '%s\r' % var.valueText().strip()
+    def doFeedrate(self, cs):
+        var = self.state.getFeedrateOverrideNoCreate(int(cs))
+        if var is None:
+            var = PmacFeedrateOverride(int(cs), 100.0)
+        return '%s\r' % var.valStr()
+    def doSetCs(self, cs):
+        self.curCs = int(cs)
+        return ''
+    def doPosition(self, motor):
+        return '0\r'
+    def doSetMotor(self, motor):
+        return ''
+    def doMsIRead(self, ms, n):
+        var = self.state.getVarNoCreate2('ms', int(ms), 'i', int(n))
+        if var is None:
+            var = PmacMsIVariable(int(ms), int(n), 0)
+        return '%s\r' % var.valStr()
+    def doListKinematic(self, which):
+        if which == 'FORWARD':
+            prog = self.state.getForwardKinematicProgramNoCreate(self.curCs)
+        else:
+            prog = self.state.getInverseKinematicProgramNoCreate(self.curCs)
+        result = ''
+        if prog is not None and not prog.isEmpty():
+            result = self.valueList(self.programLines(prog))
+        return result
+    def doListPlc(self, n, start, length):
+        return self.listing(self.state.getPlcProgramNoCreate(int(n)), int(start), int(length))
+    def doListProgram(self, n, start, length):
+        return self.listing(self.state.getMotionProgramNoCreate(int(n)), int(start), int(length))
+    def programLines(self, prog):
+        return [line for line in prog.valueText(typ=1).split('\n') if len(line) > 0]
+    def listing(self, prog, start, length):
+        '''Lists the lines of a buffer with word offsets in start..start+length.
+           Returns None (an error) for a missing buffer or a start beyond its end.'''
+        result = None
+        if prog is not None and not prog.isEmpty():
+            lines = []
+            offset = 0
+            for line in self.programLines(prog):
+                if offset >= start and offset < start + length:
+                    lines.append('%s:%s' % (offset, line))
+                offset += max(1, len(line.split()) / self.wordsPerLine + 1)
+            if start < offset:
+                result = self.valueList(lines)
+        return result
+    handlers = [
+        (re.compile(r'((?:&\d+)?[IPQM][0-9.,]+(?:=|->)\S+|MS\d+,I\d+=\S+|&\d+%\S+|(?:ENABLE|DISABLE)\s*PLCC?\s*[0-9,]+)'),
+            doAssign),
+        (re.compile(r'VER'), doVersion),
+        (re.compile(r'CID'), doCid),
+        (re.compile(r'LIST\s*PLC\s*(\d+)\s*,\s*(\d+)\s*,\s*(\d+)'), doListPlc),
+        (re.compile(r'LIST\s*PROG(?:RAM)?\s*(\d+)\s*,\s*(\d+)\s*,\s*(\d+)'), doListProgram),
+        (re.compile(r'LIST\s*(FORWARD|INVERSE)'), doListKinematic),
+        (re.compile(r'MS(\d+)\s*,\s*I(\d+)'), doMsIRead),
+        (re.compile(r'I(\d+)(?:\.\.(\d+))?'), doIRead),
+        (re.compile(r'P(\d+)(?:\.\.(\d+))?'), doPRead),
+        (re.compile(r'M(\d+)(?:\.\.(\d+))?->'), doMDefinitions),
+        (re.compile(r'M(\d+)(?:\.\.(\d+))?'), doMValues),
+        (re.compile(r'&(\d+)#(\d+)->'), doAxisDef),
+        (re.compile(r'&(\d+)%'), doFeedrate),
+        (re.compile(r'&(\d+)?Q(\d+)(?:\.\.(\d+))?'), doQRead),
+        (re.compile(r'&(\d+)'), doSetCs),
+        (re.compile(r'#(\d+)P'), doPosition),
+        (re.compile(r'#(\d+)'), doSetMotor),
+        ]
+
+class PmacSimulatorHandler(SocketServer.BaseRequestHandler):
+    '''Serves one connection to the simulator.'''
+    def handle(self):
+        if self.server.termServ:
+            self.handleTerminalServer()
+        else:
+            self.handleEthernet()
+    def reply(self, command):
+        if self.server.latency > 0:
+            time.sleep(self.server.latency)
+        self.server.commandCount += 1
+        return self.server.simulator.execute(command)
+    def receive(self, length):
+        '''Returns exactly length bytes, or None if the connection closed.'''
+        data = ''
+        while len(data) < length:
+            more = self.request.recv(length - len(data))
+            if len(more) == 0:
+                return None
+            data += more
+        return data
+    def handleEthernet(self):
+        '''Implements the VR_PMAC_GETRESPONSE and VR_PMAC_GETBUFFER requests.'''
+        pending = ''
+        going = True
+        while going:
+            header = self.receive(8)
+            if header is None:
+                going = False
+            else:
+                (requestType, request, value, index, length) = struct.unpack('>BBHHH', header)
+                if request == 0xbf:
+                    command = self.receive(length)
+                    if command is None:
+                        going = False
+                    else:
+                        pending = self.reply(command)
+                        pending = self.sendPacket(pending)
+                elif request == 0xc5:
+                    pending = self.sendPacket(pending)
+                else:
+                    self.request.sendall('\x06')
+    def sendPacket(self, text):
+        '''Sends up to maxReply bytes of the text, returning the remainder.'''
+        self.request.sendall(text[:self.server.maxReply])
+        return text[self.server.maxReply:]
+    def handleTerminalServer(self):
+        '''Implements a raw character stream terminated by carriage returns.'''
+        buffer = ''
+        going = True
+        while going:
+            data = self.request.recv(4096)
+            if len(data) == 0:
+                going = False
+            else:
+                buffer += data
+                while '\r' in buffer:
+                    (command, buffer) = buffer.split('\r', 1)
+                    buffer = buffer.lstrip('\n')
+                    self.request.sendall(self.reply(command))
+
+class PmacSimulator(SocketServer.ThreadingTCPServer):
+    '''A simulated PMAC.  Create it with a PmacState and call start() to
+       serve in a background thread of this process, or serve_forever() to
+       serve in the calling thread.  A port of 0 picks a free port, which
+       is then available as the port attribute.'''
+    allow_reuse_address = True
+    daemon_threads = True
+    def __init__(self, state, port=0, host='localhost', termServ=False, geobrick=False,
+            latency=0.0, maxReply=1400):
+        SocketServer.ThreadingTCPServer.__init__(self, (host, port), PmacSimulatorHandler)
+        self.simulator = PmacSimulatorState(state, geobrick)
+        self.port = self.server_address[1]
+        self.termServ = termServ
+        self.latency = latency
+        self.maxReply = maxReply
+        self.commandCount = 0
+        self.thread = None
+    def start(self):
+        '''Serves in a daemon thread.'''
+        self.thread = threading.Thread(target=self.serve_forever)
+        self.thread.setDaemon(True)
+        self.thread.start()
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+def loadSimulatorState(pmcFile, geobrick=False, useFactoryDefs=True, includePaths=None):
+    '''Returns a PmacState initialised from the factory settings and the PMC file.'''
+    state = PmacState('simulator')
+    state.setInlineExpressionResolutionState(state)
+    if useFactoryDefs:
+        if geobrick:
+            factoryFile = 'factorySettings_geobrick.pmc'
+        else:
+            factoryFile = 'factorySettings_pmac.pmc'
+        state.loadPmcFileWithPreprocess(os.path.join(os.path.dirname(__file__), factoryFile),
+            includePaths)
+    if pmcFile is not None:
+        state.loadPmcFileWithPreprocess(pmcFile, includePaths)
+    return state
+
+def main():
+    '''Main entry point of the script.'''
+    try:
+        opts, args = getopt.gnu_getopt(sys.argv[1:], 'h',
+            ['help', 'port=', 'ts', 'geobrick', 'nofactorydefs', 'include=',
+            'latency=', 'maxreply='])
+    except getopt.GetoptError, err:
+        raise ArgumentError(str(err))
+    port = 1025
+    termServ = False
+    geobrick = False
+    useFactoryDefs = True
+    includePaths = None
+    latency = 0.0
+    maxReply = 1400
+    for o, a in opts:
+        if o in ('-h', '--help'):
+            print helpText
+            return 0
+        elif o == '--port':
+            port = int(a)
+        elif o == '--ts':
+            termServ = True
+        elif o == '--geobrick':
+            geobrick = True
+        elif o == '--nofactorydefs':
+            useFactoryDefs = False
+        elif o == '--include':
+            includePaths = a
+        elif o == '--latency':
+            latency = float(a)
+        elif o == '--maxreply':
+            maxReply = int(a)
+    if len(args) != 1:
+        print helpText
+        return 1
+    state = loadSimulatorState(args[0], geobrick, useFactoryDefs, includePaths)
+    server = PmacSimulator(state, port, '', termServ, geobrick, latency, maxReply)
+    print 'Simulating a PMAC from %s on port %s...' % (args[0], server.port)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    print 'Served %s commands.' % server.commandCount
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -14,7 +14,8 @@ setup(
     author_email = 'fgz73762@rl.ac.uk',    
     packages = ['dls_pmacanalyse'],
     entry_points = {'console_scripts': [
-        'dls-pmac-analyse.py = dls_pmacanalyse.dls_pmacanalyse:main']},
+        'dls-pmac-analyse.py = dls_pmacanalyse.dls_pmacanalyse:main',
+        'dls-pmac-simulator.py = dls_pmacanalyse.dls_pmacsimulator:main']},
     package_data = {'': ['*.pmc']},
     zip_safe = False
     )        
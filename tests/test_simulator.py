@@ -0,0 +1,320 @@
+# ------------------------------------------------------------------------------
+# test_simulator.py
+#
+# Purpose: Regression tests of dls-pmac-analyse against dls-pmac-simulator,
+#          which is run in this process on a free port.
+# ------------------------------------------------------------------------------
+
+import os, sys, re, socket, gzip, json, pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'dls_pmacanalyse'))
+
+from dls_pmacanalyse import *
+from dls_pmacsimulator import PmacSimulator, loadSimulatorState
+
+pmcText = '''p100=5
+p101=6
+i130=7000
+m1->X:$78000,0
+open plc 3 clear
+p100=p100+1
+if (p101=3)
+p102=1
+endif
+close
+open prog 10 clear
+linear abs x10 y20 dwell100
+close
+'''
+
+@pytest.fixture(scope='module')
+def simulator(tmpdir_factory):
+    '''A simulated PMAC answering on a free port.'''
+    pmcFile = tmpdir_factory.mktemp('sim').join('sim.pmc')
+    pmcFile.write(pmcText)
+    server = PmacSimulator(loadSimulatorState(str(pmcFile)))
+    server.start()
+    yield server
+    server.stop()
+
+def makePmac(simulator, **settings):
+    pmac = Pmac('SIM')
+    pmac.setProtocol('localhost', simulator.port, False)
+    pmac.setPipelineDepth(settings.get('pipeline', 1))
+    return pmac
+
+def readout(pmac):
+    pmac.readHardware(None, False, False, False, False)
+    return dict((addr, var.dump()) for addr, var in pmac.hardwareState.vars.iteritems())
+
+def closedPort():
+    '''Returns a port on which nothing is listening.'''
+    closed = socket.socket()
+    closed.bind(('localhost', 0))
+    port = closed.getsockname()[1]
+    closed.close()
+    return port
+
+def test_coalesceRanges():
+    assert coalesceRanges([], [1]) == []
+    assert coalesceRanges([5], [1]) == [(5, 1, 1)]
+    assert coalesceRanges([3, 1, 2, 7], [1]) == [(1, 3, 1), (7, 1, 1)]
+    assert coalesceRanges([130, 230, 330, 131], [1, 100]) == [(130, 3, 100), (131, 1, 1)]
+
+def test_readout(simulator):
+    pmac = makePmac(simulator)
+    state = readout(pmac)
+    assert pmac.readoutComplete
+    assert pmac.hardwareState.getPVariable(100).valStr() == '5'
+    assert pmac.hardwareState.getIVariable(130).valStr() == '7000'
+    assert 'plc3' in state and 'prog10' in state
+    assert 'P101=3' in pmac.hardwareState.vars['plc3'].valueText()
+
+def test_pipelinedReadout(simulator):
+    assert readout(makePmac(simulator, pipeline=8)) == readout(makePmac(simulator))
+
+def test_recordReplay(simulator, tmpdir):
+    traceFile = str(tmpdir.join('SIM.trace.gz'))
+    pmac = makePmac(simulator)
+    pmac.setRecordFile(traceFile)
+    recorded = readout(pmac)
+    pmac = makePmac(simulator)
+    pmac.setReplayFile(traceFile, False)
+    assert readout(pmac) == recorded
+
+def runAnalyse(ports, tmpdir, monkeypatch, *options, **references):
+    '''Runs the analysis of the PMACs, by name, on the ports with the options
+       given and returns its configuration.  The reference file of a PMAC may
+       be given by name.'''
+    configFile = tmpdir.join('sim.cfg')
+    text = 'resultsdir %s\n' % tmpdir.join('results')
+    for name, port in sorted(ports.items()):
+        text += 'pmac %s\ntcpip localhost %s\n' % (name, port)
+        if name in references:
+            text += 'reference %s\n' % references[name]
+    configFile.write(text)
+    monkeypatch.setattr(sys, 'argv', ['dls-pmac-analyse.py'] + list(options) + [str(configFile)])
+    config = GlobalConfig()
+    assert config.processArguments()
+    config.processConfigFile()
+    config.analyse()
+    return config
+
+def test_recordReplayWithCaches(simulator, tmpdir, monkeypatch):
+    caches = ['--topologycache=%s' % tmpdir.join('topology.json'),
+        '--programcache=%s' % tmpdir.join('programs.json')]
+    runAnalyse({'SIM': simulator.port}, tmpdir, monkeypatch, *caches)
+    config = runAnalyse({'SIM': simulator.port}, tmpdir, monkeypatch,
+        '--record=%s' % tmpdir.join('trace'), *caches)
+    recorded = config.pmacs['SIM'].hardwareState.dump()
+    config = runAnalyse({'SIM': simulator.port}, tmpdir, monkeypatch,
+        '--replay=%s' % tmpdir.join('trace'), *caches)
+    assert config.pmacs['SIM'].hardwareState.dump() == recorded
+
+def test_programCacheSeesMiddleEdit(tmpdir):
+    # A PLC of several listing blocks, edited in the middle without changing its length
+    plcLines = ['p%s=1' % n for n in range(200, 500)]
+    pmcFile = tmpdir.join('long.pmc')
+    pmcFile.write('\n'.join(['open plc 5 clear'] + plcLines + ['close', '']))
+    server = PmacSimulator(loadSimulatorState(str(pmcFile)))
+    server.start()
+    cache = PmacProgramCache(str(tmpdir.join('programs.json')))
+    listings = []
+    try:
+        for edited in [False, False, True]:
+            if edited:
+                plcLines[150] = 'p350=2'
+                for line in ['open plc 5 clear'] + plcLines + ['close']:
+                    server.simulator.execute(line)
+            pmac = makePmac(server, pipeline=8)
+            pmac.setProgramCache(cache)
+            pmac.setSections(['plcs'])
+            readout(pmac)
+            listings.append(pmac.hardwareState.vars['plc5'].valueText())
+    finally:
+        server.stop()
+    assert len(cache.get(pmac, 'plc 5')['probes']) > 3
+    assert listings[0] == listings[1]
+    assert 'P350=2' in listings[2] and 'P350=1' not in listings[2]
+
+def test_applyFixReadsBack(simulator):
+    diff = PmacCompareResult('SIM')
+    for var in [PmacMsIVariable(0, 910, 7), PmacFeedrateOverride(1, 50)]:
+        diff.add(PmacDifference(var.addr(), 'Mismatch', var, None))
+    pmac = makePmac(simulator)
+    readout(pmac)
+    assert pmac.applyFix(diff, False).differences == []
+    assert simulator.simulator.execute('ms0,i910 &1%') == '7\r50\r\x06'
+
+def test_simulatorRejectsBadAssignments(simulator):
+    for command in ['P1=abc', 'M1->zz', 'P1=(3', 'Q1=1/']:
+        assert simulator.simulator.execute(command) == '\x07ERR003\r'
+
+@pytest.mark.parametrize('options', [['--concurrent=3'], []])
+def test_readoutFailures(simulator, tmpdir, monkeypatch, options):
+    # A PMAC that answers position requests with an error, and one that is not there
+    pmcFile = tmpdir.join('bad.pmc')
+    pmcFile.write('i20=$78400\n')
+    badPositions = PmacSimulator(loadSimulatorState(str(pmcFile)))
+    badPositions.simulator.handlers = [(re.compile(r'#(\d+)P'),
+        lambda self, motor: '\x07ERR003\r')] + badPositions.simulator.handlers
+    badPositions.start()
+    try:
+        config = runAnalyse({'SIM': simulator.port, 'BAD': badPositions.port,
+            'DEAD': closedPort()}, tmpdir, monkeypatch, '--checkpositions', *options)
+    finally:
+        badPositions.stop()
+    assert config.pmacs['SIM'].readFailure is None
+    assert config.pmacs['BAD'].readFailure is not None
+    assert config.pmacs['DEAD'].readFailure is not None
+    assert not tmpdir.join('results', 'DEAD_compare.json').exists()
+    report = tmpdir.join('results', 'report.xml').read()
+    assert report.count('Read failed') == 2
+
+def test_pollSurvivesBadSamples(simulator):
+    pytest.importorskip('numpy')
+    pmac = makePmac(simulator)
+    buffer = pmac.beginPolling(['p100..101', '#1'], 10, False, False)
+    buffer.add(1.0, pmac.pollSample(False))
+    # An error reply fails the sample and closes the connection
+    pmac.pollPlan.append(('p1=', 1))
+    with pytest.raises(PmacReadError):
+        pmac.pollSample(False)
+    assert pmac.pti is None
+    buffer.add(2.0, None)
+    pmac.pollPlan.pop()
+    buffer.add(3.0, pmac.pollSample(False))
+    pmac.disconnect()
+    result = buffer.toDict()
+    assert (result['samples'], result['failed']) == (3, 1)
+    assert result['statistics']['p101'] == {'min': 6.0, 'max': 6.0, 'mean': 6.0, 'std': 0.0}
+
+def test_failedPageLeavesNoTempFile(tmpdir):
+    def failingPage(fileName, name):
+        page = WebPage('Failing page for %s' % name, fileName)
+        page.paragraph(page.body(), 'Partial')
+        raise GeneralError('Rendering failed')
+    with pytest.raises(GeneralError):
+        runPageJob((failingPage, (str(tmpdir.join('failing.htm')), 'SIM')))
+    assert tmpdir.listdir() == []
+
+def test_readSpecOfReadOnlyIVariables(simulator, tmpdir, monkeypatch):
+    runAnalyse({'SIM': simulator.port}, tmpdir, monkeypatch,
+        '--backup=%s' % tmpdir.join('backup'))
+    backup = str(tmpdir.join('backup', 'SIM.pmc'))
+    assert ';i3=' in open(backup).read()
+    config = runAnalyse({'SIM': simulator.port}, tmpdir, monkeypatch, '--read=i0..99',
+        SIM=backup)
+    assert config.pmacs['SIM'].compareDiff.differences == []
+
+def test_history(tmpdir):
+    history = PmacHistory(str(tmpdir.join('history.db')))
+    runs = []
+    for started, values in [(1.0, [PmacPVariable(1, 5), PmacIVariable(130, 7000)]),
+            (2.0, [PmacPVariable(1, 5)]),
+            (3.0, [PmacPVariable(1, 6), PmacIVariable(130, 7000)])]:
+        state = PmacState('hardware')
+        for var in values:
+            state.addVar(var)
+        runs.append(history.store('SIM', started, state))
+    assert history.state('SIM', run=runs[0]) == {('p', None, 1): '5', ('i', None, 130): '7000'}
+    assert history.state('SIM', run=runs[1]) == {('p', None, 1): '5'}
+    assert history.state('SIM') == {('p', None, 1): '6', ('i', None, 130): '7000'}
+    assert history.changes('SIM', 'p1') == [(1.0, '5'), (3.0, '6')]
+    assert history.changes('SIM', 'i130') == [(1.0, '7000'), (2.0, None), (3.0, '7000')]
+    assert history.pmacNames() == ['SIM']
+    history.close()
+
+def test_pipelineFailsAfterLongReply(simulator):
+    pmac = makePmac(simulator, pipeline=4)
+    pmac.beginReadout(None, False, False, False)
+    pmac.connect(False)
+    try:
+        results = pmac.sendCommands(['p100', 'p0..999', 'p101', 'p102'])
+        assert results[0] == ('5\r\x06', True)
+        assert [status for (returnStr, status) in results] == [True, False, False, False]
+        assert 'too long' in results[1][0]
+        # The replies still in flight are never read as those of later commands
+        assert pmac.sendCommands(['p100', 'p101']) == [(results[1][0], False)] * 2
+        assert pmac.sendCommand('p100') == (results[1][0], False)
+    finally:
+        pmac.disconnect()
+        pmac.endReadout()
+
+def test_backupCommitAndAbort(simulator, tmpdir):
+    backupDir = str(tmpdir)
+    pmac = makePmac(simulator)
+    pmac.readHardware(backupDir, False, False, False, False, 'gzip')
+    backup = openBackupFile(str(tmpdir.join('SIM.pmc.gz'))).read()
+    assert 'P100=5' in backup.upper()
+    # A failed readout leaves the previous backup in place and no temporary file
+    dead = Pmac('SIM')
+    dead.setProtocol('localhost', closedPort(), False)
+    with pytest.raises(PmacReadError):
+        dead.readHardware(backupDir, False, False, False, False, 'gzip')
+    assert openBackupFile(str(tmpdir.join('SIM.pmc.gz'))).read() == backup
+    assert [p.basename for p in tmpdir.listdir()] == ['SIM.pmc.gz']
+
+def test_backupStoreRestore(simulator, tmpdir):
+    store = PmacBackupStore(str(tmpdir.join('store')))
+    pmac = makePmac(simulator)
+    pmac.setBackupStore(store)
+    pmac.readHardware(str(tmpdir), False, False, False, False)
+    assert len(store.manifests('SIM')) == 1
+    assert store.restore(store.manifests('SIM')[0]) == tmpdir.join('SIM.pmc').read()
+
+def test_deltaBackupRestoresState(simulator, tmpdir):
+    backupDir = str(tmpdir)
+    try:
+        for command in [None, 'p101=9']:
+            if command is not None:
+                simulator.simulator.execute(command)
+            pmac = makePmac(simulator)
+            pmac.setDeltaBackupEvery(3)
+            pmac.readHardware(backupDir, False, False, False, False)
+    finally:
+        simulator.simulator.execute('p101=6')
+    assert tmpdir.join('SIM.delta.pmc').exists()
+    # Loading the base followed by the delta gives the state of the last readout
+    restored = PmacState('restored')
+    for fileName in ['SIM.pmc', 'SIM.delta.pmc']:
+        PmacParser(openBackupFile(str(tmpdir.join(fileName))), restored).onLine()
+    assert restored.getPVariable(101).valStr() == '9'
+    diff = pmac.hardwareState.compare(restored, PmacState('noCompare'), 'SIM', checkPlcs=False)
+    assert diff.differences == []
+
+def test_fixFileCoalescesRanges(tmpdir):
+    diff = PmacCompareResult('SIM')
+    for var in [PmacPVariable(200, 0), PmacIVariable(130, 1), PmacPVariable(201, 0),
+            PmacIVariable(230, 1), PmacPVariable(202, 0), PmacIVariable(330, 1),
+            PmacPVariable(204, 0), PmacPVariable(205, 3)]:
+        diff.add(PmacDifference(var.addr(), 'Mismatch', var, None))
+    fixFile = tmpdir.join('SIM_fix.pmc')
+    file = open(str(fixFile), 'w')
+    diff.writeFixFile(file)
+    file.close()
+    assert fixFile.read().split('\n') == ['p200..202=0', 'i130,3,100=1', 'p204=0', 'p205=3', '']
+    # The ranges assign the same values as the separate assignments
+    fixed = PmacState('fixed')
+    PmacParser(open(str(fixFile)), fixed).onLine()
+    assert [fixed.getPVariable(n).valStr() for n in [200, 201, 202, 204, 205]] == ['0', '0', '0', '0', '3']
+    assert [fixed.getIVariable(n).valStr() for n in [130, 230, 330]] == ['1', '1', '1']
+
+def test_querySnapshotFiles(tmpdir, monkeypatch, capsys):
+    snapshots = tmpdir.mkdir('snapshots')
+    snapshots.join('A.pmc').write('i130=7000\np100=5\n')
+    file = gzip.open(str(snapshots.join('B.pmc.gz')), 'wb')
+    file.write('i130=3\np100=5\n')
+    file.close()
+    configFile = tmpdir.join('query.cfg')
+    configFile.write('resultsdir %s\n' % tmpdir.join('results'))
+    monkeypatch.setattr(sys, 'argv', ['dls-pmac-analyse.py', '--query=i130>5',
+        '--querypath=%s' % snapshots, '--queryindex=%s' % tmpdir.join('index.db'),
+        '--queryformat=json', str(configFile)])
+    for indexed in [False, True]:
+        assert main() == 0
+        (out, err) = capsys.readouterr()
+        assert json.loads(out) == [{'source': str(snapshots.join('A.pmc')),
+            'addr': 'i130', 'value': '7000'}]
+        # The second query uses the index of the unchanged files
+        assert ('Indexing 2 of 2 snapshot files' in err) != indexed